@@ -1,30 +1,52 @@
-'''Communication with ELSA control system for E3 low current beam monitor'''
+'''Communication with ELSA control system for E3 low current beam monitor
+
+The pyBAR scans, the RunManager, the power supply and the sockets are
+created on first use, importing the module only sets up the analysis core.
+'''
+from startup import StartupReport, Outbox
+# time of each startup step, see the "startup" command
+startup_report = StartupReport()
 
 import zmq
 import logging
-from basil.dut import Dut
-from pybar.run_manager import RunManager
-from pybar.scans.tune_gdac import GdacTuning
-from pybar.scans.tune_tdac import TdacTuning
-from pybar.scans.scan_analog import AnalogScan
-from pybar.scans.scan_digital import DigitalScan
-from pybar.scans.tune_noise_occupancy import NoiseOccupancyTuning
-from pybar.scans.tune_stuck_pixel import StuckPixelTuning
-from pybar.scans.scan_fei4_self_trigger import Fei4SelfTriggerScan
-from pybar.scans.scan_ext_trigger import ExtTriggerScan
+import importlib
 import datetime
 import time
-from pybar.daq.readout_utils import is_data_record, get_col_row_array_from_data_record_array, is_fe_word
 import numpy as np
+from pybar.daq.readout_utils import is_data_record, get_col_row_array_from_data_record_array, is_fe_word
 from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
-import zlib
-import cPickle as pickle
-from pybar.daq import fifo_readout
 from pybar.daq import readout_utils as ru
+import batch_analysis
+from batch_analysis import is_record
+import hit_kernel
+from hit_kernel import HitHistogram
+from hist_codec import HistEncoder
+from hist_transport import HistPublisher, HIT_MAP_TOPICS, COMBINED_TOPIC, front_end_topic
+from publish_scheduler import PublishScheduler
+from hist_streams import StreamPublisher
+from hist_accumulators import AccumulatedMaps
+from spill_structure import SpillMonitor
+from beam_state import BeamState, EVENT_BEAM_ON, EVENT_BEAM_OFF, EVENT_HITRATE_PEAK, EVENT_BEAM_MOVED
+from beam_detector import create_detector
+from beam_recorder import Recorder
+from beam_spot import MomentBeamSpot
+from pixel_mask import PixelMask, NoisyPixelTracker
+from analysis_queue import AnalysisQueue
+from parallel_analysis import ParallelAnalysis, ModulePool
+from front_ends import FrontEnd, CombinedView
+from metrics import Metrics
+from event_loop import EventLoop, RunWatcher, ScanChain, MessageQueue
+from power_supply import get_power_supply
+
+startup_report.add("imports", time.time() - startup_report.start)
 
 #thresholds to detect spills, hitrate peak and moving beam
 threshold_vars = {
     "integration_time": 0.05,
+    "framing" : "fixed",  # "adaptive": windows of window_hits hits, between window_min_time and window_max_time long
+    "window_hits" : 5000,
+    "window_min_time" : 0.05,
+    "window_max_time" : 1.0,
     "hitrate_peak" : 2.5,
     "coloumn_variance" : 100,
     "row_variance" : 500,
@@ -32,27 +54,57 @@ threshold_vars = {
     "beam_on" : 0.7,
     "beam_off" : 0.2,
     "start_analyse_hitrate_len" : 10,
-    "start_analyse_hitrate_sum" : 10000
+    "start_analyse_hitrate_sum" : 10000,
+    "baseline_estimator" : "window_median",
+    "baseline_window" : 72000,
+    "baseline_alpha" : 0.001,
+    "beam_detector" : "threshold",  # "cusum": change point detection of the beam on/off and the hitrate peaks
+    "cusum_threshold" : 5.,  # standard deviations
+    "cusum_drift" : 1.,
+    "cusum_memory" : 1000,  # windows of the level of a segment
+    "beamspot_estimator" : "median",
+    "beamspot_moved" : 1.0,
+    "beamspot_trim" : 10,
+    "beamspot_alpha" : 0.1,
+    "beamspot_min_hits" : 100,
+    "noisy_factor" : 20,  # a pixel with more than noisy_factor times the hits of its neighbours is masked
+    "noisy_min_hits" : 100,
+    "noisy_interval" : 1.0
     }
 
 #ports for zmq
 conf = {
+    "pybar_configuration":"/home/rasmus/git/pyBAR/pybar/configuration.yaml",
     "port_slow_control":5000,
-    "port_hit_map":5002,
+    "port_hit_map":5002,  # old monitors, only the zlib compressed pickle of the hit maps
+    "port_metrics":5003,
+    "port_streams":5004,  # hit maps in the formats of hist_transport, front end maps and the compact streams
+    "batch_analysis":True,
+    "fused_kernel":True,
+    "hit_map_format":"sparse",
+    "hit_map_codec":None,
+    "hit_map_delta":False,
+    "hit_map_raw":True,
+    "hit_map_interval":0.1,
+    "stream_intervals":{"projection":0.1, "binned_2":0.1, "binned_4":0.1, "centroid":0., "sliding":0.5, "decaying":0.5, "cumulative":1., "spill":1.},
+    "sliding_frames":20,  # windows of the sliding map
+    "decay_time":1.,  # seconds, time constant of the decaying map
+    "rate_series_dt":0.005,  # seconds, bin width of the high resolution hitrate series
+    "spectrum_segment":4096,  # bins of one segment of the spectrum of the hitrate series
+    "spectrum_segments":4,  # segments averaged in the spectrum
+    "analysis_queue_size":100,
+    "analysis_queue_policy":"coalesce",
+    "analysis_queue_coalesce":1000,  # readouts per front end of a coalesced item, then the oldest are dropped
+    "analysis_processes":0,  # processes of the batch analysis, only faster with more than ~50k words per call, see ParallelAnalysis
+    "front_end_processes":0,  # processes of the analysis of several front ends (0: analysed one after the other), see benchmark.py
+    "combined_interval":0.1,  # seconds of the stitched hit map and summary of all front ends
+    "metrics":True,
+    "mask_noisy_pixels":True,  # mask noisy pixels during the run, see pixel_mask
+    "record_file":None,  # e.g. "beam_monitor_%Y%m%d_%H%M%S.h5", formatted with the start time of the run
     }
 
-#global variables
-global_vars = {
-    "hits":[],
-    "baseline":[],
-    "coloumn":[],
-    "row":[],
-    "hist_occ": None,
-    "timestamp_start":[],
-    "hitrate":[],
-    "beam":True,
-    "analyse":True,
-    }
+#state of the beam analysis
+state = BeamState(threshold_vars)
 
 
 #run configuration for self trigger scan
@@ -79,296 +131,886 @@ tuning_conf = {
     "target_threshold": 54
     }
 
-context = zmq.Context()
-socket = context.socket(zmq.PAIR)
-socket.connect("tcp://127.0.0.1:%s" % conf["port_slow_control"])
-socket.setsockopt(zmq.IDENTITY, b'ELSA DAQ')
+# zmq sockets, created by setup_sockets() when the slow control starts,
+# until then the messages of the analysis core go to an Outbox
+socket = Outbox()
+socket2 = Outbox()
+socket3 = None
+socket4 = Outbox()
+# messages of the analysis worker thread, sent on socket by a timer of the event loop
+analysis_messages = MessageQueue(socket)
+
+# masked pixels, applied by the decoding before histograms and hitrate
+pixel_mask = PixelMask()
+# preallocated occupancy histogram of the fused decode kernel
+hit_histogram = HitHistogram(mask=pixel_mask)
+# multi-process batch analysis, see get_parallel_analysis()
+parallel_analysis = None
+# recorder of the per frame results, see start_recorder()
+recorder = None
+# noisy pixels found in the occupancy of the last threshold_vars["noisy_interval"] seconds
+noisy_pixels = NoisyPixelTracker(factor=threshold_vars["noisy_factor"], min_hits=threshold_vars["noisy_min_hits"], interval=threshold_vars["noisy_interval"])
+# moment based beam spot, used if threshold_vars["beamspot_estimator"] is "moments"
+beam_spot = MomentBeamSpot(trim=threshold_vars["beamspot_trim"], alpha=threshold_vars["beamspot_alpha"], min_hits=threshold_vars["beamspot_min_hits"])
+# per stage timing, published on the metrics socket
+metrics = Metrics(socket3, enabled=conf["metrics"])
+# encoder and publisher of the hit map frames
+hist_encoder = HistEncoder(codec=conf["hit_map_codec"], delta=conf["hit_map_delta"])
+hist_publisher = HistPublisher(socket2, hist_encoder, hist_format=conf["hit_map_format"], raw=conf["hit_map_raw"], metrics=metrics)
+# pickled hit maps for the old monitors on their own socket
+legacy_publisher = HistPublisher(socket4, hist_encoder, hist_format="pickle", raw=False, metrics=metrics)
+# hit maps are accumulated over conf["hit_map_interval"] seconds, independent of the integration time
+publish_scheduler = PublishScheduler(hist_publisher)
+publish_scheduler.add_stream("hit_map", hist_publisher.send, interval=conf["hit_map_interval"], topics=HIT_MAP_TOPICS)
+publish_scheduler.add_stream("legacy_hit_map", legacy_publisher.send, interval=conf["hit_map_interval"], publisher=legacy_publisher)
+# projections, binned maps and centroid for clients that subscribe to their topic
+stream_publisher = StreamPublisher(socket2)
+stream_publisher.add_streams(publish_scheduler, conf["stream_intervals"])
+# sliding, decaying and cumulative map (front end 0) for clients that subscribe to their topic
+accumulated_maps = AccumulatedMaps(socket2, hist_publisher, conf["stream_intervals"], n_frames=conf["sliding_frames"], tau=conf["decay_time"])
+# high resolution hitrate series and spill structure (front end 0) for clients that subscribe to their topic
+spill_monitor = SpillMonitor(socket2, hist_publisher, dt=conf["rate_series_dt"], nperseg=conf["spectrum_segment"], n_segments=conf["spectrum_segments"],
+                             interval=conf["stream_intervals"]["spill"])
+# publishers of the stream socket, see setup_front_ends()
+hist_publishers = [hist_publisher]
+# analysis state of each front end, front end 0 uses the objects above
+front_ends = [FrontEnd(0, state, hit_histogram, beam_spot, publish_scheduler, noisy_pixels)]
+# stitched hit map, summed hitrate and centroid with several front ends
+combined_view = None
+# process pool of the front ends, see get_module_pool()
+module_pool = None
+
+# pyBAR scans, imported by get_scan() on first use
+SCANS = {
+    "GdacTuning": "pybar.scans.tune_gdac",
+    "TdacTuning": "pybar.scans.tune_tdac",
+    "AnalogScan": "pybar.scans.scan_analog",
+    "DigitalScan": "pybar.scans.scan_digital",
+    "NoiseOccupancyTuning": "pybar.scans.tune_noise_occupancy",
+    "StuckPixelTuning": "pybar.scans.tune_stuck_pixel",
+    "Fei4SelfTriggerScan": "pybar.scans.scan_fei4_self_trigger",
+    "ExtTriggerScan": "pybar.scans.scan_ext_trigger",
+    }
+scans = {}
+# pyBAR RunManager, see get_runmngr()
+runmngr = None
+
+
+def setup_sockets():
+    global context, socket, context2, socket2, context3, socket3, context4, socket4
+    with startup_report.step("sockets"):
+        context = zmq.Context()
+        socket = context.socket(zmq.PAIR)
+        socket.connect("tcp://127.0.0.1:%s" % conf["port_slow_control"])
+        socket.setsockopt(zmq.IDENTITY, b'ELSA DAQ')
+
+        context2 = zmq.Context()
+        socket2 = context2.socket(zmq.XPUB)
+        socket2.bind("tcp://127.0.0.1:%s" % conf["port_streams"])
+
+        context3 = zmq.Context()
+        socket3 = context3.socket(zmq.PUB)
+        socket3.bind("tcp://127.0.0.1:%s" % conf["port_metrics"])
+
+        context4 = zmq.Context()
+        socket4 = context4.socket(zmq.XPUB)
+        socket4.bind("tcp://127.0.0.1:%s" % conf["port_hit_map"])
+    metrics.socket = socket3
+    legacy_publisher.socket = socket4
+    analysis_messages.socket = socket
+    for publisher in hist_publishers:
+        publisher.socket = socket2
+    stream_publisher.socket = socket2
+    accumulated_maps.socket = socket2
+    spill_monitor.socket = socket2
+    if combined_view is not None:
+        combined_view.socket = socket2
+
+
+def get_hist_publisher(topic, raw=None):
+    ''' Publisher of the hit maps of topic on the stream socket '''
+    publisher = HistPublisher(socket2, HistEncoder(codec=conf["hit_map_codec"], delta=conf["hit_map_delta"]), hist_format=conf["hit_map_format"],
+                              raw=conf["hit_map_raw"] if raw is None else raw, metrics=metrics, topic=topic, subscriptions=hist_publisher)
+    hist_publishers.append(publisher)
+    return publisher
+
+
+def setup_front_ends(n_front_ends):
+    ''' Analysis state of n_front_ends front ends, front end 0 keeps the state of the single front end analysis
+
+        Each front end publishes its hit maps on front_end_topic(index),
+        front end 0 also without topic and on the socket of the old
+        monitors. The stitched map of all front ends is always raw: its
+        pixel indices do not fit the sparse codec.
+    '''
+    global combined_view
+    del front_ends[1:]
+    del hist_publishers[1:]
+    publish_scheduler.streams.pop("front_end", None)
+    combined_view = None
+    front_ends[0].message_prefix = ""
+    if n_front_ends > 1:
+        front_ends[0].message_prefix = "FE0: "
+        publisher = get_hist_publisher(front_end_topic(0))
+        publish_scheduler.add_stream("front_end", publisher.send, interval=conf["hit_map_interval"], topics=(front_end_topic(0), ), subscribe_all=False)
+        for index in range(1, n_front_ends):
+            publisher = get_hist_publisher(front_end_topic(index))
+            scheduler = PublishScheduler(publisher)
+            scheduler.add_stream("hit_map", publisher.send, interval=conf["hit_map_interval"], topics=(front_end_topic(index), ), subscribe_all=False)
+            fe_beam_spot = MomentBeamSpot(trim=threshold_vars["beamspot_trim"], alpha=threshold_vars["beamspot_alpha"], min_hits=threshold_vars["beamspot_min_hits"])
+            fe_noisy_pixels = NoisyPixelTracker(factor=threshold_vars["noisy_factor"], min_hits=threshold_vars["noisy_min_hits"], interval=threshold_vars["noisy_interval"])
+            front_ends.append(FrontEnd(index, BeamState(threshold_vars), HitHistogram(), fe_beam_spot, scheduler, fe_noisy_pixels, "FE%d: " % index))
+        combined_view = CombinedView(n_front_ends, get_hist_publisher(COMBINED_TOPIC, raw=True), socket2, interval=conf["combined_interval"])
+    logging.info("Analysis of %d front end(s)", n_front_ends)
+
+
+def get_scan(name):
+    ''' pyBAR scan class, imported on first use '''
+    if name not in scans:
+        with startup_report.step("import %s" % name):
+            scans[name] = getattr(importlib.import_module(SCANS[name]), name)
+    return scans[name]
+
 
-context2 = zmq.Context()
-socket2 = context2.socket(zmq.PUB)
-socket2.bind("tcp://127.0.0.1:%s" % conf["port_hit_map"])
+def get_runmngr():
+    ''' pyBAR RunManager, created on first use '''
+    global runmngr
+    if runmngr is None:
+        with startup_report.step("RunManager"):
+            from pybar.run_manager import RunManager
+            runmngr = RunManager(conf["pybar_configuration"])
+    return runmngr
 
-# get notified if TTi are not working
-try:
-    from power_supply import power_off, power_on, voltage_channel1, voltage_channel2
-except (SystemExit,):
-    raise
-except Exception:
-    logging.error("Failed to connect to TTi", exc_info=True)
-    socket.send("Failed to connect to TTi")
-   
-runmngr = RunManager("/home/rasmus/git/pyBAR/pybar/configuration.yaml")
+
+def get_current_run():
+    if runmngr is not None:
+        return runmngr.current_run
+
+
+def is_data_taking():
+    ''' True during a self or external trigger run, and without RunManager (analysis core used by other tools) '''
+    if runmngr is None:
+        return True
+    run = runmngr.current_run
+    return run is not None and (run.run_id == "fei4_self_trigger_scan" or run.run_id == "ext_trigger_scan")
+
+
+def set_write_interval(interval):
+    from pybar.daq import fifo_readout
+    fifo_readout.WRITE_INTERVAL = interval
+
+
+def get_startup_report():
+    summary = startup_report.summary()
+    power_supply = get_power_supply()
+    if power_supply.connect_time is not None:
+        summary += "\npower supply connect: %.3f s" % power_supply.connect_time
+    return summary
+
+
+# slow control event loop, see slow_control()
+loop = EventLoop()
+run_watcher = RunWatcher(get_current_run)
+# running chain of scans (init, tune, fix), see start_chain()
+scan_chain = None
+# handler of the answer to a prompt (framerate, publishrate, threshold)
+pending_input = None
 
 
 def get_status():
-    if runmngr.current_run:
-        return runmngr.current_run.get_run_status()
+    run = get_current_run()
+    if run:
+        return run.get_run_status()
 
-     
-def add_done_message():
-    if runmngr.current_run:
-        socket.send("Scan finished: %s" % runmngr.current_run.run_id)
 
 def del_var():
-    del global_vars["hits"][:]
-    del global_vars["coloumn"][:]
-    del global_vars["row"][:]
-    del global_vars["timestamp_start"][:]
-    del global_vars["hitrate"][:]
-    del global_vars["baseline"][:]
-    global_vars["hist_occ"] = None
+    for fe in front_ends:
+        fe.reset()
+    if combined_view is not None:
+        combined_view.reset()
+    accumulated_maps.reset()
+    spill_monitor.reset()
         
         
-def slow_control():
-# should alwayz run no blocking    
-    while True:  
-        msg = socket.recv()
-        
-        if get_status() != "RUNNING" and msg == "init":
-            try:
-                socket.send("start initializing")
-                power_on()
-                socket.send_string("voltage channel 1 = %s " % voltage_channel1())
-                socket.send_string("voltage channel 2 = %s " % voltage_channel2())
-                runmngr.run_run(run=DigitalScan,)
-            except (SystemExit,):
-                raise
-            except Exception:
-                logging.error("Failed to initialize", exc_info=True)
-                socket.send("Failed to initialize")
-            add_done_message()
-                
-        if get_status() != "RUNNING" and msg == "startself":
-            fifo_readout.WRITE_INTERVAL = 0.05
-            Fei4SelfTriggerScan.run_conf = run_conf_self
-            Fei4SelfTriggerScan.handle_data = handle_data
-            runmngr.run_run(run=Fei4SelfTriggerScan, run_conf=run_conf_self, use_thread=True)
-            time.sleep(1)
-            socket.send("%s" % runmngr.current_run.run_id)
-            socket.send(get_status())
+def is_busy():
+    return get_status() == "RUNNING" or (scan_chain is not None and scan_chain.active)
+
+
+def send_voltages():
+    # cached readings of the power_supply thread, no serial I/O
+    power_supply = get_power_supply()
+    if power_supply.error is not None:
+        socket.send("TTi error: %s" % power_supply.error)
+    for channel in (1, 2):
+        voltage, timestamp = power_supply.reading(channel)
+        if timestamp is None:
+            socket.send_string("voltage channel %d = %s" % (channel, voltage))
+        else:
+            socket.send_string("voltage channel %d = %s (%.1f s ago)" % (channel, voltage, time.time() - timestamp))
+
+
+def on_power(error):
+    ''' Called by power_supply.dispatch() if a poweron/poweroff sequence is done '''
+    if error is not None:
+        socket.send("Failed to switch TTi: %s" % error)
+    else:
+        send_voltages()
+
+
+def on_init_power(chain, error):
+    if error is not None:
+        chain.cancel()
+        socket.send("Failed to initialize")
+    elif chain.active:  # not stopped while switching on
+        send_voltages()
+        chain.start()
+
+
+def send_status():
+    send_voltages()
+    status = get_status()
+    if status == None:
+        socket.send("Status=None")
+    else:
+        socket.send(runmngr.current_run.run_id)
+        socket.send(status)
+        if (runmngr.current_run.run_id == "fei4_self_trigger_scan" or runmngr.current_run.run_id == "ext_trigger_scan") and get_status() == "RUNNING":
+            socket.send("hitrate: %.0f [Hz]" % state.hitrate.last())
+            if len(front_ends) > 1:
+                socket.send("hitrate all front ends: %.0f [Hz] (%s)" % (sum(fe.state.hitrate.last() for fe in front_ends),
+                                                                         ", ".join("%.0f" % fe.state.hitrate.last() for fe in front_ends)))
+            if len(state.coloumn) > 0:
+                socket.send("Beamspot: %s pixels" % [int(state.coloumn.last()), int(state.row.last())])
+            if threshold_vars["beamspot_estimator"] == "moments" and beam_spot.beam_spot is not None:
+                socket.send("Beamspot: %.2f mm, %.2f mm, width %.2f mm x %.2f mm, tilt %.2f rad" % beam_spot.beam_spot[1:])
+            socket.send(spill_monitor.summary())
+            if pixel_mask.n_masked:
+                socket.send("masked pixels: %d" % pixel_mask.n_masked)
+            if conf["hit_map_format"] == "sparse":
+                socket.send(hist_encoder.summary())
+            socket.send(analysis_queue.summary())
+
+
+def start_chain(steps, start=True):
+    ''' Run the scans of steps (message, scan, run_conf) one after the other, see ScanChain '''
+    global scan_chain
+    scan_chain = ScanChain(get_runmngr(), socket.send, steps)
+    if start:
+        scan_chain.start()
+
+
+def cancel_chain():
+    if scan_chain is not None and scan_chain.active:
+        scan_chain.cancel()
+        socket.send("%s Run Stopped" % (scan_chain.run.run_id if scan_chain.run is not None else "init"))
+        return True
+    return False
+
+
+def on_run_state(run_id, status):
+    ''' Called by the run_watcher if the current run or its status changes '''
+    if scan_chain is not None:
+        scan_chain.on_run_state(run_id, status)
+    if run_id == "fei4_self_trigger_scan" and status is not None:
+        socket.send("%s" % run_id)
+        socket.send(status)
+
+
+def prompt(messages, callback):
+    ''' Send messages, the next message received is passed to callback '''
+    global pending_input
+    for message in messages:
+        socket.send(message)
+    pending_input = callback
+
+
+def set_framerate(msg):
+    try:
+        threshold_vars["integration_time"] = 1 / float(msg)
+        socket.send("new framerate:%1.1f" % float(1/ threshold_vars["integration_time"]))
+    except:
+        socket.send("invalid input")
+
+
+def set_framing(msg):
+    if msg in ("fixed", "adaptive"):
+        threshold_vars["framing"] = msg
+        socket.send("new framing:%s" % msg)
+    else:
+        socket.send("invalid input")
+
+
+def set_detector(msg):
+    if msg in ("threshold", "cusum"):
+        threshold_vars["beam_detector"] = msg
+        for fe in front_ends:
+            fe.state.detector = create_detector(threshold_vars, fe.state.baseline)
+        socket.send("new beam detector:%s" % msg)
+    else:
+        socket.send("invalid input")
+
+
+def set_window_hits(msg):
+    try:
+        threshold_vars["window_hits"] = int(msg)
+        socket.send("new window hits:%d" % threshold_vars["window_hits"])
+    except:
+        socket.send("invalid input")
+
+
+def set_window_time(msg):
+    try:
+        min_time, max_time = [float(value) for value in msg.split(",")]
+        if min_time > max_time:
+            raise ValueError("min time > max time")
+        threshold_vars["window_min_time"], threshold_vars["window_max_time"] = min_time, max_time
+        check_window_times()
+        socket.send("new window time:%1.2f-%1.2f s" % (threshold_vars["window_min_time"], threshold_vars["window_max_time"]))
+    except:
+        socket.send("invalid input")
+
+
+def set_publishrate(msg):
+    try:
+        rate = float(msg)
+        conf["hit_map_interval"] = 1 / rate if rate else 0.
+        for fe in front_ends:
+            fe.publish_scheduler.set_interval(conf["hit_map_interval"], "hit_map")
+        publish_scheduler.set_interval(conf["hit_map_interval"], "front_end")
+        publish_scheduler.set_interval(conf["hit_map_interval"], "legacy_hit_map")
+        socket.send("new publishrate:%s" % msg)
+    except:
+        socket.send("invalid input")
+
+
+def set_threshold(msg):
+    try:
+        tuning_conf["target_threshold"] = int(msg)
+        socket.send("new threshold:%s" % int(msg))
+        socket.send("press 'Tune' to tune")
+    except:
+        socket.send("invalid input")
+
+
+def get_mask_files(filename):
+    ''' Mask file of each front end: filename is formatted with the index if it has a %d, otherwise it is the file of front end 0 '''
+    if "%d" in filename:
+        return [(fe, filename % fe.index) for fe in front_ends]
+    return [(front_ends[0], filename)]
+
+
+def save_mask(msg):
+    try:
+        for fe, filename in get_mask_files(msg):
+            fe.pixel_mask.save(filename)
+            socket.send("%ssaved %d masked pixels to %s" % (fe.message_prefix, fe.pixel_mask.n_masked, filename))
+    except:
+        socket.send("invalid input")
+
+
+def load_mask(msg):
+    try:
+        for fe, filename in get_mask_files(msg):
+            fe.pixel_mask.load(filename)
+            socket.send("%sloaded %d masked pixels from %s" % (fe.message_prefix, fe.pixel_mask.n_masked, filename))
+    except:
+        socket.send("invalid input")
+
+
+def send_mask():
+    for fe in front_ends:
+        pixels = fe.pixel_mask.pixels()
+        socket.send("%smasked pixels: %d %s" % (fe.message_prefix, pixels.shape[0], pixels[:10].tolist()))
+
+
+def on_message(socket):
+    global pending_input
+    msg = socket.recv()
+    if pending_input is not None:
+        callback, pending_input = pending_input, None
+        callback(msg)
+    else:
+        handle_command(msg)
+
+
+def handle_command(msg):
+    # runs in the event loop, must not block
+    if not is_busy() and msg == "init":
+        socket.send("start initializing")
+        # the DigitalScan is started by on_init_power once the TTi is on
+        start_chain([(None, get_scan("DigitalScan"), None)], start=False)
+        get_power_supply().power_on(lambda error, chain=scan_chain: on_init_power(chain, error))
             
-        if get_status() == "RUNNING" and msg == "stop":
+    if not is_busy() and msg == "startself":
+        set_write_interval(0.05)
+        Fei4SelfTriggerScan = get_scan("Fei4SelfTriggerScan")
+        Fei4SelfTriggerScan.run_conf = run_conf_self
+        Fei4SelfTriggerScan.handle_data = handle_data
+        metrics.reset()
+        start_recorder()
+        analysis_queue.start()
+        # run id and status are sent by on_run_state once the run is started
+        get_runmngr().run_run(run=Fei4SelfTriggerScan, run_conf=run_conf_self, use_thread=True)
+        
+    if msg == "STOP":
+        cancel_chain()
+
+    if msg == "stop" and not cancel_chain() and get_status() == "RUNNING":
+        runmngr.cancel_current_run(msg)
+        set_write_interval(1)
+        analysis_queue.stop()
+        stop_recorder()
+        del_var()
+        socket.send("%s Run Stopped" % runmngr.current_run.run_id)
+
+    if msg == "exit":
+        if not cancel_chain() and get_status() == "RUNNING":
             runmngr.cancel_current_run(msg)
-            fifo_readout.WRITE_INTERVAL = 1
-            del_var()
             socket.send("%s Run Stopped" % runmngr.current_run.run_id)
-    
-        if msg == "exit":
-            if get_status() == "RUNNING":
-                runmngr.cancel_current_run(msg)
-                socket.send("%s Run Stopped" % runmngr.current_run.run_id)
-            logging.info("Program terminates")
-            socket.send("Program terminates")
-            break
-            
-        if get_status() != "RUNNING" and msg == "tune":
-            socket.send("Start GdacTuning")
-            runmngr.run_run(GdacTuning, run_conf=tuning_conf, use_thread=True)
-            while True:
-                time.sleep(1)
-                try:
-                    msg = socket.recv(flags=zmq.NOBLOCK)
-                except zmq.Again: 
-                    pass
-                if get_status() == "FINISHED" and runmngr.current_run.run_id != "tdac_tuning":
-                    add_done_message()
-                    socket.send("Start TdacTuning")
-                    runmngr.run_run(TdacTuning, run_conf=tuning_conf, use_thread=True)   
-                if msg == "STOP":
-                    runmngr.cancel_current_run(msg)
-                    socket.send("%s Run Stopped" % runmngr.current_run.run_id)
-                    break
-                if msg == "status":
-                    socket.send_string("voltage channel 1 = %s" % voltage_channel1())
-                    socket.send_string("voltage channel 2 = %s" % voltage_channel2())   
-                    status = get_status()
-                    socket.send(runmngr.current_run.run_id)
-                    msg = None
-                    if status == None:
-                        socket.send("Status=None")
-                    else:
-                        socket.send(status) 
-                if get_status() == "FINISHED" and runmngr.current_run.run_id == "tdac_tuning":
-                    add_done_message()
-                    break
-
-        if get_status() != "RUNNING" and msg == "startanalog":
-            socket.send("Start Analog Scan")
-            runmngr.run_run(AnalogScan, use_thread=True)
-   
-        if get_status() != "RUNNING" and msg == "startdigital":
-            socket.send("Start Digital Scan")
-            runmngr.run_run(DigitalScan, use_thread=True)
+        analysis_queue.stop()
+        stop_recorder()
+        if parallel_analysis is not None:
+            parallel_analysis.close()
+        if module_pool is not None:
+            module_pool.close()
+        logging.info("Program terminates")
+        socket.send("Program terminates")
+        loop.stop()
+        
+    if not is_busy() and msg == "tune":
+        start_chain([("Start GdacTuning", get_scan("GdacTuning"), tuning_conf), ("Start TdacTuning", get_scan("TdacTuning"), tuning_conf)])
+
+    if not is_busy() and msg == "startanalog":
+        socket.send("Start Analog Scan")
+        get_runmngr().run_run(get_scan("AnalogScan"), use_thread=True)
+
+    if not is_busy() and msg == "startdigital":
+        socket.send("Start Digital Scan")
+        get_runmngr().run_run(get_scan("DigitalScan"), use_thread=True)
+        
+    if msg == "poweron":
+        get_power_supply().power_on(on_power)
+         
+    if msg == "poweroff":
+        get_power_supply().power_off(on_power)
+
+    if msg == "status":
+        send_status()
             
-        if msg == "poweron":
-            power_on()
-            socket.send_string("voltage channel 1 = %s " % voltage_channel1())
-            socket.send_string("voltage channel 2 = %s " % voltage_channel2()) 
-             
-        if msg == "poweroff":
-            power_off()
-            socket.send_string("voltage channel 1 = %s " % voltage_channel1())
-            socket.send_string("voltage channel 2 = %s " % voltage_channel2()) 
-    
-        if msg == "status":
-            socket.send_string("voltage channel 1 = %s" % voltage_channel1())
-            socket.send_string("voltage channel 2 = %s" % voltage_channel2())   
-            status = get_status()
-            if status == None:
-                socket.send("Status=None")
-            else:
-                socket.send(runmngr.current_run.run_id)
-                socket.send(status)
-                if (runmngr.current_run.run_id == "fei4_self_trigger_scan" or runmngr.current_run.run_id == "ext_trigger_scan") and get_status() == "RUNNING":    
-                    socket.send("hitrate: %.0f [Hz]" % global_vars["hitrate"][-1])
-                    if len(global_vars["coloumn"]) > 0:
-                        socket.send("Beamspot: %s pixels" % [int(global_vars["coloumn"][-1]), int(global_vars["row"][-1])])
-                
-        if get_status() != "RUNNING" and msg == "fix":
-            socket.send("starting Noise Occupancy Tuning (~2min)")
-            runmngr.run_run(NoiseOccupancyTuning, use_thread=True)
-            while True:
-                time.sleep(1)
-                try:
-                    msg = socket.recv(flags=zmq.NOBLOCK)
-                except zmq.Again: 
-                    pass
-                if get_status() == "FINISHED" and runmngr.current_run.run_id != "stuck_pixel_tuning":
-                    add_done_message()
-                    socket.send("starting StuckPixelTuning")
-                    runmngr.run_run(StuckPixelTuning, use_thread=True)
-                if msg == "STOP":
-                    runmngr.cancel_current_run(msg)
-                    socket.send("%s Run Stopped" % runmngr.current_run.run_id)
-                    break
-                if msg == "status":
-                    socket.send_string("voltage channel 1 = %s" % voltage_channel1())
-                    socket.send_string("voltage channel 2 = %s" % voltage_channel2())   
-                    status = get_status()
-                    socket.send(runmngr.current_run.run_id)
-                    msg = None
-                    if status == None:
-                        socket.send("Status=None")
-                    else:
-                        socket.send(status) 
-                if get_status() == "FINISHED" and runmngr.current_run.run_id == "stuck_pixel_tuning":
-                    add_done_message()
-                    break
-                    
-        if msg == "framerate":
-            socket.send("old framerate:%1.1f" % float(1/ threshold_vars["integration_time"]))
-            socket.send("input new framerate:")
-            msg = socket.recv()
-            try:
-                global_vars["integration_time"] = 1 / float(msg)
-                socket.send("new framerate:%1.1f" % float(1/ threshold_vars["integration_time"]))
-            except:
-                socket.send("invalid input")
-                
-        if msg == "threshold":
-            socket.send("old threshold:%s" % tuning_conf["target_threshold"])
-            socket.send("input new threshold:")
-            msg = socket.recv()
-            try:
-                tuning_conf["target_threshold"] = int(msg)
-                socket.send("new threshold:%s" % int(msg))
-                socket.send("press 'Tune' to tune")          
-            except:
-                socket.send("invalid input")
+    if not is_busy() and msg == "fix":
+        start_chain([("starting Noise Occupancy Tuning (~2min)", get_scan("NoiseOccupancyTuning"), None),
+                     ("starting StuckPixelTuning", get_scan("StuckPixelTuning"), None)])
                 
-        if msg == "analyse":
-            if global_vars["analyse"]:
-                global_vars["analyse"] = False
-            else:
-                global_vars["analyse"] = True
+    if msg == "framerate":
+        prompt(["old framerate:%1.1f" % float(1/ threshold_vars["integration_time"]), "input new framerate:"], set_framerate)
+            
+    if msg == "framing":
+        prompt(["old framing:%s (%d hits, %1.2f-%1.2f s)" % (threshold_vars["framing"], threshold_vars["window_hits"], threshold_vars["window_min_time"], threshold_vars["window_max_time"]),
+                "input new framing (fixed, adaptive):"], set_framing)
+
+    if msg == "detector":
+        prompt(["old beam detector:%s" % threshold_vars["beam_detector"], "input new beam detector (threshold, cusum):"], set_detector)
+
+    if msg == "windowhits":
+        prompt(["old window hits:%d" % threshold_vars["window_hits"], "input new window hits:"], set_window_hits)
+
+    if msg == "windowtime":
+        prompt(["old window time:%1.2f-%1.2f s" % (threshold_vars["window_min_time"], threshold_vars["window_max_time"]), "input new window time (min,max):"], set_window_time)
+
+    if msg == "publishrate":
+        prompt(["old publishrate:%s" % ("%1.1f" % (1 / conf["hit_map_interval"]) if conf["hit_map_interval"] else "every frame"),
+                "input new publishrate (0 for every frame):"], set_publishrate)
+
+    if msg == "publish":
+        for fe in front_ends:
+            fe.publish_scheduler.request()
+
+    if msg == "threshold":
+        prompt(["old threshold:%s" % tuning_conf["target_threshold"], "input new threshold:"], set_threshold)
+            
+    if msg == "analyse":
+        analyse = not state.analyse
+        for fe in front_ends:
+            fe.state.analyse = analyse
+
+    if msg == "startup":
+        socket.send(get_startup_report())
 
-        if get_status() != "RUNNING" and msg == "startexternal":
-            fifo_readout.WRITE_INTERVAL = 0.05
-            ExtTriggerScan.run_conf=run_conf_ext
-            ExtTriggerScan.handle_data=handle_data
-            runmngr.run_run(run=ExtTriggerScan,run_conf=run_conf_ext, use_thread=True)
+    if msg == "spill":
+        socket.send(spill_monitor.summary())
+
+    if msg == "mask":
+        send_mask()
+
+    if msg == "clearmask":
+        for fe in front_ends:
+            fe.pixel_mask.clear()
+        send_mask()
+
+    if msg == "savemask":
+        prompt(["input mask file (%d for the index of the front end):"], save_mask)
+
+    if msg == "loadmask":
+        prompt(["input mask file (%d for the index of the front end):"], load_mask)
+
+    if msg == "metrics":
+        socket.send(metrics.summary() if metrics.enabled else "metrics off")
+
+    if msg in ("metrics on", "metrics off"):
+        metrics.enabled = msg == "metrics on"
+        metrics.reset()
+        socket.send(msg)
+
+    if not is_busy() and msg == "startexternal":
+        set_write_interval(0.05)
+        ExtTriggerScan = get_scan("ExtTriggerScan")
+        ExtTriggerScan.run_conf=run_conf_ext
+        ExtTriggerScan.handle_data=handle_data
+        metrics.reset()
+        start_recorder()
+        analysis_queue.start()
+        get_runmngr().run_run(run=ExtTriggerScan,run_conf=run_conf_ext, use_thread=True)
+
+
+def slow_control():
+    # event loop: commands, run state changes of the RunManager and timers, nothing blocks
+    start_pools()
+    setup_sockets()
+    loop.add_socket(socket, on_message)
+    run_watcher.add_callback(on_run_state)
+    run_watcher.start(loop)
+    # the power supply opens the TTi in its own thread, switches it off and starts polling
+    loop.call_every(0.05, get_power_supply().dispatch)
+    # the analysis runs in the worker thread of analysis_queue, its messages are sent here
+    loop.call_every(0.05, analysis_messages.dispatch)
+    logging.info(startup_report.summary())
+    loop.run()
 
         
-def analyse_beam(beam):
-    if len(global_vars["hitrate"]) > threshold_vars["start_analyse_hitrate_len"] and sum(global_vars["hitrate"]) > threshold_vars["start_analyse_hitrate_sum"]:                     
-        if global_vars["hitrate"][-1] > np.median(global_vars["hitrate"]) * threshold_vars["beam_on"]:
-            global_vars["baseline"].append(np.median(global_vars["hitrate"]))
-            b = np.mean(global_vars["baseline"])
-            if beam == False:
-                beam = True
-                socket.send("beam: on")
-            # detect hitrate burst if its over threshold_vars["hitrate_peak"]   
-            if global_vars["hitrate"][-1] > threshold_vars["hitrate_peak"] * b:
-                socket.send("Time: %s" % datetime.datetime.now().time())  
-                socket.send("hitrate peak: %.0f [Hz]" % global_vars["hitrate"][-1])  
-        if  global_vars["hitrate"][-1] < np.median(global_vars["hitrate"]) * threshold_vars["beam_off"]:
-            if beam == True:
-                beam = False
-                socket.send("beam: off")
+def analyse_beam(beam, fe=None):
+    fe = front_ends[0] if fe is None else fe
+    state, beam_spot = fe.state, fe.beam_spot
+
+    def send(msg):
+        analysis_messages.send(fe.message_prefix + msg)
+
+    baseline = state.baseline
+    hitrate = state.hitrate.last()
+    if baseline.n > threshold_vars["start_analyse_hitrate_len"] and baseline.sum > threshold_vars["start_analyse_hitrate_sum"]:
+        beam, events = state.detector.detect(beam)
+        state.events |= events
+        if events & EVENT_BEAM_ON:
+            send("beam: on")
+        if events & EVENT_HITRATE_PEAK:
+            send("Time: %s" % datetime.datetime.now().time())
+            send("hitrate peak: %.0f [Hz]" % hitrate)
+        if events & EVENT_BEAM_OFF:
+            send("beam: off")
             # detect moving beamspot
-        if beam:
+        if beam and threshold_vars["beamspot_estimator"] == "moments":
+            # distance of the window centroid to the reference centroid in mm
+            if beam_spot.distance() > threshold_vars["beamspot_moved"]:
+                state.events |= EVENT_BEAM_MOVED
+                send("Time: %s" % datetime.datetime.now().time())
+                send("Beam moved")
+                send("Beamspot moved %0.2f mm" % beam_spot.distance())
+                beam_spot.reset_reference()
+        elif beam:
             #Variance limit for row, coloumn
-            if np.var(global_vars["coloumn"]) > threshold_vars["coloumn_variance"] or np.var(global_vars["row"]) > threshold_vars["row_variance"]:
+            coloumn, row = state.coloumn.view(), state.row.view()
+            if np.var(coloumn) > threshold_vars["coloumn_variance"] or np.var(row) > threshold_vars["row_variance"]:
+                state.events |= EVENT_BEAM_MOVED
                 try:
-                    socket.send("Time: %s" % datetime.datetime.now().time())
-                    socket.send("Beam moved")
-                    socket.send("Beamspot moved %0.2f mm" % np.sqrt(((global_vars["coloumn"][-1] - np.median(global_vars["coloumn"]))*0.25) ** 2 + ((global_vars["row"][-1] - np.median(global_vars["row"]))*0.05) ** 2))
-                    del global_vars["coloumn"][:]
-                    del global_vars["row"][:]
+                    send("Time: %s" % datetime.datetime.now().time())
+                    send("Beam moved")
+                    send("Beamspot moved %0.2f mm" % np.sqrt(((coloumn[-1] - np.median(coloumn))*0.25) ** 2 + ((row[-1] - np.median(row))*0.05) ** 2))
+                    state.reset_beamspot()
                 except:
                     pass
     return beam
 
 
-def is_record(value):
-    return np.logical_and(is_data_record(value), is_fe_word(value))
+def check_window_times():
+    if threshold_vars["integration_time"] < 0.05:
+        threshold_vars["integration_time"] = 0.05
+    if threshold_vars["window_min_time"] < 0.05:
+        threshold_vars["window_min_time"] = 0.05
+    if threshold_vars["window_max_time"] < threshold_vars["window_min_time"]:
+        threshold_vars["window_max_time"] = threshold_vars["window_min_time"]
+
+
+def get_window_stops(state, raw_data, starts, stops, timestamp_start, timestamp_stop, mask=None):
+    ''' Index of each readout that closes a window of state, see BeamState.window_due
+
+        With adaptive framing the hits are counted without the masked
+        records, as in the window of the loop path.
+    '''
+    if threshold_vars["framing"] == "adaptive":
+        hits = batch_analysis.count_records(raw_data, starts, stops, mask)
+        return batch_analysis.get_adaptive_window_stops(timestamp_start, timestamp_stop, hits, state.window_start, state.window_hits, threshold_vars["window_hits"],
+                                                        threshold_vars["window_min_time"], threshold_vars["window_max_time"])
+    return batch_analysis.get_window_stops(timestamp_start, timestamp_stop, state.window_start, threshold_vars["integration_time"])
+
 
 #@profile
 def analyse(data_array):
-    global global_vars
-    
-    if threshold_vars["integration_time"] < 0.05:
-        threshold_vars["integration_time"] = 0.05
-    for ro in data_array[0]:
+    check_window_times()
+    for fe, readouts in zip(front_ends, data_array):
+        analyse_front_end(fe, readouts)
+
+
+def analyse_front_end(fe, readouts):
+    state, hit_histogram = fe.state, fe.hit_histogram
+    m = metrics if metrics.enabled else None
+    medians = threshold_vars["beamspot_estimator"] != "moments"  # the moments are calculated from hist_occ
+    readout_records = []  # of the spill monitor
+    for ro in readouts:
         raw_data = ro[0]
-        data_record = ru.convert_data_array(raw_data, filter_func=is_record)   
-        global_vars["timestamp_start"].append(ro[1])
-        timestamp_stop = ro[2]                            
-        global_vars["hits"].append(len(data_record))
-                                                      
-        if np.any(data_record):
-            col, row = get_col_row_array_from_data_record_array(data_record)
-             
-            global_vars["coloumn"].append(np.median(col))
-            global_vars["row"].append(np.median(row)) 
-                                
-            if not np.any(global_vars["hist_occ"]):
-                global_vars["hist_occ"] = fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
+        timestamp_stop = ro[2]
+
+        if conf["fused_kernel"]:
+            if m:
+                start = time.time()
+            n_records, col, row, _ = hit_histogram.add(raw_data)
+            if m:
+                m.add("fused_kernel", start)
+            state.add_readout(ro[1], n_records)
+            if n_records:
+                if medians:
+                    state.add_beamspot(np.median(col), np.median(row))
+                state.hist_occ = hit_histogram.hist_occ
+        else:
+            if m:
+                start = time.time()
+            data_record = ru.convert_data_array(raw_data, filter_func=is_record)
+            if m:
+                m.add("filter", start)
+            n_records = len(data_record)
+            masked = fe.pixel_mask.n_masked and n_records
+            if masked:
+                if m:
+                    start = time.time()
+                col, row, _, record_index = batch_analysis.get_hits(data_record)
+                keep, dropped = batch_analysis.mask_hits(fe.pixel_mask.lookup, col, row, record_index, n_records)
+                col, row = col[keep], row[keep]
+                n_records -= int(np.count_nonzero(dropped))
+                if m:
+                    m.add("decode", start)
+            state.add_readout(ro[1], n_records)
+
+            if np.any(data_record) and (not masked or col.shape[0]):
+                if not masked:
+                    if m:
+                        start = time.time()
+                    col, row = get_col_row_array_from_data_record_array(data_record)
+                    if m:
+                        m.add("decode", start)
+
+                if medians:
+                    state.add_beamspot(np.median(col), np.median(row))
+
+                if m:
+                    start = time.time()
+                if not np.any(state.hist_occ):
+                    state.hist_occ = fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
+                else:
+                    state.hist_occ += fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
+                if m:
+                    m.add("histogram", start)
+        readout_records.append(n_records)
+        if m:
+            m.count("readouts")
+            m.count("hits", n_records)
+
+        if state.window_due(timestamp_stop):
+            close_window(timestamp_stop, fe)
+    if fe.index == 0 and readout_records:
+        spill_monitor.add([ro[1] for ro in readouts], [ro[2] for ro in readouts], readout_records)
+
+
+def analyse_batch(data_array):
+    ''' Same as analyse() but all readouts are analysed at once with vectorized functions
+
+        With conf["fused_kernel"] the histograms are filled by the fused
+        kernel (hit_kernel.analyse_readouts), readout by readout.
+
+        With several front ends and conf["front_end_processes"] the front
+        ends are analysed in a process pool, the windows are closed in this
+        thread.
+
+        Stages of the metrics: concatenate (readouts and window stops),
+        batch_analysis (all of analyse_readouts) and, without process pool,
+        its sub-steps (decode, medians and histogram, or fused_kernel and
+        medians). The windows are timed in close_window.
+    '''
+    check_window_times()
+    m = metrics if metrics.enabled else None
+    if m:
+        start = time.time()
+    tasks = []  # front end, timestamps and arguments of analyse_readouts
+    for fe, readouts in zip(front_ends, data_array):
+        if not len(readouts):
+            continue
+        raw_data, starts, stops, timestamp_start, timestamp_stop = batch_analysis.concatenate_readouts(readouts)
+        mask = fe.pixel_mask.get_lookup()
+        window_stops = get_window_stops(fe.state, raw_data, starts, stops, timestamp_start, timestamp_stop, mask)
+        tasks.append((fe, timestamp_start, timestamp_stop, (raw_data, starts, stops, window_stops, mask)))
+    if not tasks:
+        return
+    if m:
+        m.add("concatenate", start)
+        start = time.time()
+    if len(tasks) > 1 and conf["front_end_processes"]:
+        results = get_module_pool().analyse([task[3] for task in tasks])
+    elif conf["analysis_processes"]:
+        results = [get_parallel_analysis().analyse_readouts(*task[3]) for task in tasks]
+    else:
+        analyse_readouts = hit_kernel.analyse_readouts if conf["fused_kernel"] else batch_analysis.analyse_readouts
+        results = [analyse_readouts(*task[3], metrics=m) for task in tasks]
+    if m:
+        m.add("batch_analysis", start)
+        m.count("readouts", sum(task[1].shape[0] for task in tasks))
+        m.count("hits", sum(int(result[0].sum()) for result in results))
+
+    for (fe, timestamp_start, timestamp_stop, (_, _, _, window_stops, _)), result in zip(tasks, results):
+        add_windows(fe, timestamp_start, timestamp_stop, window_stops, result)
+        if fe.index == 0:
+            spill_monitor.add(timestamp_start, timestamp_stop, result[0])
+
+
+def add_windows(fe, timestamp_start, timestamp_stop, window_stops, result):
+    ''' Add the readouts of fe analysed by analyse_readouts to its windows '''
+    state = fe.state
+    hits, coloumn, row, has_record, hists = result
+    first = 0
+    for i, last in enumerate(window_stops + [timestamp_start.shape[0] - 1]):
+        if first > last:  # last readout closed a window
+            break
+        window = slice(first, last + 1)
+        state.add_readout(timestamp_start[first], int(hits[window].sum()))
+        state.coloumn.extend(coloumn[window][has_record[window]])
+        state.row.extend(row[window][has_record[window]])
+        if hists[i] is not None:
+            if not np.any(state.hist_occ):
+                state.hist_occ = hists[i]
             else:
-                global_vars["hist_occ"] += fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
-        
-        if timestamp_stop - global_vars["timestamp_start"][0] > threshold_vars["integration_time"]:
-            global_vars["hitrate"].append(np.sum(global_vars["hits"]) / (timestamp_stop - global_vars["timestamp_start"][0]))
-            
-            if (runmngr.current_run.run_id == "fei4_self_trigger_scan" or runmngr.current_run.run_id == "ext_trigger_scan") and global_vars["analyse"]:
-                global_vars["beam"] = analyse_beam(global_vars["beam"])
-            
-            p_hist = pickle.dumps(global_vars["hist_occ"], -1)
-            zlib_hist = zlib.compress(p_hist)              
-            socket2.send(zlib_hist)
-            # free memory of global variables
-            del global_vars["hits"][:]
-            del global_vars["timestamp_start"][:]
-            global_vars["hist_occ"] = None
-            #single variance gets diminished for long mesurements, this resets the variables after some time
-            #diminishing the number leads to more sensitivity
-            if len(global_vars["coloumn"])>threshold_vars["reset_coloumn_row_arrays"]:
-                    del global_vars["coloumn"][:]
-                    del global_vars["row"][:]
-            
+                state.hist_occ += hists[i]
+        if i < len(window_stops):
+            close_window(timestamp_stop[last], fe)
+        first = last + 1
+
+
+def get_parallel_analysis():
+    ''' Process pool of the batch analysis, created on first use with conf["analysis_processes"] workers '''
+    global parallel_analysis
+    if parallel_analysis is None or parallel_analysis.n_workers != conf["analysis_processes"] or parallel_analysis.fused != conf["fused_kernel"]:
+        if parallel_analysis is not None:
+            parallel_analysis.close()
+        parallel_analysis = ParallelAnalysis(conf["analysis_processes"], fused=conf["fused_kernel"])
+    return parallel_analysis
+
+
+def get_module_pool():
+    ''' Process pool of the front ends, created on first use with conf["front_end_processes"] workers '''
+    global module_pool
+    if module_pool is None or module_pool.n_workers != conf["front_end_processes"] or module_pool.fused != conf["fused_kernel"]:
+        if module_pool is not None:
+            module_pool.close()
+        module_pool = ModulePool(conf["front_end_processes"], fused=conf["fused_kernel"])
+    return module_pool
+
+
+def start_pools():
+    ''' Fork the configured process pools while this process has no sockets and threads yet '''
+    if conf["analysis_processes"]:
+        get_parallel_analysis()
+    if conf["front_end_processes"]:
+        get_module_pool()
+
+
+def start_recorder():
+    ''' Record the per frame results into conf["record_file"] if set '''
+    global recorder
+    stop_recorder()
+    if conf["record_file"]:
+        recorder = Recorder(time.strftime(conf["record_file"]))
+
+
+def stop_recorder():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+def close_window(timestamp_stop, fe=None):
+    if metrics.enabled:
+        close_start = time.time()
+    fe = front_ends[0] if fe is None else fe
+    state, hit_histogram, beam_spot, publish_scheduler = fe.state, fe.hit_histogram, fe.beam_spot, fe.publish_scheduler
+    record = recorder is not None and fe.index == 0  # the recorder has the windows of front end 0
+    hist_occ = state.hist_occ
+    window_length = state.close_window(timestamp_stop)
+    if record:  # beam spot before analyse_beam resets it
+        coloumn, row = state.coloumn.view(), state.row.view()
+        beamspot = (np.median(coloumn), np.median(row), np.var(coloumn), np.var(row)) if len(coloumn) else (np.nan, ) * 4
+    if threshold_vars["beamspot_estimator"] == "moments":
+        beam_spot.add(hist_occ)
+
+    if is_data_taking() and state.analyse:
+        if metrics.enabled:
+            start = time.time()
+        state.beam = analyse_beam(state.beam, fe)
+        if metrics.enabled:
+            metrics.add("analyse_beam", start)
+
+    if record:
+        recorder.add(timestamp_stop - window_length, timestamp_stop, state.hitrate.last(), *(beamspot + (state.beam, state.events)))
+
+    if conf["mask_noisy_pixels"]:
+        noisy = fe.noisy_pixels.add(hist_occ, timestamp_stop - window_length, timestamp_stop)
+        if noisy is not None and noisy.shape[0]:
+            fe.pixel_mask.add(noisy)
+            analysis_messages.send("%smasked %d noisy pixel(s): %s" % (fe.message_prefix, noisy.shape[0], noisy[:10].tolist()))
+    if fe.index == 0:  # copies the hit pixels before hist_occ is sent or reset
+        if metrics.enabled:
+            start = time.time()
+        accumulated_maps.add(hist_occ, timestamp_stop - window_length, timestamp_stop)
+        if metrics.enabled:
+            metrics.add("accumulated_maps", start)
+    if combined_view is not None:  # copies hist_occ before it is sent or reset
+        combined_view.add(fe.index, hist_occ, timestamp_stop - window_length, timestamp_stop, state.hitrate.last())
+    if publish_scheduler.add(hist_occ, timestamp_stop - window_length, timestamp_stop):
+        hit_histogram.detach()
+    else:
+        hit_histogram.reset()
+    #single variance gets diminished for long mesurements, this resets the variables after some time
+    #diminishing the number leads to more sensitivity
+    if len(state.coloumn)>threshold_vars["reset_coloumn_row_arrays"]:
+        state.reset_beamspot()
+    if metrics.enabled:
+        metrics.add("close_window", close_start)
+        metrics.count("frames")
+        metrics.publish()
+
+
+def analyse_data(data_array):
+    # one list of readouts per front end
+    if len(data_array) != len(front_ends):
+        setup_front_ends(len(data_array))
+    if conf["batch_analysis"]:
+        analyse_batch(data_array)
+    else:
+        analyse(data_array)
+
+
+# analysis runs in its own worker thread, the readout thread only queues the data
+analysis_queue = AnalysisQueue(analyse_data, maxsize=conf["analysis_queue_size"], policy=conf["analysis_queue_policy"],
+                               max_coalesce=conf["analysis_queue_coalesce"])
+
 
 def handle_data(self, data, new_file=False, flush=True):
-    analyse(data)
+    analysis_queue.put(data)
     
 
 if __name__ == "__main__":
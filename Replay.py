@@ -5,67 +5,127 @@
 '''
 
 import time
+import threading
+from Queue import Queue, Full
 
+import numpy as np
 import tables as tb
 
 
 class Replay(object):
+    ''' Replays the readouts of a raw data file
 
-    def __init__(self):
+        The meta data columns are read once, the raw data in chunks of
+        many readouts (up to chunk_size words, at least one readout). The
+        raw data of a readout is a view into its chunk. With prefetch the
+        next chunk is read by a background thread while the current one
+        is replayed.
+    '''
+
+    def __init__(self, chunk_size=1 << 22, prefetch=True):
         self.delay = 0.
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+
+    def get_data(self, data_file, real_time=True, speed=1.):
+        ''' Yield [raw data, timestamp start, timestamp stop, error] of each readout
 
-    def get_data(self, data_file):
+            real_time: keep the time between readouts, divided by speed
+                       (speed=2. replays twice as fast), otherwise replay
+                       as fast as possible
+        '''
         self.data_file = data_file
+        start_time = None
         for data in self._get_data():
-            time.sleep(self.delay)
+            if real_time:
+                if start_time is None:  # Initialize on first readout
+                    start_time, first_timestamp = time.time(), data[1]
+                # Wait if send too fast, especially needed when readout was
+                # stopped during data taking (e.g. for mask shifting)
+                additional_delay = start_time + (data[1] - first_timestamp) / speed - time.time()
+                if additional_delay > 0:
+                    time.sleep(additional_delay)
+            if self.delay:
+                time.sleep(self.delay)
             yield data
 
-    def _get_data(self):
-        ''' Yield data of one readout
-
-            Delay return if replay is too fast
-        '''
-        with tb.open_file(self.data_file, mode="r") as in_file_h5:
-            meta_data = in_file_h5.root.meta_data[:]
-            raw_data = in_file_h5.root.raw_data
-            n_readouts = meta_data.shape[0]
-
-            self.last_readout_time = time.time()
-
-            for i in range(n_readouts):
-                # Raw data indeces of readout
-                i_start = meta_data['index_start'][i]
-                i_stop = meta_data['index_stop'][i]
-
-                # Time stamps of readout
-                t_stop = meta_data[i]['timestamp_stop']
-                t_start = meta_data[i]['timestamp_start']
+    def _get_chunks(self, in_file_h5):
+        ''' Yield (raw data chunk, index start, index stop, timestamp start, timestamp stop, error) of many readouts '''
+        meta_data = in_file_h5.root.meta_data[:]
+        raw_data = in_file_h5.root.raw_data
+        index_start = meta_data['index_start'].astype(np.int64)
+        index_stop = meta_data['index_stop'].astype(np.int64)
+        timestamp_start = meta_data['timestamp_start'].astype(np.float64)
+        timestamp_stop = meta_data['timestamp_stop'].astype(np.float64)
+        error = meta_data['error'].astype(np.int64)
+        n_readouts = meta_data.shape[0]
+
+        first = 0
+        while first < n_readouts:
+            # last readout that fits into the chunk, at least one
+            last = max(np.searchsorted(index_stop, index_start[first] + self.chunk_size, side='right'), first + 1)
+            chunk_start = index_start[first]
+            chunk = raw_data[chunk_start:index_stop[last - 1]]
+            yield (chunk, index_start[first:last] - chunk_start, index_stop[first:last] - chunk_start,
+                   timestamp_start[first:last], timestamp_stop[first:last], error[first:last])
+            first = last
+
+    def _put(self, queue, item, stop):
+        ''' Put item into the queue, returns False if replay was stopped '''
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _prefetch_chunks(self, queue, stop):
+        try:
+            with tb.open_file(self.data_file, mode="r") as in_file_h5:
+                for chunk in self._get_chunks(in_file_h5):
+                    if not self._put(queue, chunk, stop):
+                        return
+        except Exception as e:
+            self._put(queue, e, stop)
+            return
+        self._put(queue, None, stop)
+
+    def _iter_chunks(self):
+        if not self.prefetch:
+            with tb.open_file(self.data_file, mode="r") as in_file_h5:
+                for chunk in self._get_chunks(in_file_h5):
+                    yield chunk
+            return
+        # double buffering: one chunk is replayed while the next one is read
+        queue = Queue(maxsize=1)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._prefetch_chunks, args=(queue, stop), name="ReplayPrefetch")
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                chunk = queue.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+            reader.join()
 
+    def _get_data(self):
+        ''' Yield data of one readout '''
+        for chunk, starts, stops, timestamp_start, timestamp_stop, error in self._iter_chunks():
+            for i in range(starts.shape[0]):
                 # Create data of readout (raw data + meta data)
-                data = []
-                data.append(raw_data[i_start:i_stop])
-                data.extend((float(t_start),
-                             float(t_stop),
-                             int(meta_data[i]['error'])))
-
-                # Determine replay delays
-                if i == 0:  # Initialize on first readout
-                    self.last_timestamp_start = t_start
-                now = time.time()
-                delay = now - self.last_readout_time
-                additional_delay = t_start - self.last_timestamp_start - delay
-                if additional_delay > 0:
-                    # Wait if send too fast, especially needed when readout was
-                    # stopped during data taking (e.g. for mask shifting)
-                    time.sleep(additional_delay)
-                self.last_readout_time = time.time()
-                self.last_timestamp_start = t_start
+                yield [chunk[starts[i]:stops[i]],
+                       float(timestamp_start[i]),
+                       float(timestamp_stop[i]),
+                       int(error[i])]
 
-                yield data
 
-    def __del__(self):
-        self.in_file_h5.close()
-        
 if __name__ == "__main__":
     rep = Replay()
     for ro in rep.get_data(r"/home/rasmus/git/pyBAR/pybar/data2/module_0/6_module_0_noise_occupancy_tuning.h5"):
@@ -6,16 +6,28 @@ from matplotlib import pyplot as plt
 import numpy as np
 from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 from tqdm import tqdm
-import zlib
-import cPickle as pickle
 from Replay import Replay  
 from basil.utils.BitLogic import BitLogic
 from pybar_fei4_interpreter.data_interpreter import PyDataInterpreter
 from pybar_fei4_interpreter.data_histograming import PyDataHistograming
+from hit_kernel import HitHistogram
+from hist_codec import HistEncoder
+from hist_transport import HistPublisher, HIT_MAP_TOPICS
+from publish_scheduler import PublishScheduler
+from hist_streams import StreamPublisher
+from hist_accumulators import AccumulatedMaps
+from spill_structure import SpillMonitor
+from beam_state import BeamState, RingBuffer, EVENT_BEAM_ON, EVENT_BEAM_OFF, EVENT_HITRATE_PEAK, EVENT_BEAM_MOVED
+from beam_recorder import Recorder
+from beam_spot import MomentBeamSpot
 
 #thresholds to detect spills, hitrate peak and moving beam
 threshold_vars = {
     "integration_time": 0.1,
+    "framing" : "fixed",  # "adaptive": windows of window_hits hits, between window_min_time and window_max_time long
+    "window_hits" : 5000,
+    "window_min_time" : 0.05,
+    "window_max_time" : 1.0,
     "hitrate_peak" : 2.5,
     "coloumn_variance" : 100,
     "row_variance" : 500,
@@ -23,40 +35,89 @@ threshold_vars = {
     "beam_on" : 0.7,
     "beam_off" : 0.2,
     "start_analyse_hitrate_len" : 10,
-    "start_analyse_hitrate_sum" : 10000
+    "start_analyse_hitrate_sum" : 10000,
+    "baseline_estimator" : "window_median",
+    "baseline_window" : 72000,
+    "baseline_alpha" : 0.001,
+    "beam_detector" : "threshold",  # "cusum": change point detection of the beam on/off and the hitrate peaks
+    "cusum_threshold" : 5.,  # standard deviations
+    "cusum_drift" : 1.,
+    "cusum_memory" : 1000,  # windows of the level of a segment
+    "beamspot_estimator" : "median",
+    "beamspot_moved" : 1.0,
+    "beamspot_trim" : 10,
+    "beamspot_alpha" : 0.1,
+    "beamspot_min_hits" : 100
     }
 
 #ports for zmq
 conf = {
     "port_slow_control":5000,
-    "port_hit_map":5002,
+    "port_hit_map":5002,  # old monitors, only the zlib compressed pickle of the hit maps
+    "port_streams":5004,  # hit maps in the formats of hist_transport and the compact streams
+    "fused_kernel":True,
+    "hit_map_format":"sparse",
+    "hit_map_codec":None,
+    "hit_map_delta":False,
+    "hit_map_raw":True,
+    "hit_map_interval":0.1,
+    "stream_intervals":{"projection":0.1, "binned_2":0.1, "binned_4":0.1, "centroid":0., "sliding":0.5, "decaying":0.5, "cumulative":1., "spill":1.},
+    "sliding_frames":20,  # windows of the sliding map
+    "decay_time":1.,  # seconds, time constant of the decaying map
+    "rate_series_dt":0.005,  # seconds, bin width of the high resolution hitrate series
+    "spectrum_segment":4096,  # bins of one segment of the spectrum of the hitrate series
+    "record_file":None,
     }
 
-# global variables
-global_vars = {
-    "hits":[],
-    "baseline":[],
-    "coloumn":[],
-    "row":[],
-    "hist_occ": None,
-    "timestamp_start":[],
-    "hitrate":[],
-    "beam":True,
-    "time":[],
-    "c":[],
-    "r":[],
-    "analyse":True,
-    "beamspot":[],
-    "tot":[]
-    }
+
+class ReplayState(BeamState):
+    ''' BeamState with the time series of the whole replay for plotting '''
+    __slots__ = ("time", "c", "r")
+
+    def __init__(self, threshold_vars, capacity=10 ** 6):
+        self.time = RingBuffer(capacity)
+        self.c = RingBuffer(capacity)
+        self.r = RingBuffer(capacity)
+        super(ReplayState, self).__init__(threshold_vars, hitrate_capacity=capacity)
+
+    def reset(self):
+        super(ReplayState, self).reset()
+        self.time.clear()
+        self.c.clear()
+        self.r.clear()
+
+
+state = ReplayState(threshold_vars)
+beam_spot = MomentBeamSpot(trim=threshold_vars["beamspot_trim"], alpha=threshold_vars["beamspot_alpha"], min_hits=threshold_vars["beamspot_min_hits"])
 
 context = zmq.Context()
 socket = context.socket(zmq.PAIR)
 socket.connect("tcp://127.0.0.1:%s" % conf["port_slow_control"])
 
 context2 = zmq.Context()
-socket2 = context2.socket(zmq.PUB)
-socket2.bind("tcp://127.0.0.1:%s" % conf["port_hit_map"])
+socket2 = context2.socket(zmq.XPUB)
+socket2.bind("tcp://127.0.0.1:%s" % conf["port_streams"])
+
+context4 = zmq.Context()
+socket4 = context4.socket(zmq.XPUB)
+socket4.bind("tcp://127.0.0.1:%s" % conf["port_hit_map"])
+
+hit_histogram = HitHistogram()
+hist_encoder = HistEncoder(codec=conf["hit_map_codec"], delta=conf["hit_map_delta"])
+hist_publisher = HistPublisher(socket2, hist_encoder, hist_format=conf["hit_map_format"], raw=conf["hit_map_raw"])
+publish_scheduler = PublishScheduler(hist_publisher)
+publish_scheduler.add_stream("hit_map", hist_publisher.send, interval=conf["hit_map_interval"], topics=HIT_MAP_TOPICS)
+# pickled hit maps for the old monitors on their own socket
+legacy_publisher = HistPublisher(socket4, hist_encoder, hist_format="pickle", raw=False)
+publish_scheduler.add_stream("legacy_hit_map", legacy_publisher.send, interval=conf["hit_map_interval"], publisher=legacy_publisher)
+# projections, binned maps and centroid for clients that subscribe to their topic
+stream_publisher = StreamPublisher(socket2)
+stream_publisher.add_streams(publish_scheduler, conf["stream_intervals"])
+# sliding, decaying and cumulative map for clients that subscribe to their topic
+accumulated_maps = AccumulatedMaps(socket2, hist_publisher, conf["stream_intervals"], n_frames=conf["sliding_frames"], tau=conf["decay_time"])
+# hitrate series of the readouts and its spectrum averaged over the whole replay
+spill_monitor = SpillMonitor(socket2, hist_publisher, dt=conf["rate_series_dt"], nperseg=conf["spectrum_segment"], n_segments=None,
+                             interval=conf["stream_intervals"]["spill"])
 
 def is_record(value):
     return np.logical_and(is_data_record(value), is_fe_word(value))
@@ -64,87 +125,102 @@ def is_record(value):
 
 #@profile
 def analyse():
-    global global_vars
-    
     if threshold_vars["integration_time"] < 0.05:
         threshold_vars["integration_time"] = 0.05
+    if threshold_vars["window_min_time"] < 0.05:
+        threshold_vars["window_min_time"] = 0.05
 
 
  
+    recorder = Recorder(conf["record_file"]) if conf["record_file"] else None
     rep = Replay() 
     for i, ro in enumerate(tqdm(rep.get_data(r"/home/rasmus/Documents/Rasmus/110_mimosa_telescope_testbeam_14122016_fei4_self_trigger_scan.h5", real_time=True))):
     
         raw_data = ro[0]
         
-        data_record = ru.convert_data_array(raw_data, filter_func=is_record)
+        if conf["fused_kernel"]:
+            n_records, col, row, _ = hit_histogram.add(raw_data)
+        else:
+            data_record = ru.convert_data_array(raw_data, filter_func=is_record)
+            n_records = len(data_record)
 #         if np.any(is_trigger_word(data_record)):
 #             raise
         
         #dr = is_data_record(raw_data)
  
-        global_vars["timestamp_start"].append(ro[1])
+        state.add_readout(ro[1], n_records)
+        spill_monitor.add([ro[1]], [ro[2]], [n_records])
         timestamp_stop = ro[2]
-        global_vars["hits"].append(len(data_record))
          
 #        print "{0:b}".format(ro[0][0]), FEI4Record(ro[0][0], chip_flavor="fei4b"), is_data_record(ro[0][0])
         
-        if np.any(data_record):
-            col, row = get_col_row_array_from_data_record_array(data_record)
-            global_vars["coloumn"].append(np.median(col))
-            global_vars["row"].append(np.median(row))               
-            if not np.any(global_vars["hist_occ"]):
-                global_vars["hist_occ"] = fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
-            #    global_vars["hist_occ"] = fast_analysis_utils.hist_2d_index(np.mean(col), np.mean(row), shape=(81, 337))
+        if n_records:
+            if not conf["fused_kernel"]:
+                col, row = get_col_row_array_from_data_record_array(data_record)
+            state.add_beamspot(np.median(col), np.median(row))
+            if conf["fused_kernel"]:
+                state.hist_occ = hit_histogram.hist_occ
+            elif not np.any(state.hist_occ):
+                state.hist_occ = fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
+            #    state.hist_occ = fast_analysis_utils.hist_2d_index(np.mean(col), np.mean(row), shape=(81, 337))
             else:
-                global_vars["hist_occ"] += fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
-            #   global_vars["hist_occ"] += fast_analysis_utils.hist_2d_index(np.mean(col), np.mean(row), shape=(81, 337))
-             
-            if len(global_vars["time"]) == 0:
-                global_vars["time"].append(0)
-
-            if timestamp_stop - global_vars["timestamp_start"][0] > threshold_vars["integration_time"]:
-                global_vars["time"].append(global_vars["time"][-1] + timestamp_stop - global_vars["timestamp_start"][0])
-                global_vars["c"].append(np.var(global_vars["coloumn"]))
-                global_vars["r"].append(np.var(global_vars["row"]))
-                global_vars["hitrate"].append(np.sum(global_vars["hits"]) / (timestamp_stop - global_vars["timestamp_start"][0]))
-                if global_vars["analyse"]:
-                    global_vars["beam"] = analyse_beam(global_vars["beam"])
+                state.hist_occ += fast_analysis_utils.hist_2d_index(col, row, shape=(81, 337))
+            #   state.hist_occ += fast_analysis_utils.hist_2d_index(np.mean(col), np.mean(row), shape=(81, 337))
+
+            if state.window_due(timestamp_stop):
+                state.c.append(np.var(state.coloumn.view()))
+                state.r.append(np.var(state.row.view()))
+                if recorder is not None:
+                    beamspot = (np.median(state.coloumn.view()), np.median(state.row.view()), state.c.last(), state.r.last())
+                hist_occ = state.hist_occ
+                if threshold_vars["beamspot_estimator"] == "moments":
+                    beam_spot.add(hist_occ)
+                window_length = state.close_window(timestamp_stop)
+                state.time.append((state.time.last() if len(state.time) else 0) + window_length)
+                if state.analyse:
+                    state.beam = analyse_beam(state.beam)
+                if recorder is not None:
+                    recorder.add(timestamp_stop - window_length, timestamp_stop, state.hitrate.last(), *(beamspot + (state.beam, state.events)))
                  
-                p_hist = pickle.dumps(global_vars["hist_occ"], -1)
-                zlib_hist = zlib.compress(p_hist)
-                socket2.send(zlib_hist)
-    #             # free memory of global variables
-                del global_vars["hits"][:]
-                del global_vars["timestamp_start"][:]
-                global_vars["hist_occ"] = None
-                if len(global_vars["coloumn"])>threshold_vars["reset_coloumn_row_arrays"]:
-                    del global_vars["coloumn"][:]
-                    del global_vars["row"][:]
+                accumulated_maps.add(hist_occ, timestamp_stop - window_length, timestamp_stop)
+                if publish_scheduler.add(hist_occ, timestamp_stop - window_length, timestamp_stop):
+                    hit_histogram.detach()
+                else:
+                    hit_histogram.reset()
+                if len(state.coloumn)>threshold_vars["reset_coloumn_row_arrays"]:
+                    state.reset_beamspot()
+    if recorder is not None:
+        recorder.close()
 
 def analyse_beam(beam):
-    if len(global_vars["hitrate"]) > threshold_vars["start_analyse_hitrate_len"] and sum(global_vars["hitrate"]) > threshold_vars["start_analyse_hitrate_sum"]:                     
-        if global_vars["hitrate"][-1] > np.median(global_vars["hitrate"]) * threshold_vars["beam_on"]:
-            global_vars["baseline"].append(np.median(global_vars["hitrate"]))
-            b = np.mean(global_vars["baseline"])
-            if beam == False:
-                beam = True
-                socket.send("beam: on")
-            # detect hitrate burst if its over threshold_vars["hitrate_peak"]   
-            if global_vars["hitrate"][-1] > threshold_vars["hitrate_peak"] * b:
-                socket.send("hitrate peak: %.0f [Hz]" % global_vars["hitrate"][-1])  
-        if  global_vars["hitrate"][-1] < np.median(global_vars["hitrate"]) * threshold_vars["beam_off"]:
-            if beam == True:
-                beam = False
-                socket.send("beam: off")
+    baseline = state.baseline
+    hitrate = state.hitrate.last()
+    if baseline.n > threshold_vars["start_analyse_hitrate_len"] and baseline.sum > threshold_vars["start_analyse_hitrate_sum"]:
+        beam, events = state.detector.detect(beam)
+        state.events |= events
+        if events & EVENT_BEAM_ON:
+            socket.send("beam: on")
+        if events & EVENT_HITRATE_PEAK:
+            socket.send("hitrate peak: %.0f [Hz]" % hitrate)
+        if events & EVENT_BEAM_OFF:
+            socket.send("beam: off")
             # detect moving beamspot
-        if beam:
+        if beam and threshold_vars["beamspot_estimator"] == "moments":
+            # distance of the window centroid to the reference centroid in mm
+            if beam_spot.distance() > threshold_vars["beamspot_moved"]:
+                state.events |= EVENT_BEAM_MOVED
+                socket.send("Beam moved")
+                socket.send("Beamspot moved %0.2f mm" % beam_spot.distance())
+                beam_spot.reset_reference()
+        elif beam:
             #Variance limit for row, coloumn
-            if np.var(global_vars["coloumn"]) > threshold_vars["coloumn_variance"] or np.var(global_vars["row"]) > threshold_vars["row_variance"]:
+            coloumn, row = state.coloumn.view(), state.row.view()
+            if np.var(coloumn) > threshold_vars["coloumn_variance"] or np.var(row) > threshold_vars["row_variance"]:
+                state.events |= EVENT_BEAM_MOVED
                 try:
                     socket.send("Beam moved")
-                    socket.send("Beamspot moved %0.2f mm" % np.sqrt(((global_vars["coloumn"][-1] - np.median(global_vars["coloumn"]))*0.25) ** 2 + ((global_vars["row"][-1] - np.median(global_vars["row"]))*0.05) ** 2))
-                    del global_vars["coloumn"][:]
-                    del global_vars["row"][:]
+                    socket.send("Beamspot moved %0.2f mm" % np.sqrt(((coloumn[-1] - np.median(coloumn))*0.25) ** 2 + ((row[-1] - np.median(row))*0.05) ** 2))
+                    state.reset_beamspot()
                 except:
                     pass
     return beam
@@ -155,36 +231,35 @@ if __name__ == "__main__":
     analyse()
 
     # Plot Data
-    global_vars["time"].remove(0)
 #     plt.subplot(3,1,1)
-    plt.plot(global_vars["time"],global_vars["hitrate"])
+    plt.plot(state.time.view(), state.hitrate.view())
     plt.xlabel("Zeit [s]")
     plt.ylabel("Trefferrate [Hz]")
-#     plt.hlines(np.mean(global_vars["baseline"]),xmin=0,xmax=523, colors='k', linestyles='solid', label='baseline')
-#     plt.hlines(np.mean(global_vars["baseline"])*0.7,xmin=0,xmax=523, colors='r', linestyles='solid', label='baseline')
-#     plt.hlines(np.mean(global_vars["baseline"])*0.2,xmin=0,xmax=523, colors='g', linestyles='solid', label='baseline')
+#     plt.hlines(state.baseline.mean_baseline(),xmin=0,xmax=523, colors='k', linestyles='solid', label='baseline')
+#     plt.hlines(state.baseline.mean_baseline()*0.7,xmin=0,xmax=523, colors='r', linestyles='solid', label='baseline')
+#     plt.hlines(state.baseline.mean_baseline()*0.2,xmin=0,xmax=523, colors='g', linestyles='solid', label='baseline')
 #     plt.title("baselines")
 
 #     plt.subplot(2,1,1)
-#     plt.hist(global_vars["c"],bins=100)
+#     plt.hist(state.c.view(),bins=100)
 #     plt.ylabel("Anzahl Ereignisse")
 #     plt.xlabel("Zeilen Varianz")
 #     plt.subplot(2,1,2)
-#     plt.hist(global_vars["r"],bins=100)
+#     plt.hist(state.r.view(),bins=100)
 #     plt.ylabel("Anzahl Ereignisse")
 #     plt.xlabel("Reihen Varianz")
       
 #     plt.subplot(2,1,1)
-#     plt.plot(global_vars["time"],global_vars["c"])
+#     plt.plot(state.time.view(),state.c.view())
 #     plt.ylabel("Zeilen median")
 #     plt.xlabel("Zeit [s]")
 #     plt.subplot(2,1,2)
-#     plt.plot(global_vars["time"],global_vars["r"])
+#     plt.plot(state.time.view(),state.r.view())
 #     plt.ylabel("Reihen median")
 #     plt.xlabel("Zeit [s]")
       
       
-#     plt.hist(global_vars["hitrate"],bins=100)
+#     plt.hist(state.hitrate.view(),bins=100)
 #     plt.xlabel("Trefferrate [Hz]")
 #     plt.ylabel("Anzahl Ereignisse")
       
@@ -199,13 +274,13 @@ if __name__ == "__main__":
   
     # Plot Contour Plot of Data
 #     fig, ax = plt.subplots()
-#     CS = ax.contour(global_vars["hist_occ"])
+#     CS = ax.contour(state.hist_occ)
 #     ax.grid(linewidth=0.5)
 #     plt.xlabel("Spalte")
 #     plt.ylabel("Reihe")
 #     #plt.colorbar(CS)
 # #    
-#     plt.imshow(global_vars["hist_occ"], aspect="auto")
+#     plt.imshow(state.hist_occ, aspect="auto")
 #     plt.xlabel("Spalte")
 #     plt.ylabel("Reihe")
 #     cbar=plt.colorbar()
@@ -222,4 +297,11 @@ if __name__ == "__main__":
     # plt.axhline(y,linewidth=1, color='r')
 #     plt.axis([-80, 2200,np.min(0), np.max(1000)])
 
+    print hist_encoder.summary()
+    print spill_monitor.summary()
+    if spill_monitor.spectrum.n_averaged():
+        plt.figure()
+        plt.semilogy(spill_monitor.spectrum.frequencies[1:], spill_monitor.spectrum.get()[1:])
+        plt.xlabel("Frequenz [Hz]")
+        plt.ylabel("Leistungsdichte [Hz^2/Hz]")
     plt.show()
@@ -0,0 +1,113 @@
+''' Bounded work queue between the pyBAR readout thread and the online analysis.
+
+    handle_data only puts the readouts into the queue, a dedicated worker
+    thread analyses them. If the worker falls behind and the queue is full
+    the overflow policy decides:
+        "block":       wait until there is space (readout thread stalls)
+        "drop_oldest": drop the oldest queued readouts
+        "coalesce":    append the readouts to the newest queued item, up to
+                       max_coalesce readouts per front end, then drop the
+                       oldest queued readouts as with "drop_oldest"
+
+    Each item has one list of readouts per front end, as the data of handle_data.
+'''
+import logging
+import threading
+import time
+from collections import deque
+
+POLICIES = ("block", "drop_oldest", "coalesce")
+
+
+class AnalysisQueue(object):
+
+    def __init__(self, analyse, maxsize=100, policy="coalesce", max_coalesce=1000):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy %s" % policy)
+        self.analyse = analyse
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_coalesce = max_coalesce
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.n_readouts = 0
+        self.n_dropped = 0
+        self.n_coalesced = 0
+        self.max_depth = 0
+        self.lag = 0.
+        self.max_lag = 0.
+
+    def put(self, data):
+        ''' Queue the readouts of one handle_data call '''
+        readouts = [list(fe_readouts) for fe_readouts in data]
+        n_readouts = sum(len(fe_readouts) for fe_readouts in readouts)
+        with self._cond:
+            while self.policy == "block" and len(self._items) >= self.maxsize and not self._stop:
+                self._cond.wait(0.1)
+            full = len(self._items) >= self.maxsize
+            if full and self.policy == "coalesce" and self._can_coalesce(readouts):
+                for queued, fe_readouts in zip(self._items[-1][1], readouts):
+                    queued.extend(fe_readouts)
+                self.n_coalesced += n_readouts
+                self.n_readouts += n_readouts
+                return
+            if full and self.policy in ("drop_oldest", "coalesce"):
+                self.n_dropped += sum(len(fe_readouts) for fe_readouts in self._items.popleft()[1])
+            self._items.append((time.time(), readouts))
+            self.n_readouts += n_readouts
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._cond.notify_all()
+
+    def _can_coalesce(self, readouts):
+        ''' True if readouts fit into the newest queued item (same front ends, at most max_coalesce readouts each) '''
+        queued = self._items[-1][1]
+        return len(queued) == len(readouts) and all(len(a) + len(b) <= self.max_coalesce for a, b in zip(queued, readouts))
+
+    def depth(self):
+        return len(self._items)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._items.clear()
+        self.reset_counters()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="AnalysisWorker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, drain=False):
+        ''' Stop the worker, queued readouts are analysed first if drain is set, otherwise discarded '''
+        with self._cond:
+            if not drain:
+                self._items.clear()
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._stop:
+                    self._cond.wait(0.1)
+                if not self._items:
+                    return
+                enqueued, readouts = self._items.popleft()
+                self._cond.notify_all()
+            self.lag = time.time() - enqueued
+            self.max_lag = max(self.max_lag, self.lag)
+            try:
+                self.analyse(readouts)
+            except Exception:
+                logging.error("Analysis of %d readouts failed", sum(len(fe_readouts) for fe_readouts in readouts), exc_info=True)
+
+    def summary(self):
+        return "analysis queue: depth %d/%d (max %d), dropped %d, coalesced %d of %d readouts, lag %.1f ms (max %.1f ms)" % (
+            len(self._items), self.maxsize, self.max_depth, self.n_dropped, self.n_coalesced, self.n_readouts, self.lag * 1e3, self.max_lag * 1e3)
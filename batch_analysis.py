@@ -0,0 +1,185 @@
+''' Vectorized analysis of all readouts of one handle_data call.
+
+    The readouts are concatenated into one raw data array with start/stop
+    offsets. Hit counts, per readout column/row medians and the occupancy
+    histogram are then calculated with a few passes over the whole array
+    instead of one pass per readout.
+'''
+import time
+
+import numpy as np
+from pybar.daq.readout_utils import is_data_record, is_fe_word
+
+# FE-I4 data record layout (see pybar.daq.readout_utils)
+COL_MASK, COL_SHIFT = 0x00FE0000, 17
+ROW_MASK, ROW_SHIFT = 0x0001FF00, 8
+TOT1_MASK, TOT1_SHIFT = 0x000000F0, 4
+TOT2_MASK = 0x0000000F
+MAX_TOT = 14  # ToT codes >= 14 are no hits
+HIST_SHAPE = (81, 337)
+
+
+def is_record(value):
+    return np.logical_and(is_data_record(value), is_fe_word(value))
+
+
+def concatenate_readouts(readouts):
+    ''' Concatenate the raw data of a list of readouts (raw_data, timestamp_start, timestamp_stop, ...)
+
+        Returns the raw data, the start/stop index of each readout and the timestamps.
+    '''
+    n_readouts = len(readouts)
+    lengths = np.fromiter((len(ro[0]) for ro in readouts), dtype=np.int64, count=n_readouts)
+    stops = np.cumsum(lengths)
+    starts = stops - lengths
+    if n_readouts:
+        raw_data = np.concatenate([ro[0] for ro in readouts])
+    else:
+        raw_data = np.empty(0, dtype=np.uint32)
+    timestamp_start = np.fromiter((ro[1] for ro in readouts), dtype=np.float64, count=n_readouts)
+    timestamp_stop = np.fromiter((ro[2] for ro in readouts), dtype=np.float64, count=n_readouts)
+    return raw_data, starts, stops, timestamp_start, timestamp_stop
+
+
+def get_window_stops(timestamp_start, timestamp_stop, window_start, integration_time):
+    ''' Index of each readout that closes an integration window
+
+        window_start is the start time of the already open window or None.
+        Only scalars are compared here, the windows depend on each other.
+    '''
+    window_stops = []
+    for i, t_stop in enumerate(timestamp_stop.tolist()):
+        if window_start is None:
+            window_start = timestamp_start[i]
+        if t_stop - window_start > integration_time:
+            window_stops.append(i)
+            window_start = None
+    return window_stops
+
+
+def get_adaptive_window_stops(timestamp_start, timestamp_stop, hits, window_start, window_hits, target_hits, min_time, max_time):
+    ''' Index of each readout that closes an adaptive window (see BeamState.window_due)
+
+        window_start and window_hits belong to the already open window,
+        window_start is None if there is none.
+    '''
+    window_stops = []
+    for i, (t_stop, n_hits) in enumerate(zip(timestamp_stop.tolist(), hits.tolist())):
+        if window_start is None:
+            window_start = timestamp_start[i]
+            window_hits = 0
+        window_hits += n_hits
+        window_length = t_stop - window_start
+        if window_length > max_time or (window_hits >= target_hits and window_length >= min_time):
+            window_stops.append(i)
+            window_start = None
+    return window_stops
+
+
+def count_records(raw_data, starts, stops, mask=None):
+    ''' Number of data records of each readout, with mask as in analyse_readouts (see mask_hits) '''
+    is_rec = is_record(raw_data)
+    n_records = np.concatenate(([0], np.cumsum(is_rec)))
+    hits = n_records[stops] - n_records[starts]
+    if mask is not None:
+        col, row, _, record_index = get_hits(raw_data[is_rec])
+        readout_of_record = np.repeat(np.arange(starts.shape[0]), hits)
+        _, dropped = mask_hits(mask, col, row, record_index, readout_of_record.shape[0])
+        hits = hits - np.bincount(readout_of_record[dropped], minlength=starts.shape[0])
+    return hits
+
+
+def segment_medians(values, segment, n_segments):
+    ''' Median of values per segment, NaN for empty segments (same as np.median) '''
+    counts = np.bincount(segment, minlength=n_segments)
+    medians = np.full(n_segments, np.nan)
+    if values.shape[0] == 0:
+        return medians
+    offset = int(values.max()) + 1
+    sorted_values = np.sort(segment.astype(np.int64) * offset + values) % offset
+    filled = counts > 0
+    first = (np.cumsum(counts) - counts)[filled]
+    medians[filled] = (sorted_values[first + (counts[filled] - 1) // 2] + sorted_values[first + counts[filled] // 2]) / 2.
+    return medians
+
+
+def get_hits(data_record):
+    ''' Column, row, ToT of the hits in the data records and the index of the data record of each hit
+
+        Hits of the first and second ToT are not interleaved as in pyBAR,
+        the order does not matter for medians and histograms.
+    '''
+    col = np.right_shift(np.bitwise_and(data_record, COL_MASK), COL_SHIFT)
+    row = np.right_shift(np.bitwise_and(data_record, ROW_MASK), ROW_SHIFT)
+    tot1 = np.right_shift(np.bitwise_and(data_record, TOT1_MASK), TOT1_SHIFT)
+    tot2 = np.bitwise_and(data_record, TOT2_MASK)
+    record_index = np.arange(data_record.shape[0])
+    sel_1, sel_2 = tot1 < MAX_TOT, tot2 < MAX_TOT
+    return (np.concatenate((col[sel_1], col[sel_2])).astype(np.int64),
+            np.concatenate((row[sel_1], row[sel_2] + 1)).astype(np.int64),
+            np.concatenate((tot1[sel_1], tot2[sel_2])),
+            np.concatenate((record_index[sel_1], record_index[sel_2])))
+
+
+def mask_hits(mask, col, row, record_index, n_records):
+    ''' Lookup of the hits in a boolean mask (one row more than the histogram)
+
+        Returns which hits are not masked and which data records are dropped:
+        records with hits that are all masked. Records without hits are kept,
+        as without mask.
+    '''
+    masked = mask[col, row]
+    hits_of_record = np.bincount(record_index, minlength=n_records)
+    masked_of_record = np.bincount(record_index, weights=masked, minlength=n_records)
+    return ~masked, (hits_of_record > 0) & (masked_of_record == hits_of_record)
+
+
+def analyse_readouts(raw_data, starts, stops, window_stops, mask=None, metrics=None):
+    ''' Analyse concatenated readouts
+
+        Returns per readout the number of data records, the column/row median
+        and if there were data records, and one occupancy histogram for each
+        window (the last one is the still open window). A histogram is None
+        if there was no data record in the window. With mask the masked hits
+        and the records with only masked hits are removed (see mask_hits).
+        Hits outside of the histogram (row 337) are only in the medians.
+        With metrics (enabled Metrics) the decode, medians and histogram
+        stages are timed.
+    '''
+    if metrics:
+        start = time.time()
+    n_readouts = starts.shape[0]
+    is_rec = is_record(raw_data)
+    n_records = np.concatenate(([0], np.cumsum(is_rec)))
+    hits = n_records[stops] - n_records[starts]
+
+    readout_of_record = np.repeat(np.arange(n_readouts), hits)
+    col, row, _, record_index = get_hits(raw_data[is_rec])
+    if mask is not None:
+        keep, dropped = mask_hits(mask, col, row, record_index, readout_of_record.shape[0])
+        col, row, record_index = col[keep], row[keep], record_index[keep]
+        hits = hits - np.bincount(readout_of_record[dropped], minlength=n_readouts)
+    has_record = hits > 0
+    readout_of_hit = readout_of_record[record_index]
+    if metrics:
+        metrics.add("decode", start)
+        start = time.time()
+    coloumn = segment_medians(col, readout_of_hit, n_readouts)
+    row_median = segment_medians(row, readout_of_hit, n_readouts)
+    if metrics:
+        metrics.add("medians", start)
+        start = time.time()
+
+    window_of_readout = np.searchsorted(np.array(window_stops, dtype=np.int64), np.arange(n_readouts))
+    n_windows = len(window_stops) + 1
+    n_pixel = HIST_SHAPE[0] * HIST_SHAPE[1]
+    # the second hit of a record in the last row is outside of the histogram (as in hit_kernel)
+    in_hist = (col < HIST_SHAPE[0]) & (row < HIST_SHAPE[1])
+    window_of_hit = window_of_readout[readout_of_hit[in_hist]]
+    hist_occ = np.bincount(window_of_hit * n_pixel + col[in_hist] * HIST_SHAPE[1] + row[in_hist], minlength=n_windows * n_pixel)
+    hist_occ = hist_occ.astype(np.uint32).reshape((n_windows, ) + HIST_SHAPE)
+    window_has_record = np.bincount(window_of_readout, weights=has_record, minlength=n_windows) > 0
+    hists = [hist_occ[i] if window_has_record[i] else None for i in range(n_windows)]
+    if metrics:
+        metrics.add("histogram", start)
+    return hits, coloumn, row_median, has_record, hists
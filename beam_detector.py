@@ -0,0 +1,199 @@
+''' Beam on/off and hitrate peak detection of analyse_beam.
+
+    The detector is selected with threshold_vars["beam_detector"]:
+        "threshold": hitrate against beam_on/beam_off times the baseline
+                     median, peak against hitrate_peak times the mean of the
+                     medians of the beam on windows (original behaviour)
+        "cusum":     two sided CUSUM of the log hitrate against the level of
+                     the current segment, O(1) per window
+
+    BeamState.close_window adds the hitrate of every window, analyse_beam
+    calls detect() after the start conditions (start_analyse_hitrate_len
+    and start_analyse_hitrate_sum) are met and sends the messages of the
+    returned events.
+
+    The CUSUM detector splits the hitrate into segments of constant level.
+    A new segment starts with the window in which the CUSUM of the
+    standardised log hitrate exceeds cusum_threshold (cusum_drift is
+    subtracted each window). The level of the current segment is compared
+    every window with the beam off and the beam on level, the means of the
+    last beam off and beam on segment:
+        beam on:  above beam_on / beam_off times the beam off level
+        beam off: below beam_off times the beam on level or below half of
+                  the beam on ratio (log) above the beam off level
+        peak:     window above hitrate_peak times the beam on level
+    The first window of a spill or burst may be partly before its start,
+    so a beam on level is only a reference for bursts and peaks after
+    MIN_SEGMENT windows. A rise by more than hitrate_peak is a burst and
+    does not move the beam on level, a burst at the start of a spill is not
+    detected. The beam is on at the start of the run: if the first segment
+    is followed by a rise above the beam on ratio, it was a pause. There
+    are no peaks before the first change of the beam state.
+
+    The variance of a window is at least the poisson variance of its data
+    records, so a few noise hits do not start a segment.
+'''
+import math
+
+# alarms of analyse_beam in the last window (BeamState.events)
+EVENT_BEAM_ON = 0x01
+EVENT_BEAM_OFF = 0x02
+EVENT_HITRATE_PEAK = 0x04
+EVENT_BEAM_MOVED = 0x08
+
+# windows of a segment before its level is the beam on or off level
+MIN_SEGMENT = 3
+
+
+class ThresholdDetector(object):
+    ''' Hitrate against beam_on/beam_off times the baseline median '''
+
+    def __init__(self, threshold_vars, baseline):
+        self.threshold_vars = threshold_vars
+        self.baseline = baseline
+        self.hitrate = 0.
+
+    def add(self, hitrate, window_length):
+        self.hitrate = hitrate  # the baseline is updated by BeamState
+
+    def detect(self, beam):
+        ''' Returns the beam state and the events of the last window '''
+        threshold_vars, baseline, hitrate = self.threshold_vars, self.baseline, self.hitrate
+        events = 0
+        median = baseline.median()
+        if hitrate > median * threshold_vars["beam_on"]:
+            baseline.add_baseline(median)
+            if beam == False:
+                beam = True
+                events |= EVENT_BEAM_ON
+            # detect hitrate burst if its over threshold_vars["hitrate_peak"]
+            if hitrate > threshold_vars["hitrate_peak"] * baseline.mean_baseline():
+                events |= EVENT_HITRATE_PEAK
+        if hitrate < median * threshold_vars["beam_off"]:
+            if beam == True:
+                beam = False
+                events |= EVENT_BEAM_OFF
+        return beam, events
+
+
+class Segment(object):
+    ''' Running mean and variance of the log hitrate and mean number of data records of a segment
+
+        A segment starts with one window and the variance of the previous
+        segment, which counts as one window. The weight of a window is 1 / n
+        for the first memory windows, older windows are forgotten
+        exponentially afterwards.
+    '''
+    __slots__ = ("n", "mean", "var", "hits", "beam")
+
+    def __init__(self, value, hits, var=0., beam=None):
+        self.n = 1
+        self.mean = value
+        self.var = var
+        self.hits = hits
+        self.beam = beam  # True: beam on, False: beam off, None: burst or not classified
+
+    def add(self, value, hits, memory):
+        if self.n < memory:
+            self.n += 1
+        weight = 1. / self.n
+        delta = value - self.mean
+        self.mean += weight * delta
+        self.var = (1. - weight) * (self.var + weight * delta * delta)
+        self.hits += weight * (hits - self.hits)
+
+    def sigma(self):
+        ''' Standard deviation of one window, at least the poisson error of the mean number of records '''
+        return math.sqrt(max(self.var, 1. / (self.hits + 1.)))
+
+
+class CusumDetector(object):
+    ''' Two sided CUSUM change point detection on the log hitrate, see the module docstring '''
+
+    def __init__(self, threshold_vars, baseline=None):
+        self.threshold_vars = threshold_vars
+        self.segment = None
+        self.cusum_up = 0.
+        self.cusum_down = 0.
+        self.change = 0  # +1 / -1 if the last window started a higher / lower segment
+        self.value = None  # log hitrate of the last window
+        self.on_level = None
+        self.off_level = None
+        self.on_settled = False  # the level is of a segment with MIN_SEGMENT windows
+        self.off_settled = False
+        self.initial = True  # the beam state is the initial one, the first segment may be a pause
+
+    def add(self, hitrate, window_length):
+        threshold_vars = self.threshold_vars
+        hits = hitrate * window_length
+        value = math.log((hits + 1.) / window_length)
+        self.value = value
+        self.change = 0
+        segment = self.segment
+        if segment is None:
+            self.segment = Segment(value, hits)
+            return
+        z = (value - segment.mean) / segment.sigma()
+        drift = threshold_vars["cusum_drift"]
+        self.cusum_up = max(self.cusum_up + z - drift, 0.)
+        self.cusum_down = max(self.cusum_down - z - drift, 0.)
+        if self.cusum_up > threshold_vars["cusum_threshold"]:
+            self.change = 1
+        elif self.cusum_down > threshold_vars["cusum_threshold"]:
+            self.change = -1
+        if self.change:
+            self.segment = Segment(value, hits, segment.var)
+            self.cusum_up = self.cusum_down = 0.
+        else:
+            segment.add(value, hits, threshold_vars["cusum_memory"])
+
+    def detect(self, beam):
+        ''' Returns the beam state and the events of the last window '''
+        threshold_vars = self.threshold_vars
+        events = 0
+        segment = self.segment
+        if segment is None:
+            return beam, events
+        on_ratio = math.log(threshold_vars["beam_on"] / threshold_vars["beam_off"])
+        off_ratio = math.log(threshold_vars["beam_off"])
+        peak = math.log(threshold_vars["hitrate_peak"])
+        level = segment.mean
+        if self.change or (self.on_level is None and self.off_level is None):
+            # a new segment belongs to the beam state unless it is a burst
+            burst = self.change > 0 and beam and self.on_settled and level - self.on_level > peak
+            segment.beam = None if burst else beam
+            if burst and self.initial and level - self.on_level > on_ratio:
+                # the run started in a pause: the beam was on since the start of the run
+                segment.beam = True
+                self.off_level, self.off_settled = self.on_level, True
+                self.on_settled = self.initial = False
+        # the level of the segment is compared every window, the first window of a segment may be partly before the change
+        if not beam and self.off_level is not None and level - self.off_level > on_ratio:
+            beam = True
+            events |= EVENT_BEAM_ON
+            segment.beam = True
+            self.on_settled = self.initial = False  # the spill may have another intensity than the last one
+        elif beam and segment.beam is not None and ((self.on_level is not None and level - self.on_level < off_ratio) or
+                                                    (self.off_level is not None and level - self.off_level < on_ratio / 2)):
+            beam = False
+            events |= EVENT_BEAM_OFF
+            segment.beam = False
+            self.off_settled = self.initial = False
+        if segment.beam and (segment.n >= MIN_SEGMENT or not self.on_settled):
+            self.on_level = level
+            self.on_settled = segment.n >= MIN_SEGMENT
+        elif segment.beam is False and (segment.n >= MIN_SEGMENT or not self.off_settled):
+            self.off_level = level
+            self.off_settled = segment.n >= MIN_SEGMENT
+        if beam and self.on_settled and not self.initial and self.value - self.on_level > peak:
+            events |= EVENT_HITRATE_PEAK
+        return beam, events
+
+
+def create_detector(threshold_vars, baseline):
+    detector = threshold_vars.get("beam_detector", "threshold")
+    if detector == "threshold":
+        return ThresholdDetector(threshold_vars, baseline)
+    if detector == "cusum":
+        return CusumDetector(threshold_vars, baseline)
+    raise ValueError("Unknown beam detector %s" % detector)
@@ -0,0 +1,101 @@
+''' Recorder of the per frame results of the beam analysis.
+
+    Every closed integration window gives one record (hitrate, beam spot
+    median and variance, beam state and the alarms of analyse_beam). The
+    records are collected in a preallocated numpy buffer, full buffers (or
+    after flush_interval seconds) are handed to a writer thread that
+    appends them to a compressed, chunked PyTables table. The analysis
+    thread never touches the file.
+
+    load() reads the records of a time range for the review after the run.
+'''
+import threading
+import time
+from Queue import Queue
+
+import numpy as np
+import tables as tb
+
+from beam_state import EVENT_BEAM_ON, EVENT_BEAM_OFF, EVENT_HITRATE_PEAK, EVENT_BEAM_MOVED
+
+TABLE_NAME = "beam_monitor"
+RECORD_DTYPE = np.dtype([("timestamp_start", np.float64), ("timestamp_stop", np.float64), ("hitrate", np.float64),
+                         ("coloumn", np.float64), ("row", np.float64), ("coloumn_variance", np.float64), ("row_variance", np.float64),
+                         ("beam", np.bool_), ("events", np.uint8)])
+EVENTS = {"beam_on": EVENT_BEAM_ON, "beam_off": EVENT_BEAM_OFF, "hitrate_peak": EVENT_HITRATE_PEAK, "beam_moved": EVENT_BEAM_MOVED}
+
+
+class Recorder(object):
+
+    def __init__(self, filename, buffer_size=1000, flush_interval=1., complevel=5, chunk_size=4096):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.filters = tb.Filters(complib="blosc", complevel=complevel)
+        self.chunk_size = chunk_size
+        self.n_records = 0
+        self.n_written = 0
+        self._queue = Queue()
+        self._buffer = np.zeros(buffer_size, dtype=RECORD_DTYPE)
+        self._n = 0
+        self._last_flush = time.time()
+        self._writer = threading.Thread(target=self._write, name="BeamRecorder")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def add(self, timestamp_start, timestamp_stop, hitrate, coloumn, row, coloumn_variance, row_variance, beam, events):
+        self._buffer[self._n] = (timestamp_start, timestamp_stop, hitrate, coloumn, row, coloumn_variance, row_variance, beam, events)
+        self._n += 1
+        self.n_records += 1
+        if self._n == self.buffer_size or time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        ''' Hand the buffered records to the writer thread '''
+        self._last_flush = time.time()
+        if not self._n:
+            return
+        self._queue.put(self._buffer[:self._n])
+        self._buffer = np.zeros(self.buffer_size, dtype=RECORD_DTYPE)
+        self._n = 0
+
+    def close(self):
+        ''' Write the remaining records and close the file '''
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write(self):
+        with tb.open_file(self.filename, mode="w", title="E3 beam monitor") as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name=TABLE_NAME, description=RECORD_DTYPE, title="Results per frame",
+                                             filters=self.filters, chunkshape=(self.chunk_size, ))
+            while True:
+                records = self._queue.get()
+                if records is None:
+                    break
+                table.append(records)
+                table.flush()
+                self.n_written += records.shape[0]
+            table.cols.timestamp_start.create_csindex(filters=self.filters)
+
+
+def load(filename, timestamp_start=None, timestamp_stop=None, events=None):
+    ''' Records with timestamp_start <= record timestamp_start < timestamp_stop
+
+        events is an optional list of event names (see EVENTS), then only
+        records with one of these events are returned.
+    '''
+    conditions = []
+    if timestamp_start is not None:
+        conditions.append("(timestamp_start >= t_start)")
+    if timestamp_stop is not None:
+        conditions.append("(timestamp_start < t_stop)")
+    if events:
+        conditions.append("((events & event_mask) != 0)")
+    condvars = {"t_start": timestamp_start, "t_stop": timestamp_stop,
+                "event_mask": np.uint8(sum(EVENTS[event] for event in events) if events else 0)}
+    with tb.open_file(filename, mode="r") as in_file_h5:
+        table = in_file_h5.get_node(in_file_h5.root, TABLE_NAME)
+        if not conditions:
+            return table.read()
+        return table.read_where(" & ".join(conditions), condvars=condvars)
@@ -0,0 +1,98 @@
+''' Moment based beam spot estimator.
+
+    The weighted sums n, sum x, sum y, sum x^2, sum y^2, sum xy of the hit
+    positions are calculated from the occupancy histogram of a window with
+    a few dot products, no sorting of hits. They give the centroid, the RMS
+    width and the tilt of the beam spot in mm (pixel pitch 0.25 mm x 0.05 mm).
+
+    The beam moved alarm compares the centroid of each window with a
+    reference centroid, an exponential moving average of the previous
+    windows. It is an alternative to the median/variance logic of
+    analyse_beam (threshold_vars["beamspot_estimator"] = "moments").
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from batch_analysis import HIST_SHAPE
+
+PITCH_COL = 0.25  # mm
+PITCH_ROW = 0.05  # mm
+COL_MM = np.arange(HIST_SHAPE[0]) * PITCH_COL
+ROW_MM = np.arange(HIST_SHAPE[1]) * PITCH_ROW
+
+Moments = namedtuple("Moments", ["n", "sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy"])
+BeamSpot = namedtuple("BeamSpot", ["n", "x", "y", "sigma_x", "sigma_y", "tilt"])
+
+
+def get_moments(hist_occ, trim=None):
+    ''' Weighted sums of the hit positions in mm
+
+        With trim pixels with more than trim times the median count of the
+        hit pixels are ignored (noisy pixels).
+    '''
+    hist = hist_occ
+    if trim:
+        counts = hist[hist > 0]
+        if counts.shape[0]:
+            hist = np.where(hist > trim * np.median(counts), 0, hist)
+    col_projection = hist.sum(axis=1, dtype=np.float64)
+    row_projection = hist.sum(axis=0, dtype=np.float64)
+    return Moments(col_projection.sum(), np.dot(COL_MM, col_projection), np.dot(ROW_MM, row_projection),
+                   np.dot(COL_MM ** 2, col_projection), np.dot(ROW_MM ** 2, row_projection), np.dot(COL_MM, np.dot(hist, ROW_MM)))
+
+
+def get_beam_spot(moments):
+    ''' Centroid, RMS width (mm) and tilt (rad) of the principal axis, NaN without hits '''
+    n = moments.n
+    if not n:
+        return BeamSpot(0, np.nan, np.nan, np.nan, np.nan, np.nan)
+    x, y = moments.sum_x / n, moments.sum_y / n
+    var_x = max(moments.sum_xx / n - x ** 2, 0.)
+    var_y = max(moments.sum_yy / n - y ** 2, 0.)
+    cov_xy = moments.sum_xy / n - x * y
+    return BeamSpot(int(n), x, y, np.sqrt(var_x), np.sqrt(var_y), 0.5 * np.arctan2(2 * cov_xy, var_x - var_y))
+
+
+class MomentBeamSpot(object):
+    ''' Beam spot of each window and distance to the reference centroid
+
+        Windows with less than min_hits hits are ignored, alpha is the
+        weight of a window in the reference centroid.
+    '''
+
+    def __init__(self, trim=None, alpha=0.1, min_hits=100):
+        self.trim = trim
+        self.alpha = alpha
+        self.min_hits = min_hits
+        self.reset()
+
+    def reset(self):
+        self.beam_spot = None
+        self.reference = None
+        self._distance = 0.
+
+    def reset_reference(self):
+        self.reference = None
+
+    def add(self, hist_occ):
+        ''' Beam spot of the window histogram (None without hits) '''
+        self._distance = 0.
+        if hist_occ is None:
+            return None
+        beam_spot = get_beam_spot(get_moments(hist_occ, self.trim))
+        if beam_spot.n < self.min_hits:
+            return None
+        self.beam_spot = beam_spot
+        if self.reference is None:
+            self.reference = (beam_spot.x, beam_spot.y)
+            self._distance = 0.
+            return beam_spot
+        self._distance = np.hypot(beam_spot.x - self.reference[0], beam_spot.y - self.reference[1])
+        self.reference = (self.reference[0] + self.alpha * (beam_spot.x - self.reference[0]),
+                          self.reference[1] + self.alpha * (beam_spot.y - self.reference[1]))
+        return beam_spot
+
+    def distance(self):
+        ''' Distance in mm of the last beam spot to the reference before it was added '''
+        return self._distance
@@ -0,0 +1,128 @@
+''' Run state of the online analysis in preallocated numpy ring buffers.
+
+    Replaces the global_vars dict of python lists. Appending is O(1) and
+    the last n values are always available as a contiguous view without
+    copying: every value is written twice, at pos and at pos + capacity.
+'''
+import numpy as np
+
+from hitrate_baseline import create_baseline
+from beam_detector import create_detector, EVENT_BEAM_ON, EVENT_BEAM_OFF, EVENT_HITRATE_PEAK, EVENT_BEAM_MOVED
+
+
+class RingBuffer(object):
+    ''' Fixed capacity buffer that keeps the last capacity values '''
+    __slots__ = ("capacity", "_data", "_pos", "_n")
+
+    def __init__(self, capacity, dtype=np.float64):
+        self.capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype=dtype)
+        self._pos = 0
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def append(self, value):
+        self._data[self._pos] = value
+        self._data[self._pos + self.capacity] = value
+        self._pos = (self._pos + 1) % self.capacity
+        if self._n < self.capacity:
+            self._n += 1
+
+    def extend(self, values):
+        values = np.asarray(values)[-self.capacity:]
+        n_values = values.shape[0]
+        if n_values == 0:
+            return
+        first = min(n_values, self.capacity - self._pos)
+        for offset in (0, self.capacity):
+            self._data[self._pos + offset:self._pos + offset + first] = values[:first]
+            self._data[offset:offset + n_values - first] = values[first:]
+        self._pos = (self._pos + n_values) % self.capacity
+        self._n = min(self._n + n_values, self.capacity)
+
+    def view(self, n=None):
+        ''' The last n (default all) values, oldest first, without copy '''
+        if n is None or n > self._n:
+            n = self._n
+        stop = self._pos + self.capacity
+        return self._data[stop - n:stop]
+
+    def last(self):
+        if not self._n:
+            raise IndexError("RingBuffer is empty")
+        return self._data[self._pos + self.capacity - 1]
+
+    def clear(self):
+        self._pos = 0
+        self._n = 0
+
+
+class BeamState(object):
+    ''' State of the beam analysis of one run
+
+        The readouts of the open integration window only need the start
+        time and the summed number of data records.
+    '''
+    __slots__ = ("threshold_vars", "window_start", "window_hits", "coloumn", "row", "hitrate", "baseline", "detector", "hist_occ", "beam", "analyse", "events")
+
+    def __init__(self, threshold_vars, hitrate_capacity=72000, beamspot_capacity=4096):
+        self.threshold_vars = threshold_vars
+        self.coloumn = RingBuffer(beamspot_capacity)
+        self.row = RingBuffer(beamspot_capacity)
+        self.hitrate = RingBuffer(hitrate_capacity)
+        self.beam = True
+        self.analyse = True
+        self.reset()
+
+    def reset(self):
+        self.window_start = None
+        self.window_hits = 0
+        self.coloumn.clear()
+        self.row.clear()
+        self.hitrate.clear()
+        self.baseline = create_baseline(self.threshold_vars)
+        self.detector = create_detector(self.threshold_vars, self.baseline)
+        self.hist_occ = None
+        self.events = 0
+
+    def add_readout(self, timestamp_start, hits):
+        if self.window_start is None:
+            self.window_start = timestamp_start
+        self.window_hits += hits
+
+    def window_due(self, timestamp_stop):
+        ''' True if the open window is closed by a readout that ends at timestamp_stop
+
+            With threshold_vars["framing"] = "adaptive" a window is closed
+            when it has window_hits hits and is at least window_min_time
+            long, or when it is longer than window_max_time. Otherwise it
+            is closed after integration_time.
+        '''
+        threshold_vars = self.threshold_vars
+        window_length = timestamp_stop - self.window_start
+        if threshold_vars["framing"] == "adaptive":
+            return window_length > threshold_vars["window_max_time"] or (self.window_hits >= threshold_vars["window_hits"] and window_length >= threshold_vars["window_min_time"])
+        return window_length > threshold_vars["integration_time"]
+
+    def add_beamspot(self, coloumn, row):
+        self.coloumn.append(coloumn)
+        self.row.append(row)
+
+    def reset_beamspot(self):
+        self.coloumn.clear()
+        self.row.clear()
+
+    def close_window(self, timestamp_stop):
+        ''' Append the hitrate of the window and start a new one, returns the window length '''
+        window_length = timestamp_stop - self.window_start
+        hitrate = self.window_hits / window_length
+        self.hitrate.append(hitrate)
+        self.baseline.add(hitrate)
+        self.detector.add(hitrate, window_length)
+        self.window_start = None
+        self.window_hits = 0
+        self.hist_occ = None
+        self.events = 0
+        return window_length
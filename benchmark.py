@@ -0,0 +1,424 @@
+''' Throughput benchmarks of the online analysis with synthetic FE-I4 data.
+
+    Stages:
+        analyse:      handle_data path of E3_control (per readout loop and
+                      batch analysis with the fused kernel, parallel analysis),
+                      including window closing, analyse_beam and hit map encoding
+        analyse_beam: beam decision per integration window
+        front_ends:   batch analysis of several front ends with the same
+                      data, serial and with one process per front end
+        pixel_mask:   fused kernel and batch analysis with and without
+                      masked pixels, extra time per hit of the mask lookup
+        hit_map:      encode (E3_control/analyse) and decode (recv_data) of
+                      the hit map frames for each format and codec
+        replay:       reading a raw data file with Replay
+
+    Before the benchmarks the batch analysis (vectorized and fused) is
+    checked against the per readout kernel of the loop path with hits on the edge of the histogram
+    (second hits in row 337), and the windows of both paths are compared
+    with adaptive framing and masked pixels.
+
+    Each result has readouts/s, hits/s (data records as in the hitrate) and
+    latency percentiles per frame (handle_data call, window, hit map frame
+    or readout). The results are written as json for regression tracking.
+'''
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import zlib
+from optparse import OptionParser
+
+import cPickle as pickle
+import numpy as np
+import zmq
+
+import batch_analysis
+import E3_control
+import hist_codec
+import hist_transport
+import hit_kernel
+import pixel_mask
+from fei4_generator import Fei4Generator
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_result(name, latencies, duration, n_readouts, n_hits, **kwargs):
+    ''' Benchmark result, latencies in seconds per frame '''
+    latencies = np.array(latencies) * 1e3
+    result = {
+        "name": name,
+        "duration_s": duration,
+        "n_frames": latencies.shape[0],
+        "frames_per_s": latencies.shape[0] / duration if duration else None,
+        "readouts_per_s": n_readouts / duration if duration and n_readouts is not None else None,
+        "hits_per_s": n_hits / duration if duration and n_hits is not None else None,
+        "latency_ms": dict(("p%d" % p, float(np.percentile(latencies, p)) if latencies.shape[0] else None) for p in PERCENTILES),
+        }
+    result["latency_ms"]["max"] = float(latencies.max()) if latencies.shape[0] else None
+    result.update(kwargs)
+    return result
+
+
+class OnlineAnalysis(object):
+    ''' handle_data path of E3_control, the analysis core without sockets and hardware
+
+        mode is "loop" (analyse() with the fused kernel), "batch"
+        (analyse_batch()) or "parallel" (analyse_batch() with n_workers
+        processes). The hit maps are encoded as for a client subscribed to
+        everything, the messages go to the Outbox E3_control.socket.
+    '''
+
+    def __init__(self, mode="batch", n_workers=0):
+        self.mode = mode
+        E3_control.conf["batch_analysis"] = mode != "loop"
+        E3_control.conf["fused_kernel"] = True
+        E3_control.conf["analysis_processes"] = n_workers if mode == "parallel" else 0
+        E3_control.hist_publisher.topics = set([b""])
+        E3_control.metrics.enabled = True
+        self.reset()
+
+    def reset(self):
+        E3_control.del_var()
+        E3_control.metrics.reset()
+        E3_control.analysis_messages.dispatch()
+        E3_control.socket.messages.clear()
+
+    @property
+    def n_windows(self):
+        return E3_control.metrics.counters["frames"]
+
+    @property
+    def messages(self):
+        E3_control.analysis_messages.dispatch()  # sent by the event loop in E3_control
+        return E3_control.socket.messages
+
+    @property
+    def beam_latencies(self):
+        return E3_control.metrics.latency["analyse_beam"].view()
+
+    def close(self):
+        if E3_control.parallel_analysis is not None:
+            E3_control.parallel_analysis.close()
+            E3_control.parallel_analysis = None
+        if E3_control.module_pool is not None:
+            E3_control.module_pool.close()
+            E3_control.module_pool = None
+
+    def handle_data(self, data_array):
+        E3_control.analyse_data(data_array)
+
+
+def get_calls(readouts, readouts_per_call, n_front_ends=1):
+    ''' Group the readouts into the data of handle_data calls, each front end gets the same readouts '''
+    return [[readouts[i:i + readouts_per_call]] * n_front_ends for i in range(0, len(readouts), readouts_per_call)]
+
+
+def count_hits(readouts):
+    return int(sum(np.count_nonzero(batch_analysis.is_record(ro[0])) for ro in readouts))
+
+
+def bench_analyse(readouts, n_hits, readouts_per_call=1, workers=(2, )):
+    ''' Throughput of the handle_data path for each analysis mode '''
+    modes = [("loop", 0), ("batch", 0)] + [("parallel", n) for n in workers if n]
+    calls = get_calls(readouts, readouts_per_call)
+    results = []
+    for mode, n_workers in modes:
+        analysis = OnlineAnalysis(mode, n_workers)
+        analysis.handle_data(calls[0])  # warm up (numba compilation, process start)
+        analysis.reset()
+        latencies = []
+        start = time.time()
+        for data_array in calls:
+            call_start = time.time()
+            analysis.handle_data(data_array)
+            latencies.append(time.time() - call_start)
+        duration = time.time() - start
+        analysis.close()
+        name = "analyse_%s" % mode + ("_%d" % n_workers if n_workers else "")
+        results.append(get_result(name, latencies, duration, len(readouts), n_hits, n_windows=analysis.n_windows,
+                                  readouts_per_call=readouts_per_call, numba=hit_kernel.njit is not None))
+    return results
+
+
+def bench_analyse_beam(readouts, n_hits):
+    ''' Time of analyse_beam per integration window of the batch analysis '''
+    analysis = OnlineAnalysis("batch")
+    analysis.handle_data([readouts])
+    latencies = analysis.beam_latencies
+    return [get_result("analyse_beam", latencies, float(latencies.sum()), None, None, n_windows=analysis.n_windows, n_messages=len(analysis.messages))]
+
+
+def bench_front_ends(readouts, n_hits, readouts_per_call=1, front_ends=(1, 2, 4)):
+    ''' Throughput of the batch analysis of several front ends, serial and with one process per front end '''
+    results = []
+    for processes in (False, True):
+        for n_front_ends in front_ends:
+            E3_control.conf["front_end_processes"] = n_front_ends if processes else 0
+            calls = get_calls(readouts, readouts_per_call, n_front_ends)
+            analysis = OnlineAnalysis("batch")
+            analysis.handle_data(calls[0])  # warm up, creates the front ends and the processes
+            analysis.reset()
+            latencies = []
+            start = time.time()
+            for data_array in calls:
+                call_start = time.time()
+                analysis.handle_data(data_array)
+                latencies.append(time.time() - call_start)
+            duration = time.time() - start
+            analysis.close()
+            name = "front_ends_%d" % n_front_ends + ("_processes" if processes else "")
+            results.append(get_result(name, latencies, duration, n_front_ends * len(readouts), n_front_ends * n_hits, n_windows=analysis.n_windows,
+                                      n_front_ends=n_front_ends, readouts_per_call=readouts_per_call))
+    E3_control.conf["front_end_processes"] = 0
+    E3_control.setup_front_ends(1)
+    return results
+
+
+def bench_pixel_mask(readouts, n_hits, n_masked=10, repeat=3):
+    ''' Time per hit of the fused kernel and the batch analysis without and with the n_masked pixels with the most hits '''
+    raw_data, starts, stops, timestamp_start, timestamp_stop = batch_analysis.concatenate_readouts(readouts)
+    window_stops = batch_analysis.get_window_stops(timestamp_start, timestamp_stop, None, E3_control.threshold_vars["integration_time"])
+    hist_occ = sum(hist for hist in batch_analysis.analyse_readouts(raw_data, starts, stops, window_stops)[4] if hist is not None)
+    hottest = np.argsort(hist_occ, axis=None)[::-1][:n_masked]
+    results = []
+    for stage in ("kernel", "batch"):
+        durations = {}
+        for masked in (False, True):
+            mask = pixel_mask.PixelMask()
+            if masked:
+                mask.add(np.column_stack(np.unravel_index(hottest, hist_occ.shape)))
+            hit_histogram = hit_kernel.HitHistogram(mask=mask)
+            latencies = []
+            for _ in range(repeat + 1):  # the first one compiles the kernel
+                start = time.time()
+                if stage == "kernel":
+                    for ro in readouts:
+                        hit_histogram.add(ro[0])
+                        hit_histogram.reset()
+                else:
+                    batch_analysis.analyse_readouts(raw_data, starts, stops, window_stops, mask.get_lookup())
+                latencies.append(time.time() - start)
+            durations[masked] = np.mean(latencies[1:])
+            results.append(get_result("pixel_mask_%s%s" % (stage, "_masked" if masked else ""), latencies[1:], sum(latencies[1:]), repeat * len(readouts), repeat * n_hits,
+                                      n_masked=mask.n_masked))
+        results[-1]["mask_ns_per_hit"] = (durations[True] - durations[False]) / max(n_hits, 1) * 1e9
+    return results
+
+
+def check_batch(readouts, integration_time, analyse_readouts=batch_analysis.analyse_readouts):
+    ''' Number of readouts and windows in which analyse_readouts differs from the per readout kernel of the loop path '''
+    raw_data, starts, stops, timestamp_start, timestamp_stop = batch_analysis.concatenate_readouts(readouts)
+    window_stops = batch_analysis.get_window_stops(timestamp_start, timestamp_stop, None, integration_time)
+    hits, coloumn, row, _, hists = analyse_readouts(raw_data, starts, stops, window_stops)
+    hit_histogram = hit_kernel.HitHistogram()
+    loop_hits, loop_coloumn, loop_row, loop_hists = [], [], [], []
+    for i, ro in enumerate(readouts):
+        n_records, col, ro_row, _ = hit_histogram.add(ro[0])
+        loop_hits.append(n_records)
+        loop_coloumn.append(np.median(col) if col.shape[0] else np.nan)
+        loop_row.append(np.median(ro_row) if ro_row.shape[0] else np.nan)
+        if i in window_stops or i == len(readouts) - 1:
+            loop_hists.append(hit_histogram.hist_occ.copy())
+            hit_histogram.reset()
+    medians_equal = [np.array_equal(np.isnan(a), np.isnan(b)) and np.array_equal(a[~np.isnan(a)], b[~np.isnan(b)])
+                     for a, b in zip(np.column_stack((coloumn, row)), np.column_stack((loop_coloumn, loop_row)))]
+    return {
+        "n_readouts": len(readouts),
+        "n_windows": len(loop_hists),
+        "hits": int(np.count_nonzero(hits != np.array(loop_hits))),
+        "medians": medians_equal.count(False),
+        "hists": sum(1 for hist, loop_hist in zip(hists, loop_hists) if not np.array_equal(loop_hist, 0 if hist is None else hist)),
+        }
+
+
+def check_framing(readouts, n_masked=10, window_hits=100000, readouts_per_call=10):
+    ''' Windows in which the batch analysis differs from the loop path with adaptive framing and the n_masked pixels with the most hits masked
+
+        Both paths have to close the windows after the same readouts, the
+        hits of a window are counted without the masked records. window_hits
+        has to be more than the hits of window_min_time, otherwise the
+        windows are closed by the time.
+    '''
+    raw_data, starts, stops, timestamp_start, timestamp_stop = batch_analysis.concatenate_readouts(readouts)
+    hist_occ = sum(hist for hist in batch_analysis.analyse_readouts(raw_data, starts, stops, [])[4] if hist is not None)
+    hottest = np.column_stack(np.unravel_index(np.argsort(hist_occ, axis=None)[::-1][:n_masked], hist_occ.shape))
+    threshold_vars, conf = E3_control.threshold_vars, E3_control.conf
+    saved = threshold_vars["framing"], threshold_vars["window_hits"], conf["mask_noisy_pixels"]
+    threshold_vars["framing"], threshold_vars["window_hits"] = "adaptive", window_hits
+    conf["mask_noisy_pixels"] = False  # the same mask in both paths
+    hitrates = {}
+    try:
+        for mode in ("loop", "batch"):
+            analysis = OnlineAnalysis(mode)
+            E3_control.pixel_mask.clear()
+            E3_control.pixel_mask.add(hottest)
+            for data_array in get_calls(readouts, readouts_per_call):
+                analysis.handle_data(data_array)
+            hitrates[mode] = E3_control.state.hitrate.view().copy()
+    finally:
+        threshold_vars["framing"], threshold_vars["window_hits"], conf["mask_noisy_pixels"] = saved
+        E3_control.pixel_mask.clear()
+    n_windows = min(len(hitrates["loop"]), len(hitrates["batch"]))
+    return {
+        "n_masked": n_masked,
+        "n_windows": len(hitrates["loop"]),
+        "hitrates": int(np.count_nonzero(hitrates["loop"][:n_windows] != hitrates["batch"][:n_windows])) + abs(len(hitrates["loop"]) - len(hitrates["batch"])),
+        }
+
+
+def get_hists(readouts):
+    ''' Occupancy histograms of the integration windows of the readouts '''
+    raw_data, starts, stops, timestamp_start, timestamp_stop = batch_analysis.concatenate_readouts(readouts)
+    window_stops = batch_analysis.get_window_stops(timestamp_start, timestamp_stop, None, E3_control.threshold_vars["integration_time"])
+    hists = batch_analysis.analyse_readouts(raw_data, starts, stops, window_stops)[4][:-1]
+    window_starts = [0] + [i + 1 for i in window_stops[:-1]]
+    return [(hist, timestamp_start[first], timestamp_stop[last]) for hist, first, last in zip(hists, window_starts, window_stops)]
+
+
+def bench_hit_map(readouts):
+    ''' Encode and decode time and size per hit map frame for each format '''
+    hists = get_hists(readouts)
+    formats = [("pickle", None, False), ("raw", None, False)]
+    for codec in sorted(hist_codec.CODECS, key=hist_codec.CODECS.get):
+        if (codec == "zstd" and hist_codec.zstandard is None) or (codec == "lz4" and hist_codec.lz4 is None):
+            continue
+        formats.extend([("sparse", codec, False), ("sparse", codec, True)])
+    results = []
+    for hist_format, codec, delta in formats:
+        encoder = hist_codec.HistEncoder(codec=codec, delta=delta)
+        receiver = hist_transport.HistReceiver(allow_pickle=hist_format == "pickle")
+        encode_latencies, decode_latencies, n_bytes = [], [], 0
+        for hist_occ, timestamp_start, timestamp_stop in hists:
+            encode_start = time.time()
+            if hist_format == "pickle":
+                frames = [zlib.compress(pickle.dumps(hist_occ, -1))]
+            elif hist_format == "raw":
+                hist_occ = np.zeros(batch_analysis.HIST_SHAPE, dtype=np.uint32) if hist_occ is None else hist_occ
+                frames = [hist_transport.RAW_HEADER.pack(hist_transport.RAW_TOPIC, hist_occ.dtype.str.encode("ascii"), hist_occ.shape[0], hist_occ.shape[1],
+                                                         0, timestamp_start, timestamp_stop), hist_occ]
+            else:
+                frames = [encoder.encode(hist_occ, timestamp_start, timestamp_stop)]
+            encode_latencies.append(time.time() - encode_start)
+            n_bytes += len(frames[0]) + (hist_occ.nbytes if hist_format == "raw" else 0)
+            frames = [zmq.Frame(frame) for frame in frames]
+            decode_start = time.time()
+            receiver.decode(frames)
+            decode_latencies.append(time.time() - decode_start)
+        name = "hit_map_%s" % hist_format + ("_%s" % codec if codec else "") + ("_delta" if delta else "")
+        n_frames = max(len(hists), 1)
+        results.append(get_result(name + "_encode", encode_latencies, sum(encode_latencies), None, None, bytes_per_frame=n_bytes / float(n_frames)))
+        results.append(get_result(name + "_decode", decode_latencies, sum(decode_latencies), None, None, bytes_per_frame=n_bytes / float(n_frames)))
+    return results
+
+
+def bench_replay(generator, duration, n_hits):
+    ''' Readout rate of Replay for a raw data file of the generator, with and without prefetch '''
+    try:
+        from Replay import Replay
+    except ImportError as e:
+        print("replay benchmark skipped: %s" % e)
+        return []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "fei4_generator.h5")
+        generator.write_h5(filename, duration)
+        results = []
+        for prefetch in (False, True):
+            latencies = []
+            n_readouts = 0
+            start = read_start = time.time()
+            for _ in Replay(prefetch=prefetch).get_data(filename, real_time=False):
+                now = time.time()
+                latencies.append(now - read_start)
+                read_start = now
+                n_readouts += 1
+            results.append(get_result("replay" + ("_prefetch" if prefetch else ""), latencies, time.time() - start, n_readouts, n_hits))
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run(duration=10., hit_rate=1e6, readouts_per_call=1, workers=(2, ), seed=0, replay=True, front_ends=(1, 2, 4), **kwargs):
+    ''' Run all benchmarks with duration seconds of generated data, returns the results as dict '''
+    generator_conf = dict(hit_rate=hit_rate, seed=seed, **kwargs)
+    readouts = list(Fei4Generator(**generator_conf).readouts(duration))
+    n_hits = count_hits(readouts)
+    # beam spot on the last row, the second hit of a record there is outside of the histogram
+    edge_readouts = list(Fei4Generator(**dict(generator_conf, beam_row=batch_analysis.HIST_SHAPE[1] - 4., beam_sigma_row=4., edge_hits=True)).readouts(1.))
+    check = dict((name, check_batch(edge_readouts, E3_control.threshold_vars["integration_time"], analyse_readouts))
+                 for name, analyse_readouts in (("vectorized", batch_analysis.analyse_readouts), ("fused", hit_kernel.analyse_readouts)))
+    framing_check = check_framing(readouts[:200])
+    results = []
+    results.extend(bench_analyse(readouts, n_hits, readouts_per_call, workers))
+    results.extend(bench_analyse_beam(readouts, n_hits))
+    if front_ends:
+        results.extend(bench_front_ends(readouts, n_hits, readouts_per_call, front_ends))
+    results.extend(bench_pixel_mask(readouts, n_hits))
+    results.extend(bench_hit_map(readouts))
+    if replay:
+        results.extend(bench_replay(Fei4Generator(**generator_conf), duration, n_hits))
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": hit_kernel.njit is not None,
+        "duration": duration,
+        "n_readouts": len(readouts),
+        "n_hits": n_hits,
+        "generator": generator_conf,
+        "check": check,
+        "check_framing": framing_check,
+        "results": results,
+        }
+
+
+def print_results(report):
+    def format_value(value, fmt):
+        return "-" if value is None else fmt % value
+
+    print("%d readouts, %d hits (%.1f s of data)" % (report["n_readouts"], report["n_hits"], report["duration"]))
+    for name, check in sorted(report["check"].items()):
+        print("%s batch analysis vs loop: %d/%d readouts with other hits, %d/%d with other medians, %d/%d windows with other histograms" %
+              (name, check["hits"], check["n_readouts"], check["medians"], check["n_readouts"], check["hists"], check["n_windows"]))
+    check = report["check_framing"]
+    print("adaptive framing with %d masked pixels, batch analysis vs loop: %d/%d windows with other hitrates" % (check["n_masked"], check["hitrates"], check["n_windows"]))
+    print("%-34s %12s %12s %14s %10s %10s %10s" % ("benchmark", "frames/s", "readouts/s", "hits/s", "p50 [ms]", "p99 [ms]", "max [ms]"))
+    for result in report["results"]:
+        latency = result["latency_ms"]
+        print("%-34s %12s %12s %14s %10s %10s %10s" % (result["name"], format_value(result["frames_per_s"], "%.0f"), format_value(result["readouts_per_s"], "%.0f"),
+                                                       format_value(result["hits_per_s"], "%.0f"), format_value(latency["p50"], "%.3f"),
+                                                       format_value(latency["p99"], "%.3f"), format_value(latency["max"], "%.3f")))
+        if "mask_ns_per_hit" in result:
+            print("%-34s %.1f ns per hit" % ("  mask lookup", result["mask_ns_per_hit"]))
+
+
+if __name__ == "__main__":
+    usage = "Usage: %prog [options]"
+    description = "Throughput benchmarks of the online analysis with synthetic FE-I4 data."
+    parser = OptionParser(usage, description=description)
+    parser.add_option("-d", "--duration", type="float", default=10., help="seconds of generated data (default: %default)")
+    parser.add_option("-r", "--hit-rate", type="float", default=1e6, help="data records per second during a spill (default: %default)")
+    parser.add_option("-c", "--readouts-per-call", type="int", default=1, help="readouts per handle_data call (default: %default)")
+    parser.add_option("-w", "--workers", default="2", help="comma separated process counts of the parallel analysis (default: %default)")
+    parser.add_option("-f", "--front-ends", default="1,2,4", help="comma separated front end counts of the front end benchmark, empty to skip (default: %default)")
+    parser.add_option("-t", "--trigger-rate", type="float", default=0., help="trigger words per second, 0 for self trigger (default: %default)")
+    parser.add_option("-s", "--seed", type="int", default=0, help="random seed (default: %default)")
+    parser.add_option("-o", "--output", help="write the results as json into this file")
+    parser.add_option("--no-replay", action="store_false", dest="replay", default=True, help="skip the Replay benchmark (needs PyTables)")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("incorrect number of arguments")
+
+    report = run(duration=options.duration, hit_rate=options.hit_rate, readouts_per_call=options.readouts_per_call,
+                 workers=[int(n) for n in options.workers.split(",") if n], seed=options.seed, replay=options.replay,
+                 front_ends=[int(n) for n in options.front_ends.split(",") if n],
+                 trigger_rate=options.trigger_rate)
+    print_results(report)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,207 @@
+''' Detection latency and false alarms of the beam detectors on labelled replays.
+
+    The readouts of a scenario are generated with Fei4Generator, which
+    labels every readout with the beam state and the bursts. The readouts
+    are cut into integration windows (fixed framing) and every window is
+    given to a BeamState with the detector as in analyse_beam. Any other
+    readouts can be scored the same way with count_readouts() and labels
+    of their own (one beam and one burst flag per readout).
+
+    Scenarios:
+        spills:         spills of spill_length seconds with pauses
+        intensity_drop: the hit rate drops to a tenth after half of the run
+        bursts:         bursts of 4 times the hit rate during the spills
+        continuous:     beam without pause (no transitions, false alarms only)
+        pause_start:    the run starts in a pause, the beam state is on at
+                        the start of a run (the first beam on is not sent)
+
+    Scores of each event (beam on, beam off, hitrate peak):
+        latency:      seconds from the labelled transition (start of the
+                      burst) to the stop of the window with the event
+        missed:       transitions without event within max_latency
+        false alarms: events that do not belong to a transition
+    and the time of close_window and detect per window.
+'''
+import json
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+import batch_analysis
+import E3_control
+from beam_state import BeamState, EVENT_BEAM_ON, EVENT_BEAM_OFF, EVENT_HITRATE_PEAK
+from fei4_generator import Fei4Generator
+
+# segments of each scenario: fraction of the duration, factor of the hit rate, Fei4Generator arguments
+SCENARIOS = {
+    "spills": [(1., 1., {})],
+    "intensity_drop": [(0.5, 1., {}), (0.5, 0.1, {})],
+    "bursts": [(1., 1., {"burst_period": 7.3})],
+    "continuous": [(1., 1., {"spill_pause": 0.})],
+    "pause_start": [(0.05, 1., {"spill_length": 0.}), (0.95, 1., {})],
+    }
+# threshold_vars of each detector
+DETECTORS = {
+    "threshold": {"beam_detector": "threshold"},
+    "threshold_median": {"beam_detector": "threshold", "baseline_estimator": "median"},
+    "cusum": {"beam_detector": "cusum"},
+    }
+EVENTS = (("beam_on", EVENT_BEAM_ON), ("beam_off", EVENT_BEAM_OFF), ("hitrate_peak", EVENT_HITRATE_PEAK))
+
+
+def count_readouts(readouts):
+    ''' Timestamp start, timestamp stop and number of data records of each readout '''
+    counts = [(ro[1], ro[2], np.count_nonzero(batch_analysis.is_record(ro[0]))) for ro in readouts]
+    timestamp_start, timestamp_stop, hits = zip(*counts)
+    return np.array(timestamp_start), np.array(timestamp_stop), np.array(hits)
+
+
+def get_labelled_readouts(scenario, duration, hit_rate, seed=0):
+    ''' Timestamps, data records, beam and burst label of each readout of a scenario '''
+    timestamp_start, timestamp_stop, hits, beam, burst = [], [], [], [], []
+    segment_start = 0.
+    for i, (fraction, factor, kwargs) in enumerate(SCENARIOS[scenario]):
+        generator = Fei4Generator(hit_rate=hit_rate * factor, seed=seed + i, **kwargs)
+        counts = count_readouts(generator.readouts(duration * fraction, segment_start))
+        for values, segment_values in zip((timestamp_start, timestamp_stop, hits), counts):
+            values.append(segment_values)
+        beam.append([generator.beam_on(t - segment_start) for t in counts[0]])
+        burst.append([generator.burst(t - segment_start) for t in counts[0]])
+        segment_start += duration * fraction
+    return [np.concatenate(values) for values in (timestamp_start, timestamp_stop, hits)] + [np.concatenate(beam).astype(bool), np.concatenate(burst).astype(bool)]
+
+
+def replay_detector(threshold_vars, timestamp_start, timestamp_stop, hits):
+    ''' Events of the detector per integration window, returns the window stops, events and the time per window '''
+    window_stops = batch_analysis.get_window_stops(timestamp_start, timestamp_stop, None, threshold_vars["integration_time"])
+    state = BeamState(threshold_vars, hitrate_capacity=len(window_stops) + 1)
+    beam = True
+    stops, events, latencies = [], [], []
+    first = 0
+    for last in window_stops:
+        state.add_readout(timestamp_start[first], int(hits[first:last + 1].sum()))
+        start = time.time()
+        state.close_window(timestamp_stop[last])
+        baseline = state.baseline
+        window_events = 0
+        if baseline.n > threshold_vars["start_analyse_hitrate_len"] and baseline.sum > threshold_vars["start_analyse_hitrate_sum"]:
+            beam, window_events = state.detector.detect(beam)
+        latencies.append(time.time() - start)
+        stops.append(timestamp_stop[last])
+        events.append(window_events)
+        first = last + 1
+    return np.array(stops), np.array(events, dtype=np.int64), np.array(latencies)
+
+
+def get_transitions(timestamp_start, labels):
+    ''' Times of the rising and the falling edges of the labels and the end of the interval after each rising edge '''
+    changes = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    rising = changes[labels[changes]]
+    falling = changes[~labels[changes]]
+    ends = [timestamp_start[falling[falling > index][0]] if np.any(falling > index) else timestamp_start[-1] for index in rising]
+    return timestamp_start[rising], timestamp_start[falling], np.array(ends)
+
+
+def score(times, event_times, max_latency, intervals=None):
+    ''' Latencies of the first event after each transition time and the number of false alarms
+
+        With intervals (stop of each interval) every event between the
+        transition and the interval stop + max_latency belongs to it,
+        otherwise only the first one within max_latency.
+    '''
+    latencies = []
+    matched = np.zeros(event_times.shape[0], dtype=bool)
+    for i, t in enumerate(times):
+        stop = (intervals[i] if intervals is not None else t) + max_latency
+        in_window = (event_times >= t) & (event_times <= stop)
+        if not np.any(in_window):
+            continue
+        first = np.flatnonzero(in_window)[0]
+        latencies.append(event_times[first] - t)
+        if intervals is not None:
+            matched |= in_window
+        else:
+            matched[first] = True
+    return np.array(latencies), int(np.count_nonzero(~matched))
+
+
+def evaluate(scenario, detector, duration=120., hit_rate=1e5, max_latency=0.5, seed=0, readouts=None):
+    ''' Scores of detector on scenario, readouts are the labelled readouts of get_labelled_readouts (generated if None) '''
+    timestamp_start, timestamp_stop, hits, beam, burst = readouts or get_labelled_readouts(scenario, duration, hit_rate, seed)
+    threshold_vars = dict(E3_control.threshold_vars, **DETECTORS[detector])
+    stops, events, latencies = replay_detector(threshold_vars, timestamp_start, timestamp_stop, hits)
+    beam_on, beam_off, _ = get_transitions(timestamp_start, beam)
+    burst_start, _, burst_stop = get_transitions(timestamp_start, burst)
+    result = {
+        "scenario": scenario,
+        "detector": detector,
+        "n_windows": stops.shape[0],
+        "window_us": {"p50": float(np.percentile(latencies, 50)) * 1e6, "p99": float(np.percentile(latencies, 99)) * 1e6},
+        }
+    labelled = {"beam_on": (beam_on, None), "beam_off": (beam_off, None), "hitrate_peak": (burst_start, burst_stop)}
+    for name, event in EVENTS:
+        times, intervals = labelled[name]
+        detection_latencies, false_alarms = score(times, stops[(events & event) != 0], max_latency, intervals)
+        result[name] = {
+            "n": times.shape[0],
+            "detected": detection_latencies.shape[0],
+            "missed": times.shape[0] - detection_latencies.shape[0],
+            "false_alarms": false_alarms,
+            "latency_ms": {"mean": float(detection_latencies.mean()) * 1e3 if detection_latencies.shape[0] else None,
+                           "max": float(detection_latencies.max()) * 1e3 if detection_latencies.shape[0] else None},
+            }
+    return result
+
+
+def run(scenarios, detectors, duration=120., hit_rate=1e5, max_latency=0.5, seed=0):
+    results = []
+    for scenario in scenarios:
+        readouts = get_labelled_readouts(scenario, duration, hit_rate, seed)
+        for detector in detectors:
+            results.append(evaluate(scenario, detector, max_latency=max_latency, readouts=readouts))
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration": duration,
+        "hit_rate": hit_rate,
+        "max_latency": max_latency,
+        "integration_time": E3_control.threshold_vars["integration_time"],
+        "results": results,
+        }
+
+
+def print_results(report):
+    def format_value(value, fmt):
+        return "-" if value is None else fmt % value
+
+    print("%.0f s per scenario, %.0f records/s, max latency %.2f s" % (report["duration"], report["hit_rate"], report["max_latency"]))
+    print("%-16s %-18s %-14s %10s %8s %14s %14s %12s" % ("scenario", "detector", "event", "detected", "missed", "false alarms", "latency [ms]", "window [us]"))
+    for result in report["results"]:
+        for name, _ in EVENTS:
+            scores = result[name]
+            print("%-16s %-18s %-14s %10s %8d %14d %14s %12.1f" % (result["scenario"], result["detector"], name, "%d/%d" % (scores["detected"], scores["n"]),
+                                                                  scores["missed"], scores["false_alarms"], format_value(scores["latency_ms"]["mean"], "%.0f"),
+                                                                  result["window_us"]["p50"]))
+
+
+if __name__ == "__main__":
+    usage = "Usage: %prog [options]"
+    description = "Detection latency and false alarms of the beam detectors on generated labelled data."
+    parser = OptionParser(usage, description=description)
+    parser.add_option("-d", "--duration", type="float", default=120., help="seconds of generated data per scenario (default: %default)")
+    parser.add_option("-r", "--hit-rate", type="float", default=1e5, help="data records per second during a spill (default: %default)")
+    parser.add_option("-S", "--scenarios", default=",".join(sorted(SCENARIOS)), help="comma separated scenarios (default: %default)")
+    parser.add_option("-D", "--detectors", default="threshold,cusum", help="comma separated detectors of %s (default: %%default)" % ", ".join(sorted(DETECTORS)))
+    parser.add_option("-l", "--max-latency", type="float", default=0.5, help="seconds after a transition an event is counted as detection (default: %default)")
+    parser.add_option("-s", "--seed", type="int", default=0, help="random seed (default: %default)")
+    parser.add_option("-o", "--output", help="write the results as json into this file")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("incorrect number of arguments")
+
+    report = run([scenario for scenario in options.scenarios.split(",") if scenario], [detector for detector in options.detectors.split(",") if detector],
+                 duration=options.duration, hit_rate=options.hit_rate, max_latency=options.max_latency, seed=options.seed)
+    print_results(report)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
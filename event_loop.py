@@ -0,0 +1,223 @@
+''' Event loop of the slow control.
+
+    One zmq.Poller waits for messages on the registered sockets and for the
+    next timer, the callbacks run in the thread of the loop and must not
+    block. Scans run in the RunManager thread, the RunWatcher polls the
+    status of the current run with a timer of the loop and notifies its
+    callbacks if the run or its status changes. A ScanChain starts the scans
+    of a tuning one after the other on these notifications, so commands are
+    served while the tuning is running. Messages of other threads go through
+    a MessageQueue that is sent by a timer of the loop.
+'''
+import heapq
+import itertools
+import logging
+import time
+from Queue import Queue, Empty, Full
+
+import zmq
+
+
+class Timer(object):
+
+    def __init__(self, deadline, callback, args, interval=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    ''' Sockets and timers of one thread '''
+
+    def __init__(self):
+        self.poller = zmq.Poller()
+        self.handlers = {}
+        self.running = False
+        self._timers = []
+        self._counter = itertools.count()  # keeps the order of timers with the same deadline
+
+    def add_socket(self, socket, handler):
+        ''' handler(socket) is called if a message can be received on socket '''
+        self.handlers[socket] = handler
+        self.poller.register(socket, zmq.POLLIN)
+
+    def remove_socket(self, socket):
+        self.poller.unregister(socket)
+        del self.handlers[socket]
+
+    def _add_timer(self, timer):
+        heapq.heappush(self._timers, (timer.deadline, next(self._counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        ''' Call callback(*args) once after delay seconds '''
+        return self._add_timer(Timer(time.time() + delay, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        ''' Call callback(*args) every interval seconds '''
+        return self._add_timer(Timer(time.time() + interval, callback, args, interval))
+
+    def stop(self):
+        self.running = False
+
+    def _timeout(self):
+        ''' Milliseconds to the next timer, None without timers '''
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, int((self._timers[0][0] - time.time()) * 1e3) + 1)
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.deadline = max(timer.deadline + timer.interval, now)
+                self._add_timer(timer)
+            else:
+                timer.cancelled = True
+            self._call(timer.callback, *timer.args)
+
+    def _call(self, callback, *args):
+        # an exception in one callback must not stop the slow control
+        try:
+            callback(*args)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            logging.error("Error in slow control callback %s", getattr(callback, "__name__", callback), exc_info=True)
+
+    def run_once(self, timeout=None):
+        ''' Wait at most timeout seconds (default until the next timer) and handle the events '''
+        timers_timeout = self._timeout()
+        if timeout is not None:
+            timeout = int(timeout * 1e3) if timers_timeout is None else min(int(timeout * 1e3), timers_timeout)
+        else:
+            timeout = timers_timeout
+        for socket, _ in self.poller.poll(timeout):
+            self._call(self.handlers[socket], socket)
+        self._run_timers()
+
+    def run(self):
+        ''' Handle events until stop() is called '''
+        self.running = True
+        while self.running:
+            self.run_once()
+
+
+class MessageQueue(object):
+    ''' Messages of other threads for a socket of the loop
+
+        zmq sockets are not thread safe: send() only queues the message and
+        can be called from any thread, dispatch() sends the queued messages
+        in the thread of the loop. If maxsize messages are queued, new
+        messages are dropped and counted in n_dropped.
+    '''
+
+    def __init__(self, socket, maxsize=1000):
+        self.socket = socket
+        self.n_dropped = 0
+        self._messages = Queue(maxsize)
+
+    def send(self, msg):
+        try:
+            self._messages.put_nowait(msg)
+        except Full:
+            self.n_dropped += 1
+
+    def dispatch(self):
+        ''' Send the queued messages in the calling thread '''
+        while True:
+            try:
+                msg = self._messages.get_nowait()
+            except Empty:
+                return
+            self.socket.send(msg)
+
+
+class RunWatcher(object):
+    ''' Notifies callback(run_id, status) if the current run of the RunManager or its status changes
+
+        get_run() returns the current run (None without run). The RunManager
+        has no notification of its own, the status is polled every interval
+        seconds by a timer of the loop.
+    '''
+
+    def __init__(self, get_run, interval=0.05):
+        self.get_run = get_run
+        self.interval = interval
+        self.callbacks = []
+        self.run = None
+        self.status = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def start(self, loop):
+        return loop.call_every(self.interval, self.check)
+
+    def check(self):
+        run = self.get_run()
+        status = run.get_run_status() if run else None
+        if run is self.run and status == self.status:
+            return
+        self.run, self.status = run, status
+        run_id = run.run_id if run else None
+        for callback in self.callbacks:
+            callback(run_id, status)
+
+
+class ScanChain(object):
+    ''' Scans started one after the other, each one if the previous one is FINISHED
+
+        steps is a list of (message, scan, run_conf), message (if not None)
+        is sent when the scan is started. The chain ends after the last
+        scan, if a scan ends with another status or if it is cancelled.
+    '''
+
+    def __init__(self, runmngr, send, steps):
+        self.runmngr = runmngr
+        self.send = send
+        self.steps = list(steps)
+        self.run = None
+        self.active = True  # until the last scan ended or the chain is cancelled
+
+    def start(self):
+        self._next()
+
+    def _next(self):
+        message, scan, run_conf = self.steps.pop(0)
+        if message:
+            self.send(message)
+        self.runmngr.run_run(scan, run_conf=run_conf, use_thread=True)
+        self.run = self.runmngr.current_run
+
+    def on_run_state(self, run_id, status):
+        ''' Callback of the RunWatcher '''
+        run = self.runmngr.current_run
+        if not self.active or run is not self.run or status in (None, "RUNNING"):
+            return
+        if status != "FINISHED":
+            self.send("%s %s" % (run_id, status))
+            self.active = False
+            return
+        self.send("Scan finished: %s" % run_id)
+        if self.steps:
+            self._next()
+        else:
+            self.active = False
+
+    def cancel(self):
+        ''' Stop the chain and cancel its running scan '''
+        self.active = False
+        self.steps = []
+        if self.run is not None and self.run.get_run_status() == "RUNNING":
+            self.runmngr.cancel_current_run("STOP")
@@ -0,0 +1,137 @@
+''' Synthetic FE-I4 raw data for benchmarks and tests without beam.
+
+    Generates readouts (raw_data, timestamp_start, timestamp_stop, error)
+    like pyBAR's FIFO readout: events of a data header followed by data
+    records, optionally preceded by a trigger word. The beam spot is a 2d
+    gaussian, the beam is only on during the spills, optionally with
+    periodic bursts of a higher hit rate. Noisy pixels fire
+    independent of the beam. write_h5() stores the readouts with the
+    meta_data/raw_data layout of pyBAR raw data files that Replay reads.
+'''
+import numpy as np
+
+from batch_analysis import COL_SHIFT, ROW_SHIFT, TOT1_SHIFT, HIST_SHAPE
+
+DATA_HEADER = 0x00E90000
+TRIGGER_WORD = 0x80000000
+NO_HIT_TOT = 0xF
+
+META_DATA_DTYPE = np.dtype([("index_start", np.uint32), ("index_stop", np.uint32), ("data_length", np.uint32),
+                            ("timestamp_start", np.float64), ("timestamp_stop", np.float64), ("error", np.uint32)])
+
+
+class Fei4Generator(object):
+    ''' Generator of FE-I4 readouts
+
+        hit_rate:          data records per second of the beam during a spill
+        beam_col/row:      beam spot position in pixels, beam_sigma_col/row its width
+        spill_length:      seconds beam on, spill_pause seconds beam off (0 for a continuous beam)
+        burst_period:      seconds between the starts of two bursts (0 without bursts), a burst
+                           is burst_length seconds long with burst_factor times the hit rate
+        noisy_pixels:      number of noisy pixels firing with noise_rate records per second each
+        trigger_rate:      trigger words per second (0 for self trigger), one event per trigger
+        records_per_event: mean number of data records of one event without triggers
+        readout_interval:  seconds per readout
+        edge_hits:         second hits of the records in the last row (row 337, outside of the histogram)
+    '''
+
+    def __init__(self, hit_rate=1e6, beam_col=40., beam_row=168., beam_sigma_col=4., beam_sigma_row=20.,
+                 spill_length=4., spill_pause=1., noisy_pixels=5, noise_rate=100., trigger_rate=0.,
+                 records_per_event=4., readout_interval=0.01, burst_period=0., burst_length=0.2, burst_factor=4., edge_hits=False, seed=None):
+        self.hit_rate = hit_rate
+        self.beam_col = beam_col
+        self.beam_row = beam_row
+        self.beam_sigma_col = beam_sigma_col
+        self.beam_sigma_row = beam_sigma_row
+        self.spill_length = spill_length
+        self.spill_pause = spill_pause
+        self.burst_period = burst_period
+        self.burst_length = burst_length
+        self.burst_factor = burst_factor
+        self.noise_rate = noise_rate
+        self.trigger_rate = trigger_rate
+        self.records_per_event = records_per_event
+        self.readout_interval = readout_interval
+        self.edge_hits = edge_hits
+        self.rng = np.random.RandomState(seed)
+        self.noisy_col = self.rng.randint(1, HIST_SHAPE[0], noisy_pixels)
+        self.noisy_row = self.rng.randint(1, HIST_SHAPE[1], noisy_pixels)
+        self.trigger_number = 0
+        self.n_records = 0
+
+    def beam_on(self, timestamp):
+        if not self.spill_pause:
+            return True
+        return timestamp % (self.spill_length + self.spill_pause) < self.spill_length
+
+    def burst(self, timestamp):
+        ''' True during a burst, there are only bursts while the beam is on '''
+        return bool(self.burst_period) and self.beam_on(timestamp) and timestamp % self.burst_period < self.burst_length
+
+    def _records(self, duration, beam_on, burst=False):
+        ''' Data records (uint32) of one readout '''
+        hit_rate = self.hit_rate * self.burst_factor if burst else self.hit_rate
+        n_beam = self.rng.poisson(hit_rate * duration) if beam_on else 0
+        col = np.rint(self.rng.normal(self.beam_col, self.beam_sigma_col, n_beam))
+        row = np.rint(self.rng.normal(self.beam_row, self.beam_sigma_row, n_beam))
+        n_noise = self.rng.poisson(self.noise_rate * duration, self.noisy_col.shape[0])
+        col = np.clip(np.concatenate((col, np.repeat(self.noisy_col, n_noise))), 1, HIST_SHAPE[0] - 1).astype(np.uint32)
+        row = np.clip(np.concatenate((row, np.repeat(self.noisy_row, n_noise))), 1, HIST_SHAPE[1] - 1).astype(np.uint32)
+        n_records = col.shape[0]
+        tot1 = self.rng.randint(0, 14, n_records).astype(np.uint32)
+        # about a third of the records also has a hit in the next row
+        tot2 = np.where(self.rng.rand(n_records) < 0.3, self.rng.randint(0, 14, n_records), NO_HIT_TOT).astype(np.uint32)
+        if not self.edge_hits:
+            tot2[row == HIST_SHAPE[1] - 1] = NO_HIT_TOT
+        order = self.rng.permutation(n_records)
+        self.n_records += n_records
+        return ((col << COL_SHIFT) | (row << ROW_SHIFT) | (tot1 << TOT1_SHIFT) | tot2)[order]
+
+    def _events(self, records, duration):
+        ''' Split the records into events with a data header (and trigger word) each '''
+        if self.trigger_rate:
+            n_events = self.rng.poisson(self.trigger_rate * duration)
+        else:
+            n_events = int(np.ceil(records.shape[0] / float(self.records_per_event)))
+        if not n_events:
+            return records
+        # event i starts at records[cuts[i]]
+        cuts = np.sort(self.rng.randint(0, records.shape[0] + 1, n_events))
+        cuts[0] = 0
+        bcid = self.rng.randint(0, 1 << 10, n_events).astype(np.uint32)
+        words = [DATA_HEADER | bcid]
+        if self.trigger_rate:
+            trigger_number = (self.trigger_number + np.arange(n_events)) & 0x7FFFFFFF
+            self.trigger_number += n_events
+            words.insert(0, TRIGGER_WORD | trigger_number.astype(np.uint32))
+        n_words = len(words)
+        raw_data = np.insert(records, np.repeat(cuts, n_words), np.column_stack(words).ravel())
+        return raw_data.astype(np.uint32)
+
+    def readouts(self, duration, timestamp_start=0.):
+        ''' Yield the readouts (raw_data, timestamp_start, timestamp_stop, error) of duration seconds '''
+        n_readouts = int(round(duration / self.readout_interval))
+        for i in range(n_readouts):
+            t_start = timestamp_start + i * self.readout_interval
+            records = self._records(self.readout_interval, self.beam_on(t_start - timestamp_start), self.burst(t_start - timestamp_start))
+            yield self._events(records, self.readout_interval), t_start, t_start + self.readout_interval, 0
+
+    def write_h5(self, filename, duration, timestamp_start=0.):
+        ''' Write duration seconds of readouts into a raw data file, returns the number of readouts '''
+        import tables as tb
+        with tb.open_file(filename, mode="w") as out_file_h5:
+            raw_data = out_file_h5.create_earray(out_file_h5.root, name="raw_data", atom=tb.UInt32Atom(), shape=(0, ),
+                                                 filters=tb.Filters(complib="blosc", complevel=5))
+            meta_data = out_file_h5.create_table(out_file_h5.root, name="meta_data", description=META_DATA_DTYPE,
+                                                 filters=tb.Filters(complib="blosc", complevel=5))
+            n_readouts = 0
+            for ro in self.readouts(duration, timestamp_start):
+                row = np.zeros(1, dtype=META_DATA_DTYPE)
+                row["index_start"] = raw_data.nrows
+                row["index_stop"] = raw_data.nrows + ro[0].shape[0]
+                row["data_length"] = ro[0].shape[0]
+                row["timestamp_start"], row["timestamp_stop"], row["error"] = ro[1:]
+                raw_data.append(ro[0])
+                meta_data.append(row)
+                n_readouts += 1
+        return n_readouts
@@ -0,0 +1,120 @@
+''' Analysis of several FE-I4 front ends read out in one run.
+
+    pyBAR calls handle_data with one list of readouts per front end. Each
+    front end has its own FrontEnd: beam state, occupancy histogram, beam
+    spot and the publishing of its hit maps on front_end_topic(index). The
+    windows, alarms and hit maps of a front end do not depend on the others.
+
+    CombinedView sums the windows of all front ends over interval seconds:
+    the hit maps are stitched side by side (front end k in the columns
+    k * 81 ... k * 81 + 80) and sent on COMBINED_TOPIC, followed by a summary
+    message with the summed hitrate and the centroid of the stitched map.
+'''
+import struct
+
+import numpy as np
+
+from hist_streams import get_centroid
+from hist_transport import COMBINED_TOPIC
+
+SUMMARY_TOPIC = b"E3CS"
+# topic, frame number, timestamp start/stop, number of front ends, summed hitrate,
+# number of hits, mean and standard deviation of column and row of the stitched map
+SUMMARY = struct.Struct("<4sIddHdQdddd")
+
+
+class FrontEnd(object):
+    ''' Analysis state of one front end, message_prefix is put in front of its slow control messages
+
+        The masked pixels are the mask of hit_histogram, they are kept by reset().
+    '''
+
+    def __init__(self, index, state, hit_histogram, beam_spot, publish_scheduler, noisy_pixels, message_prefix=""):
+        self.index = index
+        self.state = state
+        self.hit_histogram = hit_histogram
+        self.beam_spot = beam_spot
+        self.publish_scheduler = publish_scheduler
+        self.noisy_pixels = noisy_pixels
+        self.message_prefix = message_prefix
+
+    @property
+    def pixel_mask(self):
+        return self.hit_histogram.mask
+
+    def reset(self):
+        self.state.reset()
+        self.hit_histogram.reset()
+        self.publish_scheduler.reset()
+        self.beam_spot.reset()
+        self.noisy_pixels.reset()
+
+
+class CombinedView(object):
+    ''' Stitched hit map, summed hitrate and centroid of all front ends
+
+        The windows are summed into frames of a fixed time grid (window
+        stop // interval). The front ends are analysed one after the other,
+        so a frame is sent once every front end has a window after it (or
+        when more than max_frames frames are open). publisher is a
+        HistPublisher with topic COMBINED_TOPIC, socket gets the summary
+        messages. Nothing is accumulated without subscriber.
+    '''
+
+    def __init__(self, n_front_ends, publisher, socket, interval=0.1, shape=(81, 337), max_frames=100):
+        self.n_front_ends = n_front_ends
+        self.publisher = publisher
+        self.socket = socket
+        self.interval = interval
+        self.shape = shape
+        self.max_frames = max_frames
+        self.frame_number = 0
+        self.reset()
+
+    def reset(self):
+        self.frames = {}  # grid index: [hist_occ, n_records, timestamp_start, timestamp_stop]
+        self.timestamp_stop = [None] * self.n_front_ends  # of the last window of each front end
+
+    def subscribed(self):
+        return any(subscription and (COMBINED_TOPIC.startswith(subscription) or SUMMARY_TOPIC.startswith(subscription))
+                   for subscription in self.publisher.topics)
+
+    def add(self, index, hist_occ, timestamp_start, timestamp_stop, hitrate):
+        ''' Add the window of front end index (hist_occ None without hits) '''
+        self.publisher.update_subscriptions()
+        if not self.subscribed():
+            if self.frames:
+                self.reset()
+            return
+        grid_index = int(timestamp_stop // self.interval) if self.interval else timestamp_stop
+        frame = self.frames.get(grid_index)
+        if frame is None:
+            frame = self.frames[grid_index] = [np.zeros((self.n_front_ends * self.shape[0], self.shape[1]), dtype=np.uint32), 0., timestamp_start, timestamp_stop]
+        if hist_occ is not None:
+            frame[0][index * self.shape[0]:(index + 1) * self.shape[0]] += hist_occ
+        frame[1] += hitrate * (timestamp_stop - timestamp_start)
+        frame[2], frame[3] = min(frame[2], timestamp_start), max(frame[3], timestamp_stop)
+        self.timestamp_stop[index] = timestamp_stop
+        if None not in self.timestamp_stop:
+            complete = min(self.timestamp_stop)
+            complete = int(complete // self.interval) if self.interval else complete
+            for grid_index in sorted(self.frames):
+                if grid_index < complete or len(self.frames) > self.max_frames:
+                    self.send(self.frames.pop(grid_index))
+        elif len(self.frames) > self.max_frames:
+            self.send(self.frames.pop(min(self.frames)))
+
+    def send(self, frame):
+        ''' Send the stitched map and the summary of a frame '''
+        hist_occ, n_records, timestamp_start, timestamp_stop = frame
+        length = timestamp_stop - timestamp_start
+        self.publisher.send(hist_occ, timestamp_start, timestamp_stop)
+        self.socket.send(SUMMARY.pack(SUMMARY_TOPIC, self.frame_number, timestamp_start, timestamp_stop, self.n_front_ends,
+                                      n_records / length if length else 0., *get_centroid(hist_occ)))
+        self.frame_number += 1
+
+
+def decode_summary(msg):
+    ''' Returns frame number, timestamp start/stop, number of front ends, summed hitrate, (n_hits, mean column, mean row, std column, std row) '''
+    values = SUMMARY.unpack(msg)
+    return values[1], values[2], values[3], values[4], values[5], values[6:]
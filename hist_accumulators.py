@@ -0,0 +1,187 @@
+''' Occupancy maps integrated over more than one window.
+
+    The hit map of a window only has the hits of the last integration time,
+    which is very noisy at low intensity. AccumulatedMaps keeps three maps
+    next to it, each updated with the hit pixels of every window only (no
+    sum over the history):
+
+        SLIDING_TOPIC: sum of the last n_frames windows, the oldest window
+                       is subtracted when a new one is added
+        DECAYING_TOPIC: exponentially decaying map with time constant tau,
+                        the decay is kept in one scale factor
+        CUMULATIVE_TOPIC: all windows of the run
+
+    Each map is a stream of its own, sent on the stream socket every
+    interval seconds while a client subscribed to its topic (clients that
+    subscribed to everything get it too, the old hit map clients have a
+    socket of their own). The message is the header of hist_streams
+    followed by the map (dtype of DTYPES).
+'''
+from collections import deque
+
+import numpy as np
+
+from batch_analysis import HIST_SHAPE
+from hist_streams import HEADER
+
+SLIDING_TOPIC = b"E3SW"
+DECAYING_TOPIC = b"E3DC"
+CUMULATIVE_TOPIC = b"E3CU"
+DTYPES = {SLIDING_TOPIC: np.uint32, DECAYING_TOPIC: np.float32, CUMULATIVE_TOPIC: np.uint64}
+
+
+def get_hit_pixels(hist_occ):
+    ''' Flat index and count of the pixels with hits '''
+    if hist_occ is None:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.uint32)
+    indices = np.flatnonzero(hist_occ)
+    return indices, hist_occ.ravel()[indices]
+
+
+class SlidingMap(object):
+    ''' Sum of the last n_frames windows '''
+
+    def __init__(self, n_frames=20, shape=HIST_SHAPE):
+        self.n_frames = n_frames
+        self.shape = shape
+        self.reset()
+
+    def reset(self):
+        self.hist_occ = np.zeros(self.shape, dtype=np.uint32)
+        self.frames = deque()  # hit pixels and timestamp start of each window
+        self.timestamp_start = None
+        self.timestamp_stop = None
+
+    def add(self, indices, counts, timestamp_start, timestamp_stop):
+        if len(self.frames) >= self.n_frames:
+            old_indices, old_counts, _ = self.frames.popleft()
+            self.hist_occ.ravel()[old_indices] -= old_counts
+        self.hist_occ.ravel()[indices] += counts
+        self.frames.append((indices, counts, timestamp_start))
+        self.timestamp_start = self.frames[0][2]
+        self.timestamp_stop = timestamp_stop
+
+    def get(self):
+        return self.hist_occ
+
+
+class DecayingMap(object):
+    ''' Hits weighted with exp(-age / tau), age in seconds since the stop of the last window
+
+        The map is stored divided by the decay since the first window, a new
+        window only scales the factor. The map is rescaled when the factor
+        gets small.
+    '''
+
+    def __init__(self, tau=1., shape=HIST_SHAPE):
+        self.tau = tau
+        self.shape = shape
+        self.reset()
+
+    def reset(self):
+        self.hist_occ = np.zeros(self.shape, dtype=np.float64)
+        self.scale = 1.
+        self.timestamp_start = None
+        self.timestamp_stop = None
+
+    def add(self, indices, counts, timestamp_start, timestamp_stop):
+        if self.timestamp_stop is None:
+            self.timestamp_start = timestamp_start
+        else:
+            self.scale *= np.exp(-max(timestamp_stop - self.timestamp_stop, 0.) / self.tau)
+        if self.scale < 1e-100:
+            self.hist_occ *= self.scale
+            self.scale = 1.
+        self.hist_occ.ravel()[indices] += counts / self.scale
+        self.timestamp_stop = timestamp_stop
+
+    def get(self):
+        return (self.hist_occ * self.scale).astype(np.float32)
+
+
+class CumulativeMap(object):
+    ''' Sum of all windows since the last reset '''
+
+    def __init__(self, shape=HIST_SHAPE):
+        self.shape = shape
+        self.reset()
+
+    def reset(self):
+        self.hist_occ = np.zeros(self.shape, dtype=np.uint64)
+        self.timestamp_start = None
+        self.timestamp_stop = None
+
+    def add(self, indices, counts, timestamp_start, timestamp_stop):
+        if self.timestamp_start is None:
+            self.timestamp_start = timestamp_start
+        self.hist_occ.ravel()[indices] += counts
+        self.timestamp_stop = timestamp_stop
+
+    def get(self):
+        return self.hist_occ
+
+
+class AccumulatedMaps(object):
+    ''' Sliding, decaying and cumulative map, sent on socket to the subscribers of their topic
+
+        subscriptions is the HistPublisher of the socket, intervals maps the
+        stream name ("sliding", "decaying", "cumulative") to the send interval.
+    '''
+
+    def __init__(self, socket, subscriptions, intervals, n_frames=20, tau=1., shape=HIST_SHAPE):
+        self.socket = socket
+        self.subscriptions = subscriptions
+        self.maps = [(SLIDING_TOPIC, SlidingMap(n_frames, shape), intervals.get("sliding", 0.5)),
+                     (DECAYING_TOPIC, DecayingMap(tau, shape), intervals.get("decaying", 0.5)),
+                     (CUMULATIVE_TOPIC, CumulativeMap(shape), intervals.get("cumulative", 1.))]
+        self.frame_number = dict((topic, 0) for topic, _, _ in self.maps)
+        self.last_send = dict((topic, None) for topic, _, _ in self.maps)
+
+    @property
+    def sliding(self):
+        return self.maps[0][1]
+
+    @property
+    def decaying(self):
+        return self.maps[1][1]
+
+    @property
+    def cumulative(self):
+        return self.maps[2][1]
+
+    def reset(self):
+        for topic, accumulator, _ in self.maps:
+            accumulator.reset()
+            self.last_send[topic] = None
+
+    def subscribed(self, topic):
+        return any(subscription and topic.startswith(subscription) for subscription in self.subscriptions.topics)
+
+    def add(self, hist_occ, timestamp_start, timestamp_stop):
+        ''' Add the histogram of one window (None without hits) and send the maps that are due '''
+        indices, counts = get_hit_pixels(hist_occ)
+        for _, accumulator, _ in self.maps:
+            accumulator.add(indices, counts, timestamp_start, timestamp_stop)
+        self.subscriptions.update_subscriptions()
+        for topic, accumulator, interval in self.maps:
+            if not self.subscribed(topic):
+                continue
+            last_send = self.last_send[topic]
+            if last_send is None or timestamp_stop - last_send >= interval:
+                self.send(topic, accumulator)
+                self.last_send[topic] = timestamp_stop
+
+    def send(self, topic, accumulator):
+        hist_occ = accumulator.get()
+        header = HEADER.pack(topic, self.frame_number[topic], accumulator.timestamp_start, accumulator.timestamp_stop, hist_occ.shape[0], hist_occ.shape[1])
+        self.frame_number[topic] += 1
+        self.socket.send(header + hist_occ.tobytes())
+
+
+def decode(msg):
+    ''' Returns topic, frame number, timestamp start, timestamp stop and the map of an accumulated map message '''
+    topic, frame_number, timestamp_start, timestamp_stop, n_col, n_row = HEADER.unpack_from(msg)
+    if topic not in DTYPES:
+        raise ValueError("Unknown map topic %r" % topic)
+    hist_occ = np.frombuffer(msg, dtype=DTYPES[topic], count=n_col * n_row, offset=HEADER.size).reshape((n_col, n_row))
+    return topic, frame_number, timestamp_start, timestamp_stop, hist_occ
@@ -0,0 +1,179 @@
+''' Sparse binary wire format for the occupancy histogram PUB stream.
+
+    A frame is a fixed size header followed by a compressed payload with only
+    the non-zero pixels: the gaps between their flat indices (uint16, the
+    81 x 337 histogram has less than 2^16 pixels) and their counts. Delta
+    frames carry the (signed) difference to the previous frame instead,
+    every keyframe_interval-th frame is a full frame.
+
+    Header (little endian):
+        magic, version, flags, codec, frame number, timestamp start/stop,
+        histogram shape, number of pixels, uncompressed payload size
+
+    No pickle is involved, so frames from the network can be decoded safely.
+    Frames without the magic are the old zlib compressed pickles.
+'''
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+MAGIC = b"E3HM"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBxIddHHII")
+
+FLAG_DELTA = 0x01
+FLAG_COUNT32 = 0x02
+
+CODEC_NONE, CODEC_ZLIB, CODEC_LZ4, CODEC_ZSTD = 0, 1, 2, 3
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lz4": CODEC_LZ4, "zstd": CODEC_ZSTD}
+
+FrameHeader = namedtuple("FrameHeader", ["version", "flags", "codec", "frame_number", "timestamp_start", "timestamp_stop", "shape", "n_pixels"])
+
+
+def default_codec():
+    if zstandard is not None:
+        return "zstd"
+    if lz4 is not None:
+        return "lz4"
+    return "zlib"
+
+
+def is_frame(msg):
+    return msg[:len(MAGIC)] == MAGIC
+
+
+def is_delta(msg):
+    return is_frame(msg) and bool(HEADER.unpack_from(msg)[2] & FLAG_DELTA)
+
+
+def _compress(codec, data):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    if codec == CODEC_LZ4:
+        return lz4.block.compress(data, store_size=False)
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 1)
+    return data
+
+
+def _decompress(codec, data, size):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to decode this frame")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    if codec == CODEC_LZ4:
+        if lz4 is None:
+            raise RuntimeError("lz4 is needed to decode this frame")
+        return lz4.block.decompress(data, uncompressed_size=size)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+
+class HistEncoder(object):
+    ''' Encodes occupancy histograms into frames and measures size and encode time '''
+
+    def __init__(self, shape=(81, 337), codec=None, delta=False, keyframe_interval=100):
+        self.shape = shape
+        self.codec = CODECS[codec or default_codec()]
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.frame_number = 0
+        self._previous = None
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.encode_time = 0.
+
+    def encode(self, hist_occ, timestamp_start=0., timestamp_stop=0.):
+        ''' hist_occ can be None for a window without hits '''
+        start = time.time()
+        if hist_occ is None:
+            hist_occ = np.zeros(self.shape, dtype=np.uint32)
+        current = hist_occ.ravel()
+        flags = 0
+        if self.delta and self._previous is not None and self.frame_number % self.keyframe_interval:
+            flags |= FLAG_DELTA
+            values = current.astype(np.int64) - self._previous
+            counts_dtype = np.int32
+        else:
+            values = current
+            counts_dtype = np.uint16
+            if values.shape[0] and values.max() > np.iinfo(np.uint16).max:
+                flags |= FLAG_COUNT32
+                counts_dtype = np.uint32
+        if self.delta:
+            self._previous = current.astype(np.int64)
+        index = np.flatnonzero(values)
+        gaps = np.diff(index, prepend=0) if index.shape[0] else index
+        payload = gaps.astype(np.uint16).tobytes() + values[index].astype(counts_dtype).tobytes()
+        msg = HEADER.pack(MAGIC, VERSION, flags, self.codec, self.frame_number, timestamp_start, timestamp_stop,
+                          self.shape[0], self.shape[1], index.shape[0], len(payload)) + _compress(self.codec, payload)
+        self.frame_number += 1
+        self.n_frames += 1
+        self.n_bytes += len(msg)
+        self.encode_time += time.time() - start
+        return msg
+
+    def summary(self):
+        if not self.n_frames:
+            return "hit map: no frames sent"
+        return "hit map: %.0f bytes/frame, encode %.3f ms/frame" % (self.n_bytes / float(self.n_frames), self.encode_time / self.n_frames * 1e3)
+
+
+class HistDecoder(object):
+    ''' Decodes frames into occupancy histograms and measures the decode time '''
+
+    def __init__(self):
+        self._previous = None
+        self._frame_number = None
+        self.n_frames = 0
+        self.decode_time = 0.
+
+    def decode(self, msg):
+        ''' Returns the FrameHeader and the histogram
+
+            The histogram is None for a delta frame if the previous frame was missed.
+        '''
+        start = time.time()
+        _, version, flags, codec, frame_number, timestamp_start, timestamp_stop, n_col, n_row, n_pixels, payload_size = HEADER.unpack_from(msg)
+        if version > VERSION:
+            raise ValueError("Unsupported hit map frame version %d" % version)
+        header = FrameHeader(version, flags, codec, frame_number, timestamp_start, timestamp_stop, (n_col, n_row), n_pixels)
+        payload = _decompress(codec, msg[HEADER.size:], payload_size)
+        index = np.cumsum(np.frombuffer(payload, dtype=np.uint16, count=n_pixels), dtype=np.int64)
+        if flags & FLAG_DELTA:
+            counts_dtype = np.int32
+        elif flags & FLAG_COUNT32:
+            counts_dtype = np.uint32
+        else:
+            counts_dtype = np.uint16
+        counts = np.frombuffer(payload, dtype=counts_dtype, count=n_pixels, offset=2 * n_pixels)
+
+        if flags & FLAG_DELTA:
+            if self._previous is None or self._frame_number != frame_number - 1:
+                hist = None
+            else:
+                hist = self._previous.copy()
+                hist[index] += counts
+        else:
+            hist = np.zeros(n_col * n_row, dtype=np.int64)
+            hist[index] = counts
+        self._previous = hist
+        self._frame_number = frame_number
+        self.n_frames += 1
+        self.decode_time += time.time() - start
+        if hist is None:
+            return header, None
+        return header, hist.astype(np.uint32).reshape(header.shape)
@@ -0,0 +1,125 @@
+''' Compact streams calculated from the accumulated occupancy histogram.
+
+    Next to the full hit map the stream socket carries small messages for
+    clients that only need the beam position and profile. Each message
+    starts with its topic, so SUB clients subscribe only to what they need:
+
+        PROJECTION_TOPIC: column and row projection (uint32)
+        BINNED_TOPIC + factor: hit map binned factor x factor (uint32)
+        CENTROID_TOPIC: number of hits, mean and standard deviation of column and row
+
+    A stream is only calculated and sent while a client subscribed to its
+    topic. PUB prefix matching also delivers it to the clients of the
+    socket that subscribed to everything, so the streams are not sent on
+    the socket of the old hit map clients (see hist_transport).
+
+    Header (little endian): topic, frame number, timestamp start/stop,
+    shape of the payload. The centroid message has the scalars instead of
+    the shape.
+'''
+import struct
+
+import numpy as np
+
+PROJECTION_TOPIC = b"E3PJ"
+BINNED_TOPIC = b"E3B"  # + str(factor), e.g. E3B2
+CENTROID_TOPIC = b"E3CT"
+HEADER = struct.Struct("<4sIddHH")
+CENTROID = struct.Struct("<4sIddQdddd")
+
+
+def binned_topic(factor):
+    return BINNED_TOPIC + str(factor).encode("ascii")
+
+
+def get_projections(hist_occ):
+    ''' Hits per column and per row '''
+    return hist_occ.sum(axis=1, dtype=np.uint32), hist_occ.sum(axis=0, dtype=np.uint32)
+
+
+def get_binned(hist_occ, factor):
+    ''' Sum of factor x factor pixels, the last bins are padded with zeros '''
+    n_col, n_row = -(-hist_occ.shape[0] // factor), -(-hist_occ.shape[1] // factor)
+    padded = np.zeros((n_col * factor, n_row * factor), dtype=np.uint32)
+    padded[:hist_occ.shape[0], :hist_occ.shape[1]] = hist_occ
+    return padded.reshape(n_col, factor, n_row, factor).sum(axis=(1, 3), dtype=np.uint32)
+
+
+def get_centroid(hist_occ):
+    ''' Number of hits, mean and standard deviation of column and row (NaN without hits) '''
+    col_projection, row_projection = get_projections(hist_occ)
+    n_hits = int(col_projection.sum())
+    if not n_hits:
+        return 0, np.nan, np.nan, np.nan, np.nan
+    col, row = np.arange(col_projection.shape[0]), np.arange(row_projection.shape[0])
+    mean_col = np.dot(col, col_projection) / float(n_hits)
+    mean_row = np.dot(row, row_projection) / float(n_hits)
+    std_col = np.sqrt(np.dot((col - mean_col) ** 2, col_projection) / n_hits)
+    std_row = np.sqrt(np.dot((row - mean_row) ** 2, row_projection) / n_hits)
+    return n_hits, mean_col, mean_row, std_col, std_row
+
+
+class StreamPublisher(object):
+    ''' Sends the compact streams of a histogram on a PUB socket '''
+
+    def __init__(self, socket, shape=(81, 337)):
+        self.socket = socket
+        self.shape = shape
+        self.frame_number = {}
+
+    def _next_frame_number(self, topic):
+        frame_number = self.frame_number.get(topic, 0)
+        self.frame_number[topic] = frame_number + 1
+        return frame_number
+
+    def _hist(self, hist_occ):
+        return np.zeros(self.shape, dtype=np.uint32) if hist_occ is None else hist_occ
+
+    def send_projections(self, hist_occ, timestamp_start, timestamp_stop):
+        col_projection, row_projection = get_projections(self._hist(hist_occ))
+        header = HEADER.pack(PROJECTION_TOPIC, self._next_frame_number(PROJECTION_TOPIC), timestamp_start, timestamp_stop,
+                             col_projection.shape[0], row_projection.shape[0])
+        self.socket.send(header + col_projection.tobytes() + row_projection.tobytes())
+        return False
+
+    def send_binned(self, hist_occ, timestamp_start, timestamp_stop, factor):
+        binned = get_binned(self._hist(hist_occ), factor)
+        topic = binned_topic(factor)
+        header = HEADER.pack(topic, self._next_frame_number(topic), timestamp_start, timestamp_stop, binned.shape[0], binned.shape[1])
+        self.socket.send(header + binned.tobytes())
+        return False
+
+    def send_centroid(self, hist_occ, timestamp_start, timestamp_stop):
+        self.socket.send(CENTROID.pack(CENTROID_TOPIC, self._next_frame_number(CENTROID_TOPIC), timestamp_start, timestamp_stop,
+                                       *get_centroid(self._hist(hist_occ))))
+        return False
+
+    def add_streams(self, scheduler, intervals, binning=(2, 4)):
+        ''' Register the streams with a PublishScheduler, intervals maps stream name to accumulation time '''
+        scheduler.add_stream("projection", self.send_projections, intervals.get("projection", 0.), (PROJECTION_TOPIC, ), subscribe_all=False)
+        for factor in binning:
+            name = "binned_%d" % factor
+            send = lambda hist_occ, timestamp_start, timestamp_stop, factor=factor: self.send_binned(hist_occ, timestamp_start, timestamp_stop, factor)
+            scheduler.add_stream(name, send, intervals.get(name, 0.), (binned_topic(factor), ), subscribe_all=False)
+        scheduler.add_stream("centroid", self.send_centroid, intervals.get("centroid", 0.), (CENTROID_TOPIC, ), subscribe_all=False)
+
+
+def decode(msg):
+    ''' Returns topic, frame number, timestamp start, timestamp stop and the data of a compact stream message
+
+        The data is (column projection, row projection), the binned map or
+        (n_hits, mean column, mean row, std column, std row).
+    '''
+    topic = msg[:4]
+    if topic == CENTROID_TOPIC:
+        values = CENTROID.unpack(msg)
+        return values[0], values[1], values[2], values[3], values[4:]
+    topic, frame_number, timestamp_start, timestamp_stop, n_0, n_1 = HEADER.unpack_from(msg)
+    if topic == PROJECTION_TOPIC:
+        data = (np.frombuffer(msg, dtype=np.uint32, count=n_0, offset=HEADER.size),
+                np.frombuffer(msg, dtype=np.uint32, count=n_1, offset=HEADER.size + 4 * n_0))
+    elif topic.startswith(BINNED_TOPIC):
+        data = np.frombuffer(msg, dtype=np.uint32, count=n_0 * n_1, offset=HEADER.size).reshape((n_0, n_1))
+    else:
+        raise ValueError("Unknown stream topic %r" % topic)
+    return topic, frame_number, timestamp_start, timestamp_stop, data
@@ -0,0 +1,185 @@
+''' Transport of the occupancy histograms over the hit map sockets.
+
+    Old monitors subscribe to everything (empty topic) and can only decode
+    the zlib compressed pickle. With PUB prefix matching they would get
+    every message of the socket, so they have a socket of their own
+    (conf["port_hit_map"]) that only carries the pickle frames. The new
+    formats are sent on the stream socket (conf["port_streams"]), an XPUB
+    socket on which the sender sees which topics the monitors subscribed
+    to. Monitors that understand the raw transport subscribe to RAW_TOPIC
+    (which contains the raw format version) and to the prefixes of the
+    single part formats. The raw transport is only used while all monitors
+    of the socket support it:
+
+        raw:    [header with dtype, shape, frame number, timestamps, histogram buffer]
+                The buffer is sent with copy=False and rebuilt with np.frombuffer.
+        sparse: one hist_codec frame
+        pickle: one zlib compressed pickle (old format)
+
+    With several front ends the hit maps of each front end and the stitched
+    map of all front ends are sent with a topic frame in front
+    (front_end_topic(index), COMBINED_TOPIC). Only monitors that subscribed
+    to these topics get them, in the raw format.
+'''
+import struct
+import time
+import zlib
+
+import cPickle as pickle
+import numpy as np
+import zmq
+
+import hist_codec
+
+RAW_VERSION = 1
+RAW_TOPIC = b"E3HR" + struct.pack("B", RAW_VERSION)
+RAW_HEADER = struct.Struct("<5s8sHHIdd")
+PICKLE_TOPIC = b"\x78"  # zlib streams start with 0x78
+RECV_TOPICS = (RAW_TOPIC, hist_codec.MAGIC)
+HIT_MAP_TOPICS = RECV_TOPICS + (PICKLE_TOPIC, )  # all formats, the pickle only for receivers with allow_pickle
+FRONT_END_TOPIC = b"E3FE"  # + two digit index
+COMBINED_TOPIC = b"E3FECB"
+
+
+def front_end_topic(index):
+    return FRONT_END_TOPIC + ("%02d" % index).encode("ascii")
+
+
+class HistPublisher(object):
+    ''' Sends histograms in the best format all subscribers understand '''
+
+    def __init__(self, socket, encoder, hist_format="sparse", raw=True, metrics=None, topic=None, subscriptions=None):
+        self.socket = socket
+        self.encoder = encoder
+        self.hist_format = hist_format
+        self.raw = raw
+        self.metrics = metrics  # times the encode and send stages if enabled
+        self.topic = topic  # topic frame in front of each histogram
+        self.subscriptions = subscriptions  # HistPublisher of the same socket that reads the subscriptions
+        self.topics = set()
+        self.frame_number = 0
+
+    def update_subscriptions(self):
+        if self.subscriptions is not None:  # only one publisher may read the subscription messages
+            self.subscriptions.update_subscriptions()
+            self.topics = self.subscriptions.topics
+            return
+        while True:
+            try:
+                msg = self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if msg[:1] == b"\x01":
+                self.topics.add(msg[1:])
+            else:
+                self.topics.discard(msg[1:])
+
+    def raw_negotiated(self):
+        if self.topic is not None:  # only new monitors subscribe to topics
+            return self.raw
+        return self.raw and RAW_TOPIC in self.topics and b"" not in self.topics
+
+    def send(self, hist_occ, timestamp_start, timestamp_stop):
+        ''' Send one histogram (None if there were no hits)
+
+            Returns True if hist_occ was handed to zmq without copy, it must not be changed afterwards.
+        '''
+        metrics = self.metrics if self.metrics is not None and self.metrics.enabled else None
+        self.update_subscriptions()
+        if metrics:
+            start = time.time()
+        zero_copy = False
+        if self.raw_negotiated():
+            if hist_occ is None:
+                hist_occ = np.zeros(self.encoder.shape, dtype=np.uint32)
+            else:
+                zero_copy = hist_occ.flags.c_contiguous
+                hist_occ = np.ascontiguousarray(hist_occ)
+            frames = [RAW_HEADER.pack(RAW_TOPIC, hist_occ.dtype.str.encode("ascii"), hist_occ.shape[0], hist_occ.shape[1],
+                                      self.frame_number, timestamp_start, timestamp_stop), hist_occ]
+        elif self.hist_format == "sparse":
+            frames = [self.encoder.encode(hist_occ, timestamp_start, timestamp_stop)]
+        else:
+            p_hist = pickle.dumps(hist_occ, -1)
+            frames = [zlib.compress(p_hist)]
+        if metrics:
+            metrics.add("encode", start)
+            start = time.time()
+        if self.topic is not None:
+            frames.insert(0, self.topic)
+        if len(frames) > 1:
+            self.socket.send_multipart(frames, copy=False)
+        else:
+            self.socket.send(frames[0])
+        if metrics:
+            metrics.add("send", start)
+        self.frame_number += 1
+        return zero_copy
+
+
+def subscribe(socket, topics=RECV_TOPICS):
+    ''' Subscribe a SUB socket to the formats HistReceiver decodes without allow_pickle (or to a front end topic) '''
+    for topic in topics:
+        socket.setsockopt(zmq.SUBSCRIBE, topic)
+
+
+def strip_topic(frames):
+    ''' Frames without the topic frame of the front end hit maps '''
+    if len(frames) > 1 and frames[0].bytes[:len(FRONT_END_TOPIC)] == FRONT_END_TOPIC:
+        return frames[1:]
+    return frames
+
+
+class HistReceiver(object):
+    ''' Rebuilds histograms from the frames of socket.recv_multipart(copy=False)
+
+        Frame number and timestamps of the last decoded frame are kept (None
+        for the pickle format), gaps in the frame numbers are counted as missed.
+        Unpickling a frame can run any code, the pickle format is only
+        decoded with allow_pickle (subscribe to HIT_MAP_TOPICS then).
+    '''
+
+    def __init__(self, allow_pickle=False):
+        self.allow_pickle = allow_pickle
+        self.decoder = hist_codec.HistDecoder()
+        self.frame_number = None
+        self.timestamp_start = None
+        self.timestamp_stop = None
+        self.n_missed = 0
+
+    def _set_frame(self, frame_number, timestamp_start, timestamp_stop):
+        if self.frame_number is not None and frame_number > self.frame_number + 1:
+            self.n_missed += frame_number - self.frame_number - 1
+        self.frame_number, self.timestamp_start, self.timestamp_stop = frame_number, timestamp_start, timestamp_stop
+
+    def skip(self, frames):
+        ''' Account for a frame that is not decoded '''
+        frames = strip_topic(frames)
+        first = frames[0].bytes
+        if first[:len(RAW_TOPIC)] == RAW_TOPIC and len(frames) == 2:
+            self._set_frame(*RAW_HEADER.unpack(first)[4:])
+        elif hist_codec.is_frame(first):
+            self._set_frame(*hist_codec.HEADER.unpack_from(first)[4:7])
+
+    def needs_previous(self, frames):
+        ''' True if the frame can only be decoded after the previous frame (delta frame) '''
+        return hist_codec.is_delta(strip_topic(frames)[0].bytes)
+
+    def decode(self, frames):
+        ''' Returns the histogram, None if it cannot be decoded (missed delta reference) '''
+        frames = strip_topic(frames)
+        first = frames[0].bytes
+        if first[:len(RAW_TOPIC)] == RAW_TOPIC and len(frames) == 2:
+            _, dtype, n_col, n_row, frame_number, timestamp_start, timestamp_stop = RAW_HEADER.unpack(first)
+            self._set_frame(frame_number, timestamp_start, timestamp_stop)
+            return np.frombuffer(frames[1].buffer, dtype=np.dtype(dtype.rstrip(b"\0").decode("ascii"))).reshape((n_col, n_row))
+        if hist_codec.is_frame(first):
+            header, hist_occ = self.decoder.decode(first)
+            self._set_frame(header.frame_number, header.timestamp_start, header.timestamp_stop)
+            return hist_occ
+        if first[:len(PICKLE_TOPIC)] != PICKLE_TOPIC:
+            raise ValueError("Unknown hit map frame %r" % first[:8])
+        if not self.allow_pickle:
+            raise ValueError("Pickle hit map frame, the receiver needs allow_pickle")
+        self.frame_number = self.timestamp_start = self.timestamp_stop = None
+        return pickle.loads(zlib.decompress(first))
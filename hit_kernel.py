@@ -0,0 +1,160 @@
+''' Fused decode and histogram kernel for FE-I4 raw data.
+
+    One pass over the raw FIFO words filters the data records, decodes
+    column, row and ToT of both hits of a record and adds them to a
+    preallocated occupancy histogram. Compiled with numba if available,
+    otherwise a pure numpy implementation with the same result is used.
+
+    Every hit is looked up in the mask of the masked pixels (PixelMask), a
+    data record with only masked hits is not counted.
+
+    analyse_readouts() is the batch analysis (batch_analysis.analyse_readouts)
+    with the histograms of the windows filled by the kernel.
+'''
+import time
+
+import numpy as np
+
+import batch_analysis
+from pixel_mask import PixelMask
+from batch_analysis import COL_MASK, COL_SHIFT, ROW_MASK, ROW_SHIFT, TOT1_MASK, TOT1_SHIFT, TOT2_MASK, MAX_TOT, HIST_SHAPE
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+FE_WORD_MASK = 0xF0000000
+MAX_COL_BITS = 0x00A00000  # column 80
+MAX_ROW_BITS = 0x00015000  # row 336
+
+
+def _histogram_data_numpy(raw_data, hist_occ, col, row, tot, mask):
+    data_record = raw_data[batch_analysis.is_record(raw_data)]
+    c, r, t, record_index = batch_analysis.get_hits(data_record)
+    keep, dropped = batch_analysis.mask_hits(mask, c, r, record_index, data_record.shape[0])
+    c, r, t = c[keep], r[keep], t[keep]
+    n_hits = c.shape[0]
+    col[:n_hits], row[:n_hits], tot[:n_hits] = c, r, t
+    in_hist = r < hist_occ.shape[1]
+    hist_occ += np.bincount(c[in_hist] * hist_occ.shape[1] + r[in_hist], minlength=hist_occ.size).reshape(hist_occ.shape).astype(hist_occ.dtype)
+    return data_record.shape[0] - int(np.count_nonzero(dropped)), n_hits
+
+
+def _histogram_data(raw_data, hist_occ, col, row, tot, mask):
+    n_records = 0
+    n_hits = 0
+    for i in range(raw_data.shape[0]):
+        word = raw_data[i]
+        if word & FE_WORD_MASK != 0:
+            continue
+        col_bits = word & COL_MASK
+        row_bits = word & ROW_MASK
+        if col_bits == 0 or col_bits > MAX_COL_BITS or row_bits == 0 or row_bits > MAX_ROW_BITS:
+            continue
+        c = col_bits >> COL_SHIFT
+        r = row_bits >> ROW_SHIFT
+        record_hits = 0
+        masked_hits = 0
+        tot1 = (word & TOT1_MASK) >> TOT1_SHIFT
+        if tot1 < MAX_TOT:
+            record_hits += 1
+            if mask[c, r]:
+                masked_hits += 1
+            else:
+                col[n_hits], row[n_hits], tot[n_hits] = c, r, tot1
+                hist_occ[c, r] += 1
+                n_hits += 1
+        tot2 = word & TOT2_MASK
+        if tot2 < MAX_TOT:
+            record_hits += 1
+            if mask[c, r + 1]:
+                masked_hits += 1
+            else:
+                col[n_hits], row[n_hits], tot[n_hits] = c, r + 1, tot2
+                if r + 1 < hist_occ.shape[1]:
+                    hist_occ[c, r + 1] += 1
+                n_hits += 1
+        if record_hits == 0 or masked_hits < record_hits:
+            n_records += 1
+    return n_records, n_hits
+
+
+if njit is not None:
+    histogram_data = njit(nogil=True, cache=True)(_histogram_data)
+else:
+    histogram_data = _histogram_data_numpy
+
+
+def analyse_readouts(raw_data, starts, stops, window_stops, mask=None, metrics=None):
+    ''' Same interface and result as batch_analysis.analyse_readouts
+
+        The kernel is called once per readout with the histogram of its
+        window. The hits of a readout are contiguous in the hit buffers, the
+        medians are calculated on these slices as in the per readout loop,
+        after all kernel calls. With metrics both are timed (fused_kernel
+        and medians stage).
+    '''
+    if metrics:
+        start = time.time()
+    n_readouts = starts.shape[0]
+    n_windows = len(window_stops) + 1
+    if mask is None:
+        mask = np.zeros((HIST_SHAPE[0], HIST_SHAPE[1] + 1), dtype=np.bool_)
+    hist_occ = np.zeros((n_windows, ) + HIST_SHAPE, dtype=np.uint32)
+    col = np.empty(2 * raw_data.shape[0], dtype=np.uint32)
+    row = np.empty_like(col)
+    tot = np.empty_like(col)
+    hits = np.zeros(n_readouts, dtype=np.int64)
+    coloumn = np.full(n_readouts, np.nan)
+    row_median = np.full(n_readouts, np.nan)
+    window_of_readout = np.searchsorted(np.array(window_stops, dtype=np.int64), np.arange(n_readouts))
+    offsets = np.zeros(n_readouts + 1, dtype=np.int64)  # of the hits of each readout in the hit buffers
+    for i in range(n_readouts):
+        hits[i], n_hits = histogram_data(raw_data[starts[i]:stops[i]], hist_occ[window_of_readout[i]], col[offsets[i]:], row[offsets[i]:], tot[offsets[i]:], mask)
+        offsets[i + 1] = offsets[i] + n_hits
+    if metrics:
+        metrics.add("fused_kernel", start)
+        start = time.time()
+    for i in np.flatnonzero(offsets[1:] > offsets[:-1]):
+        coloumn[i] = np.median(col[offsets[i]:offsets[i + 1]])
+        row_median[i] = np.median(row[offsets[i]:offsets[i + 1]])
+    if metrics:
+        metrics.add("medians", start)
+    has_record = hits > 0
+    window_has_record = np.bincount(window_of_readout, weights=has_record, minlength=n_windows) > 0
+    hists = [hist_occ[i] if window_has_record[i] else None for i in range(n_windows)]
+    return hits, coloumn, row_median, has_record, hists
+
+
+class HitHistogram(object):
+    ''' Preallocated occupancy histogram filled with histogram_data()
+
+        The hit buffers only grow, the returned col/row/tot are views
+        into them and are overwritten by the next call of add(). The hits of
+        the pixels of mask (a PixelMask) are not added.
+    '''
+
+    def __init__(self, shape=HIST_SHAPE, mask=None):
+        self.hist_occ = np.zeros(shape, dtype=np.uint32)
+        self.mask = PixelMask(shape) if mask is None else mask
+        self._col = np.empty(0, dtype=np.uint32)
+        self._row = np.empty(0, dtype=np.uint32)
+        self._tot = np.empty(0, dtype=np.uint32)
+
+    def add(self, raw_data):
+        ''' Add the hits of raw_data, returns number of data records and col, row, tot of the hits '''
+        size = 2 * raw_data.shape[0]
+        if self._col.shape[0] < size:
+            self._col = np.empty(size, dtype=np.uint32)
+            self._row = np.empty(size, dtype=np.uint32)
+            self._tot = np.empty(size, dtype=np.uint32)
+        n_records, n_hits = histogram_data(raw_data, self.hist_occ, self._col, self._row, self._tot, self.mask.lookup)
+        return n_records, self._col[:n_hits], self._row[:n_hits], self._tot[:n_hits]
+
+    def reset(self):
+        self.hist_occ[:] = 0
+
+    def detach(self):
+        ''' Continue with a new histogram, the old one is still referenced elsewhere (e.g. zero-copy send) '''
+        self.hist_occ = np.zeros_like(self.hist_occ)
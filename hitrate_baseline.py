@@ -0,0 +1,166 @@
+''' Streaming estimators for the hitrate baseline used by analyse_beam.
+
+    The estimator is selected with threshold_vars["baseline_estimator"]:
+        "median":        median of the full hitrate history (original behaviour, cost grows with run length)
+        "window_median": median of the last threshold_vars["baseline_window"] hitrates, two heaps with lazy deletion
+        "ewma":          exponentially weighted moving average with threshold_vars["baseline_alpha"]
+    The window median is identical to the full median as long as the run has
+    less frames than the window.
+'''
+import heapq
+from collections import deque
+
+import numpy as np
+
+
+class MedianBaseline(object):
+    ''' Median of all hitrates '''
+
+    def __init__(self):
+        self.hitrate = []
+
+    def add(self, hitrate):
+        self.hitrate.append(hitrate)
+
+    def get(self):
+        return np.median(self.hitrate)
+
+
+class WindowMedianBaseline(object):
+    ''' Median of the last window hitrates, O(log n) per frame
+
+        The lower half of the window is in a max heap (negated values), the
+        upper half in a min heap. A hitrate that leaves the window is only
+        counted in removed and popped once it is on top of a heap, n_low and
+        n_high are the numbers of hitrates of the window in each heap. The
+        heaps are rebuilt from the ring if they have more than twice the
+        window entries (amortized O(log n) per frame).
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self.ring = deque()
+        self.low = []
+        self.high = []
+        self.n_low = 0
+        self.n_high = 0
+        self.removed = {}
+
+    def add(self, hitrate):
+        if len(self.ring) == self.window:
+            self._remove(self.ring.popleft())
+        self.ring.append(hitrate)
+        if len(self.low) + len(self.high) >= 2 * self.window:
+            self._rebuild()
+        if not self.low or hitrate <= -self.low[0]:
+            heapq.heappush(self.low, -hitrate)
+            self.n_low += 1
+        else:
+            heapq.heappush(self.high, hitrate)
+            self.n_high += 1
+        self._balance()
+
+    def _rebuild(self):
+        ''' Heaps of the hitrates in the ring without the removed ones, the last one is added by add() '''
+        values = sorted(list(self.ring)[:-1])
+        self.n_low = (len(values) + 1) // 2
+        self.n_high = len(values) - self.n_low
+        self.low = [-value for value in reversed(values[:self.n_low])]  # sorted lists are heaps
+        self.high = values[self.n_low:]
+        self.removed = {}
+
+    def _remove(self, hitrate):
+        self.removed[hitrate] = self.removed.get(hitrate, 0) + 1
+        if hitrate <= -self.low[0]:
+            self.n_low -= 1
+            if hitrate == -self.low[0]:
+                self._prune(self.low, -1)
+        else:
+            self.n_high -= 1
+            if hitrate == self.high[0]:
+                self._prune(self.high, 1)
+        self._balance()
+
+    def _prune(self, heap, sign):
+        ''' Pop the removed hitrates from the top of heap '''
+        while heap and self.removed.get(sign * heap[0]):
+            hitrate = sign * heapq.heappop(heap)
+            self.removed[hitrate] -= 1
+            if not self.removed[hitrate]:
+                del self.removed[hitrate]
+
+    def _balance(self):
+        ''' The lower half has as many or one more hitrate than the upper half '''
+        if self.n_low > self.n_high + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.n_low -= 1
+            self.n_high += 1
+            self._prune(self.low, -1)
+        elif self.n_low < self.n_high:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.n_high -= 1
+            self.n_low += 1
+            self._prune(self.high, 1)
+
+    def get(self):
+        if self.n_low > self.n_high:
+            return float(-self.low[0])
+        return (-self.low[0] + self.high[0]) / 2.
+
+
+class EwmaBaseline(object):
+    ''' Exponentially weighted moving average of the hitrate, O(1) per frame '''
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def add(self, hitrate):
+        if self.value is None:
+            self.value = float(hitrate)
+        else:
+            self.value += self.alpha * (hitrate - self.value)
+
+    def get(self):
+        return self.value
+
+
+class HitrateBaseline(object):
+    ''' Running hitrate count and sum, the baseline estimator and the mean of the accepted baselines
+
+        Replaces len(), sum() and np.median() of the hitrate history and
+        np.mean() of the baseline list in analyse_beam.
+    '''
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+        self.n = 0
+        self.sum = 0.
+        self.n_baseline = 0
+        self.sum_baseline = 0.
+
+    def add(self, hitrate):
+        self.n += 1
+        self.sum += hitrate
+        self.estimator.add(hitrate)
+
+    def median(self):
+        return self.estimator.get()
+
+    def add_baseline(self, baseline):
+        self.n_baseline += 1
+        self.sum_baseline += baseline
+
+    def mean_baseline(self):
+        return self.sum_baseline / self.n_baseline
+
+
+def create_baseline(threshold_vars):
+    estimator = threshold_vars.get("baseline_estimator", "median")
+    if estimator == "median":
+        return HitrateBaseline(MedianBaseline())
+    if estimator == "window_median":
+        return HitrateBaseline(WindowMedianBaseline(threshold_vars["baseline_window"]))
+    if estimator == "ewma":
+        return HitrateBaseline(EwmaBaseline(threshold_vars["baseline_alpha"]))
+    raise ValueError("Unknown baseline estimator %s" % estimator)
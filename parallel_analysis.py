@@ -0,0 +1,224 @@
+''' Multi-process version of batch_analysis.analyse_readouts.
+
+    The readouts of each integration window are split into chunks that are
+    analysed by a pool of worker processes. Raw data and occupancy
+    histograms are exchanged through shared memory slots, only the small
+    per readout results (hits, column/row median) go through the pool pipes.
+    The coordinator merges the histograms of the chunks of each window and
+    returns the results in readout (timestamp) order, so the caller sees
+    exactly the same per frame sequence as with the serial analysis.
+
+    With several front ends ModulePool analyses the readouts of each front
+    end in its own process, the front ends do not share any state. The
+    raw data and histograms go through shared memory slots as well.
+'''
+import ctypes
+import multiprocessing
+import time
+
+import numpy as np
+
+import batch_analysis
+import hit_kernel
+from batch_analysis import HIST_SHAPE
+
+N_PIXEL = HIST_SHAPE[0] * HIST_SHAPE[1]
+
+_shared = {}
+
+
+def _init_worker(hists, raw, max_words):
+    _shared["hists"] = np.frombuffer(hists, dtype=np.uint32).reshape((-1, ) + HIST_SHAPE)
+    _shared["raw"] = np.frombuffer(raw, dtype=np.uint32).reshape((-1, max_words))
+
+
+def _analyse_chunk(slot, n_words, starts, stops, mask, fused):
+    raw_data = _shared["raw"][slot, :n_words]
+    analyse_readouts = hit_kernel.analyse_readouts if fused else batch_analysis.analyse_readouts
+    hits, coloumn, row, has_record, hists = analyse_readouts(raw_data, starts, stops, [], mask)
+    if hists[0] is None:
+        return hits, coloumn, row, has_record, False
+    _shared["hists"][slot] = hists[0]
+    return hits, coloumn, row, has_record, True
+
+
+class ParallelAnalysis(object):
+    ''' Pool of analysis processes with 2 shared memory slots per process
+
+        max_words is the maximum number of raw data words of one chunk,
+        larger single readouts are analysed in the calling process. Windows
+        are not split into chunks smaller than min_words, for small chunks
+        the pipe overhead is larger than the analysis. With fused the
+        chunks are analysed with hit_kernel.analyse_readouts.
+
+        A chunk costs about 1 ms of pipe round trip and copying, the fused
+        kernel analyses about 20k words per ms. Parallel analysis only pays
+        off with a core per worker and calls of more than about 50k words
+        (2 workers, 4 readouts at 1e6 hits/s), see benchmark().
+    '''
+
+    def __init__(self, n_workers, max_words=1 << 20, min_words=1 << 16, fused=True):
+        self.n_workers = n_workers
+        self.n_slots = 2 * n_workers
+        self.max_words = max_words
+        self.min_words = min_words
+        self.fused = fused
+        self._hists_buffer = multiprocessing.RawArray(ctypes.c_uint32, self.n_slots * N_PIXEL)
+        self._raw_buffer = multiprocessing.RawArray(ctypes.c_uint32, self.n_slots * max_words)
+        self._hists = np.frombuffer(self._hists_buffer, dtype=np.uint32).reshape((-1, ) + HIST_SHAPE)
+        self._raw = np.frombuffer(self._raw_buffer, dtype=np.uint32).reshape((-1, max_words))
+        self.pool = multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(self._hists_buffer, self._raw_buffer, max_words))
+
+    def _analyse_readouts(self, *task):
+        return (hit_kernel.analyse_readouts if self.fused else batch_analysis.analyse_readouts)(*task)
+
+    def _chunks(self, starts, stops, window_stops):
+        ''' Split the readouts into chunks (window, first readout, last readout + 1) '''
+        chunks = []
+        first = 0
+        for window, last in enumerate(window_stops + [starts.shape[0] - 1]):
+            if first > last:
+                break
+            words = stops[last] - starts[first]
+            chunk_words = min(max(words // self.n_workers, self.min_words, 1), self.max_words)
+            # cut at the first readout that starts after each multiple of chunk_words
+            cuts = np.searchsorted(starts[first:last + 1] - starts[first], np.arange(chunk_words, words, chunk_words), side="right") + first
+            bounds = np.unique(np.concatenate(([first], cuts, [last + 1])))
+            chunks.extend((window, bounds[i], bounds[i + 1]) for i in range(bounds.shape[0] - 1))
+            first = last + 1
+        return chunks
+
+    def analyse_readouts(self, raw_data, starts, stops, window_stops, mask=None):
+        ''' Same interface and result as batch_analysis.analyse_readouts '''
+        n_readouts = starts.shape[0]
+        n_windows = len(window_stops) + 1
+        hits = np.zeros(n_readouts, dtype=np.int64)
+        coloumn = np.full(n_readouts, np.nan)
+        row = np.full(n_readouts, np.nan)
+        has_record = np.zeros(n_readouts, dtype=bool)
+        hists = [None] * n_windows
+
+        def merge(window, first, last, result):
+            hits[first:last], coloumn[first:last], row[first:last], has_record[first:last], hist = result
+            if hist is None:
+                return
+            if hists[window] is None:
+                hists[window] = hist.copy()
+            else:
+                hists[window] += hist
+
+        chunks = self._chunks(starts, stops, window_stops)
+        for i in range(0, len(chunks), self.n_slots):
+            pending = []
+            for slot, (window, first, last) in enumerate(chunks[i:i + self.n_slots]):
+                n_words = stops[last - 1] - starts[first]
+                if n_words > self.max_words:  # too large for a slot
+                    result = self._analyse_readouts(raw_data[starts[first]:stops[last - 1]], starts[first:last] - starts[first], stops[first:last] - starts[first], [], mask)
+                    merge(window, first, last, result[:4] + (result[4][0], ))
+                    continue
+                self._raw[slot, :n_words] = raw_data[starts[first]:stops[last - 1]]
+                pending.append((slot, window, first, last, self.pool.apply_async(_analyse_chunk, (slot, n_words, starts[first:last] - starts[first], stops[first:last] - starts[first], mask, self.fused))))
+            for slot, window, first, last, result in pending:
+                result = result.get()
+                merge(window, first, last, result[:4] + (self._hists[slot] if result[4] else None, ))
+        return hits, coloumn, row, has_record, hists
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def _init_module_worker(hists, raw, max_words, max_windows):
+    _shared["module_hists"] = np.frombuffer(hists, dtype=np.uint32).reshape((-1, max_windows) + HIST_SHAPE)
+    _shared["module_raw"] = np.frombuffer(raw, dtype=np.uint32).reshape((-1, max_words))
+
+
+def _analyse_module(slot, n_words, starts, stops, window_stops, mask, fused):
+    raw_data = _shared["module_raw"][slot, :n_words]
+    analyse_readouts = hit_kernel.analyse_readouts if fused else batch_analysis.analyse_readouts
+    hits, coloumn, row, has_record, hists = analyse_readouts(raw_data, starts, stops, window_stops, mask)
+    in_slot = []  # windows with the histogram in the shared memory slot
+    for window, hist in enumerate(hists[:_shared["module_hists"].shape[1]]):
+        if hist is not None:
+            _shared["module_hists"][slot, window] = hist
+            hists[window] = None
+            in_slot.append(window)
+    return hits, coloumn, row, has_record, hists, in_slot
+
+
+class ModulePool(object):
+    ''' Pool of analysis processes, one analyse_readouts per front end
+
+        Like ParallelAnalysis the raw data and the histograms go through
+        shared memory slots (2 per process), max_windows histograms per
+        slot. Readouts larger than max_words are analysed in the calling
+        process, histograms of more windows go through the pool pipes. With
+        fused the processes use hit_kernel.analyse_readouts.
+
+        The processes are forked when the pool is created, create it before
+        the sockets and threads of the calling process.
+    '''
+
+    def __init__(self, n_workers, max_words=1 << 20, max_windows=4, fused=True):
+        self.n_workers = n_workers
+        self.n_slots = 2 * n_workers
+        self.max_words = max_words
+        self.max_windows = max_windows
+        self.fused = fused
+        self._hists_buffer = multiprocessing.RawArray(ctypes.c_uint32, self.n_slots * max_windows * N_PIXEL)
+        self._raw_buffer = multiprocessing.RawArray(ctypes.c_uint32, self.n_slots * max_words)
+        self._hists = np.frombuffer(self._hists_buffer, dtype=np.uint32).reshape((-1, max_windows) + HIST_SHAPE)
+        self._raw = np.frombuffer(self._raw_buffer, dtype=np.uint32).reshape((-1, max_words))
+        self.pool = multiprocessing.Pool(n_workers, initializer=_init_module_worker, initargs=(self._hists_buffer, self._raw_buffer, max_words, max_windows))
+
+    def _analyse_readouts(self, *task):
+        return (hit_kernel.analyse_readouts if self.fused else batch_analysis.analyse_readouts)(*task)
+
+    def analyse(self, tasks):
+        ''' Results of analyse_readouts(raw_data, starts, stops, window_stops, mask) for each task, in task order '''
+        if len(tasks) == 1:  # nothing to run in parallel
+            return [self._analyse_readouts(*tasks[0])]
+        results = [None] * len(tasks)
+        for i in range(0, len(tasks), self.n_slots):
+            pending = []
+            for slot, (raw_data, starts, stops, window_stops, mask) in enumerate(tasks[i:i + self.n_slots]):
+                if raw_data.shape[0] > self.max_words:  # too large for a slot
+                    results[i + slot] = self._analyse_readouts(raw_data, starts, stops, window_stops, mask)
+                    continue
+                self._raw[slot, :raw_data.shape[0]] = raw_data
+                pending.append((i + slot, slot, self.pool.apply_async(_analyse_module, (slot, raw_data.shape[0], starts, stops, window_stops, mask, self.fused))))
+            for task, slot, result in pending:
+                hits, coloumn, row, has_record, hists, in_slot = result.get()
+                for window in in_slot:
+                    hists[window] = self._hists[slot, window].copy()
+                results[task] = hits, coloumn, row, has_record, hists
+        return results
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def benchmark(readouts, n_workers_list=(0, 1, 2, 4, 8), integration_time=0.05, repeat=3, fused=True):
+    ''' Throughput of the serial (0 workers) and parallel analysis of a list of readouts
+
+        Returns (n_workers, readouts/s, hits/s) for each worker count.
+    '''
+    raw_data, starts, stops, timestamp_start, timestamp_stop = batch_analysis.concatenate_readouts(readouts)
+    window_stops = batch_analysis.get_window_stops(timestamp_start, timestamp_stop, None, integration_time)
+    results = []
+    for n_workers in n_workers_list:
+        engine = ParallelAnalysis(n_workers, fused=fused) if n_workers else None
+        if engine:
+            analyse_readouts = engine.analyse_readouts
+        else:
+            analyse_readouts = hit_kernel.analyse_readouts if fused else batch_analysis.analyse_readouts
+        analyse_readouts(raw_data, starts, stops, window_stops)  # warm up
+        start = time.time()
+        for _ in range(repeat):
+            hits = analyse_readouts(raw_data, starts, stops, window_stops)[0]
+        duration = (time.time() - start) / repeat
+        results.append((n_workers, len(readouts) / duration, hits.sum() / duration))
+        if engine:
+            engine.close()
+    return results
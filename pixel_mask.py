@@ -0,0 +1,97 @@
+''' Online masking of noisy pixels.
+
+    A noisy pixel firing at a high rate inflates the hitrate, skews the
+    column/row medians and can raise false hitrate peak and beam moved
+    alarms. NoisyPixelTracker sums the occupancy of the windows for interval
+    seconds and flags the pixels with far more hits than their neighbours.
+    They are added to the PixelMask of the front end. The decoding looks up
+    every hit in the mask (one boolean per pixel) and removes the masked hits
+    before the histogram, the medians and the hitrate are calculated. A data
+    record with only masked hits is not counted in the hitrate.
+
+    The mask only grows during a run. It is cleared with clear() and can be
+    saved to and loaded from a text file with one "column row" line per
+    masked pixel.
+'''
+import numpy as np
+
+from batch_analysis import HIST_SHAPE
+
+
+class PixelMask(object):
+    ''' Masked pixels of one front end
+
+        lookup has one row more than the histogram: the second hit of a data
+        record in the last row is looked up there (never masked).
+    '''
+
+    def __init__(self, shape=HIST_SHAPE):
+        self.shape = shape
+        self.lookup = np.zeros((shape[0], shape[1] + 1), dtype=np.bool_)
+        self.n_masked = 0
+
+    def add(self, pixels):
+        ''' Mask the pixels (column, row), returns the number of newly masked pixels '''
+        pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+        self.lookup[pixels[:, 0], pixels[:, 1]] = True
+        n_masked = self.n_masked
+        self.n_masked = int(np.count_nonzero(self.lookup))
+        return self.n_masked - n_masked
+
+    def clear(self):
+        self.lookup[:] = False
+        self.n_masked = 0
+
+    def get_lookup(self):
+        ''' The lookup table, None without masked pixel (the batch analysis skips the lookup) '''
+        return self.lookup if self.n_masked else None
+
+    def pixels(self):
+        ''' Column and row of the masked pixels '''
+        return np.argwhere(self.lookup)
+
+    def save(self, filename):
+        np.savetxt(filename, self.pixels(), fmt="%d", header="column row of the masked pixels")
+
+    def load(self, filename):
+        ''' Mask the pixels of a file written by save(), the mask is cleared first '''
+        pixels = np.loadtxt(filename, dtype=np.int64, ndmin=2)
+        self.clear()
+        return self.add(pixels)
+
+
+def get_noisy_pixels(hist_occ, factor, min_hits):
+    ''' Column and row of the pixels with at least min_hits hits and more than factor times the median of their 8 neighbours '''
+    sensor = hist_occ[1:, 1:HIST_SHAPE[1]].astype(np.float64)  # FE-I4 columns and rows start at 1
+    padded = np.pad(sensor, 1, mode="edge")
+    n_col, n_row = sensor.shape
+    neighbours = np.stack([padded[1 + i:1 + i + n_col, 1 + j:1 + j + n_row] for i in (-1, 0, 1) for j in (-1, 0, 1) if i or j])
+    noisy = (sensor >= min_hits) & (sensor > factor * np.median(neighbours, axis=0))
+    return np.argwhere(noisy) + 1
+
+
+class NoisyPixelTracker(object):
+    ''' Sums the window histograms for interval seconds and flags the noisy pixels (see get_noisy_pixels) '''
+
+    def __init__(self, factor=20., min_hits=100, interval=1., shape=HIST_SHAPE):
+        self.factor = factor
+        self.min_hits = min_hits
+        self.interval = interval
+        self.shape = shape
+        self.reset()
+
+    def reset(self):
+        self.hist_occ = np.zeros(self.shape, dtype=np.uint32)
+        self.timestamp_start = None
+
+    def add(self, hist_occ, timestamp_start, timestamp_stop):
+        ''' Add the histogram of one window (None without hits), returns the noisy pixels when the interval is over, otherwise None '''
+        if self.timestamp_start is None:
+            self.timestamp_start = timestamp_start
+        if hist_occ is not None:
+            self.hist_occ += hist_occ
+        if timestamp_stop - self.timestamp_start < self.interval:
+            return None
+        noisy = get_noisy_pixels(self.hist_occ, self.factor, self.min_hits)
+        self.reset()
+        return noisy
@@ -1,54 +1,252 @@
+''' TTi power supply of the FE-I4, polled on a background thread.
+
+    All serial I/O happens in the thread of the PowerSupply service: it
+    reads the voltages of all channels every interval seconds and runs the
+    on/off sequences. The slow control only reads the cached readings
+    (voltage and time of the reading) and gets the completion of a sequence
+    with dispatch(), so no command waits on the hardware.
+
+    Importing the module does not touch the hardware, the service is
+    created by get_power_supply() and opens the Dut in its own thread. With
+    conf["simulate"] a SimulatedDut is used instead of basil's Dut.
+'''
 from __future__ import print_function
-from basil.dut import Dut
+import logging
+import threading
 import time
+from collections import namedtuple
+from Queue import Queue, Empty
+
+conf = {
+    "dut": '/home/rasmus/git/basil/examples/lab_devices/ttiql355tp.yaml',
+    "simulate": False,
+    "channels": (1, 2, 3),
+    "interval": 1.,  # seconds between two readings of all channels
+    "settle_time": 3.,  # seconds after switching before the sequence is done
+    "power_off_on_start": True,  # switch all channels off when the service is created
+    }
+
+Reading = namedtuple("Reading", ["voltage", "timestamp"])
+
+
+class SimulatedPowerSupply(object):
+    ''' Stands in for the TTi QL355TP, latency is the time of one serial round trip '''
+
+    def __init__(self, voltages=None, latency=0.):
+        self.voltages = voltages if voltages is not None else {1: 1.5, 2: 1.5, 3: 5.}
+        self.latency = latency
+        self.output = dict.fromkeys(self.voltages, False)
+
+    def _io(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_name(self):
+        self._io()
+        return "Simulated TTi QL355TP"
+
+    def on(self, channel):
+        self._io()
+        self.output[channel] = True
+
+    def off(self, channel):
+        self._io()
+        self.output[channel] = False
+
+    def set_voltage(self, value, channel):
+        self._io()
+        self.voltages[channel] = value
+
+    def get_voltage(self, channel):
+        self._io()
+        return self.voltages[channel] if self.output[channel] else 0.
+
+
+class SimulatedDut(object):
+    ''' Dut with a SimulatedPowerSupply as PowerSupply '''
+
+    def __init__(self, conf=None, **kwargs):
+        self.power_supply = SimulatedPowerSupply(**kwargs)
+
+    def init(self):
+        pass
+
+    def __getitem__(self, name):
+        if name != "PowerSupply":
+            raise KeyError(name)
+        return self.power_supply
+
+
+def get_dut():
+    if conf["simulate"]:
+        dut = SimulatedDut()
+    else:
+        from basil.dut import Dut
+        dut = Dut(conf["dut"])
+    dut.init()
+    return dut
+
+
+class PowerSupply(object):
+    ''' Cached readings and asynchronous on/off sequences of the channels of a Dut["PowerSupply"]
+
+        Without dut the Dut of get_dut() is opened by the service thread.
+    '''
+
+    def __init__(self, dut=None, channels=(1, 2, 3), interval=1., settle_time=3.):
+        self.dut = dut
+        self.connect_time = None  # seconds to open the Dut and read its name
+        self.channels = channels
+        self.interval = interval
+        self.settle_time = settle_time
+        self.readings = dict((channel, Reading(None, None)) for channel in channels)
+        self.name = None
+        self.error = None
+        self._commands = Queue()
+        self._done = Queue()
+        self._pending = []  # (deadline, callback) of switched sequences
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="PowerSupply")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._commands.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def power_on(self, callback=None):
+        ''' Switch all channels on, callback(error) is called by dispatch() once the voltages settled '''
+        self._commands.put((True, callback))
+
+    def power_off(self, callback=None):
+        ''' Switch all channels off, callback(error) is called by dispatch() once the voltages settled '''
+        self._commands.put((False, callback))
+
+    def reading(self, channel):
+        ''' Last Reading of a channel, (None, None) before the first reading '''
+        return self.readings[channel]
+
+    def voltage(self, channel):
+        return self.readings[channel].voltage
+
+    def age(self, channel):
+        ''' Seconds since the last reading of a channel, None before the first reading '''
+        timestamp = self.readings[channel].timestamp
+        return None if timestamp is None else time.time() - timestamp
+
+    def dispatch(self):
+        ''' Call the callbacks of the finished sequences in the calling thread '''
+        while True:
+            try:
+                callback, error = self._done.get_nowait()
+            except Empty:
+                return
+            if callback is not None:
+                callback(error)
+
+    def poll(self):
+        ''' Read the voltages of all channels (service thread) '''
+        if self.dut is None:
+            self._connect()  # retry after a failed connect
+            if self.dut is None:
+                raise IOError("TTi not connected")
+        power_supply = self.dut["PowerSupply"]
+        for channel in self.channels:
+            self.readings[channel] = Reading(power_supply.get_voltage(channel=channel), time.time())
+
+    def _switch(self, on, callback):
+        try:
+            if self.dut is None:
+                raise IOError("TTi not connected")
+            power_supply = self.dut["PowerSupply"]
+            for channel in self.channels:
+                if on:
+                    power_supply.on(channel=channel)
+                else:
+                    power_supply.off(channel=channel)
+        except Exception as e:
+            logging.error("Failed to switch TTi %s", "on" if on else "off", exc_info=True)
+            self._done.put((callback, e))
+            return
+        self._pending.append((time.time() + self.settle_time, callback))
+
+    def _connect(self):
+        start = time.time()
+        try:
+            if self.dut is None:
+                self.dut = get_dut()
+            self.name = self.dut["PowerSupply"].get_name()
+            logging.info("Power supply: %s", self.name)
+        except Exception as e:
+            logging.error("Failed to connect to TTi", exc_info=True)
+            self.error = e
+        self.connect_time = time.time() - start
+
+    def _run(self):
+        self._connect()
+        next_poll = time.time()
+        while True:
+            deadline = min([next_poll] + [pending[0] for pending in self._pending])
+            try:
+                command = self._commands.get(timeout=max(deadline - time.time(), 0.))
+            except Empty:
+                command = False
+            if command is None:
+                break
+            if command:
+                self._switch(*command)
+            now = time.time()
+            done = [pending for pending in self._pending if pending[0] <= now]
+            if now < next_poll and not done:
+                continue
+            try:
+                self.poll()
+                self.error = None
+            except Exception as e:
+                logging.error("Failed to read the TTi", exc_info=True)
+                self.error = e
+            next_poll = now + self.interval
+            for pending in done:
+                self._pending.remove(pending)
+                self._done.put((pending[1], self.error))
+
+
+power_supply = None
+
+
+def get_power_supply():
+    ''' The PowerSupply service, created and started on first use '''
+    global power_supply
+    if power_supply is None:
+        power_supply = PowerSupply(channels=conf["channels"], interval=conf["interval"], settle_time=conf["settle_time"])
+        power_supply.start()
+        if conf["power_off_on_start"]:
+            power_supply.power_off()
+    return power_supply
+
+
+def power_on(callback=None):
+    get_power_supply().power_on(callback)
+
+
+def power_off(callback=None):
+    get_power_supply().power_off(callback)
 
 
-
-dut = Dut('/home/rasmus/git/basil/examples/lab_devices/ttiql355tp.yaml')
-dut.init()
-print(dut['PowerSupply'].get_name())
-
-def power_on():
-    dut['PowerSupply'].on(channel=1)
-    dut['PowerSupply'].on(channel=2)
-    dut['PowerSupply'].on(channel=3)
-
-    time.sleep(3)
-
-    print ("Channel 1")
-    print(dut['PowerSupply'].get_voltage(channel=1))    
-    print ("Channel 2")
-    print(dut['PowerSupply'].get_voltage(channel=2))
-
-
-def power_off():
-    dut['PowerSupply'].off(channel=1)
-    dut['PowerSupply'].off(channel=2)
-    dut['PowerSupply'].off(channel=3)
-
-    time.sleep(3)
-
-    print ("Channel 1")
-    print(dut['PowerSupply'].get_voltage(channel=1))    
-    print ("Channel 2")
-    print(dut['PowerSupply'].get_voltage(channel=2))
-    
-    
 def voltage_channel1():
-    return dut['PowerSupply'].get_voltage(channel=1)
-
-def voltage_channel2():
-    return dut['PowerSupply'].get_voltage(channel=2)
-
-
-
-#print (voltage_channel1())
-#print (voltage_channel2())
-power_off()
-
-#dut['PowerSupply'].set_voltage(1.2,channel=1) 
-#dut['PowerSupply'].set_voltage(1.5,channel=2)
+    return get_power_supply().voltage(1)
 
 
+def voltage_channel2():
+    return get_power_supply().voltage(2)
 
 
+#get_power_supply().dut['PowerSupply'].set_voltage(1.2,channel=1)
+#get_power_supply().dut['PowerSupply'].set_voltage(1.5,channel=2)
@@ -0,0 +1,111 @@
+''' Publishing of the occupancy histograms independent of the analysis rate.
+
+    The analysis closes a window every integration_time, the scheduler adds
+    its histogram to each stream. A stream accumulates the windows and sends
+    the sum once its interval is over (interval 0: every window) or when a
+    frame is requested. Streams without subscriber on their XPUB socket
+    are neither accumulated nor sent.
+'''
+from collections import OrderedDict
+
+
+class Stream(object):
+    ''' Accumulated histogram of one published stream
+
+        send(hist_occ, timestamp_start, timestamp_stop) returns True if
+        hist_occ was handed to zmq without copy. topics are the prefixes of
+        the messages of the stream, with subscribe_all it is also sent to
+        clients that subscribed to everything (empty topic). publisher is
+        the HistPublisher of the socket of the stream if it is not the
+        socket of the scheduler.
+    '''
+
+    def __init__(self, send, interval=0., topics=(b"", ), subscribe_all=True, publisher=None):
+        self.send = send
+        self.interval = interval
+        self.topics = topics
+        self.subscribe_all = subscribe_all
+        self.publisher = publisher
+        self.requested = False
+        self.reset()
+
+    def reset(self):
+        self.hist_occ = None
+        self.timestamp_start = None
+        self.timestamp_stop = None
+
+    def add(self, hist_occ, timestamp_start, timestamp_stop):
+        ''' Add the histogram of one window (None without hits), returns True if hist_occ was sent without copy '''
+        if self.timestamp_start is None:
+            self.timestamp_start = timestamp_start
+        self.timestamp_stop = timestamp_stop
+        due = self.requested or timestamp_stop - self.timestamp_start >= self.interval
+        if due and self.hist_occ is None:  # nothing accumulated, send the window directly
+            zero_copy = self.send(hist_occ, self.timestamp_start, timestamp_stop)
+            self.requested = False
+            self.reset()
+            return zero_copy
+        if hist_occ is not None:
+            if self.hist_occ is None:
+                self.hist_occ = hist_occ.copy()
+            else:
+                self.hist_occ += hist_occ
+        if due:
+            self.flush()
+        return False
+
+    def flush(self):
+        ''' Send the accumulated histogram '''
+        self.requested = False
+        if self.timestamp_start is None:
+            return
+        self.send(self.hist_occ, self.timestamp_start, self.timestamp_stop)
+        self.reset()  # the sent histogram is not used anymore
+
+
+class PublishScheduler(object):
+    ''' Streams of one HistPublisher socket '''
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.streams = OrderedDict()
+
+    def add_stream(self, name, send, interval=0., topics=(b"", ), subscribe_all=True, publisher=None):
+        self.streams[name] = Stream(send, interval, topics, subscribe_all, publisher)
+        return self.streams[name]
+
+    def set_interval(self, interval, name=None):
+        ''' Accumulation time in seconds of one (default all) stream '''
+        for stream_name, stream in self.streams.items():
+            if name is None or stream_name == name:
+                stream.interval = interval
+
+    def request(self, name=None):
+        ''' Send one (default all) stream with the next window '''
+        for stream_name, stream in self.streams.items():
+            if name is None or stream_name == name:
+                stream.requested = True
+
+    def subscribed(self, stream):
+        publisher = self.publisher if stream.publisher is None else stream.publisher
+        return any(topic.startswith(subscription) for subscription in publisher.topics if subscription or stream.subscribe_all
+                   for topic in stream.topics)
+
+    def add(self, hist_occ, timestamp_start, timestamp_stop):
+        ''' Add the histogram of one window to all streams, returns True if hist_occ was sent without copy '''
+        self.publisher.update_subscriptions()
+        for stream in self.streams.values():
+            if stream.publisher is not None:
+                stream.publisher.update_subscriptions()
+        zero_copy = False
+        for stream in self.streams.values():
+            if not self.subscribed(stream):
+                stream.reset()
+                stream.requested = False
+                continue
+            zero_copy |= stream.add(hist_occ, timestamp_start, timestamp_stop)
+        return zero_copy
+
+    def reset(self):
+        for stream in self.streams.values():
+            stream.reset()
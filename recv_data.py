@@ -12,8 +12,7 @@ from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea, Dock
 import pyqtgraph.ptime as ptime
 
-import zlib
-import cPickle as pickle
+import hist_transport
 
 
 class DataWorker(QtCore.QObject):
@@ -25,32 +24,81 @@ class DataWorker(QtCore.QObject):
     meta_data = QtCore.pyqtSignal(dict)
     finished = QtCore.pyqtSignal()
     
-    def __init__(self):
+    def __init__(self, display_rate=10., rcvhwm=10, topic=None, allow_pickle=False):
         QtCore.QObject.__init__(self)
         self.integrate_readouts = 1
         self.n_readout = 0
         self._stop_readout = Event()
         self.reset_lock = Lock()
+        self.receiver = hist_transport.HistReceiver(allow_pickle=allow_pickle)
+        self.display_rate = display_rate  # maximum number of emitted frames per second
+        self.rcvhwm = rcvhwm
+        self.topic = topic  # hit maps of one front end or of all front ends, see hist_transport.front_end_topic
+        self.n_frames = 0  # received frames
+        self.n_conflated = 0  # received but not displayed frames
+        self._data_array = None  # newest frame not emitted yet
+        self._last_emit = 0.
 
         
     def connect(self, socket_addr):
         self.socket_addr = socket_addr
         self.context = zmq.Context()
         self.socket_pull = self.context.socket(zmq.SUB)  # subscriber
-        self.socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
+        # CONFLATE does not support multipart messages (raw transport), the queue is bounded and drained instead
+        self.socket_pull.setsockopt(zmq.RCVHWM, self.rcvhwm)
+        if self.topic is None:
+            # all hit map formats, raw transport if the sender supports it
+            hist_transport.subscribe(self.socket_pull, hist_transport.HIT_MAP_TOPICS if self.receiver.allow_pickle else hist_transport.RECV_TOPICS)
+        else:
+            hist_transport.subscribe(self.socket_pull, (self.topic, ))
         self.socket_pull.connect(self.socket_addr)
 
-    
+    def recv_pending(self):
+        ''' All frames waiting in the socket queue, oldest first '''
+        pending = []
+        while True:
+            try:
+                pending.append(self.socket_pull.recv_multipart(flags=zmq.NOBLOCK, copy=False))
+            except zmq.Again:
+                return pending
+
+    def decode_newest(self, pending):
+        ''' Decode only the newest frame, the older ones only if the newest is a delta frame '''
+        needs_previous = self.receiver.needs_previous(pending[-1])
+        for frames in pending[:-1]:
+            if needs_previous:
+                self.receiver.decode(frames)
+            else:
+                self.receiver.skip(frames)
+        return self.receiver.decode(pending[-1])
+
     def process_data(self):
         while(not self._stop_readout.wait(0.01)):  # use wait(), do not block here
             with self.reset_lock:
-                data = self.socket_pull.recv()  
-                p_hist = zlib.decompress(data)
-                data_array = pickle.loads(p_hist)
+                pending = self.recv_pending()
+                if pending:
+                    self.n_frames += len(pending)
+                    self.n_conflated += len(pending) - 1
+                    data_array = self.decode_newest(pending)
+                    if data_array is None:  # delta frame without its reference frame
+                        self.n_conflated += 1
+                    else:
+                        if self._data_array is not None:  # not displayed yet, replaced by the newer frame
+                            self.n_conflated += 1
+                        self._data_array = data_array
+                now = time.time()
+                if self._data_array is None or now - self._last_emit < 1. / self.display_rate:
+                    continue
+                self._last_emit = now
                 if self.integrate_readouts != 0 and self.n_readout % self.integrate_readouts == 0:
                     interpreted_data = {
-                        'occupancy': data_array}
+                        'occupancy': self._data_array}
                     self.interpreted_data.emit(interpreted_data)
+                self._data_array = None
+                self.meta_data.emit({
+                    'timestamp_stop': self.receiver.timestamp_stop,
+                    'n_frames': self.n_frames,
+                    'n_dropped': self.n_conflated + self.receiver.n_missed})
         self.finished.emit()
         
     def stop(self):
@@ -59,8 +107,13 @@ class DataWorker(QtCore.QObject):
         
 class OnlineMonitorApplication(QtGui.QMainWindow):
 
-    def __init__(self, socket_addr):
+    def __init__(self, socket_addr, display_rate=10., rcvhwm=10, topic=None, allow_pickle=False):
         super(OnlineMonitorApplication, self).__init__()
+        self.display_rate = display_rate
+        self.rcvhwm = rcvhwm
+        self.topic = topic
+        self.allow_pickle = allow_pickle
+        self.n_dropped = 0
         self.setup_plots()
         self.add_widgets()
         self.fps = 0  # data frames per second
@@ -75,8 +128,9 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
 
     def setup_data_worker_and_start(self, socket_addr):
         self.thread = QtCore.QThread()  # no parent
-        self.worker = DataWorker()  # no parent
+        self.worker = DataWorker(display_rate=self.display_rate, rcvhwm=self.rcvhwm, topic=self.topic, allow_pickle=self.allow_pickle)  # no parent
         self.worker.interpreted_data.connect(self.on_interpreted_data)
+        self.worker.meta_data.connect(self.on_meta_data)
         self.worker.run_start.connect(self.on_run_start)
         self.worker.run_config_data.connect(self.on_run_config_data)
     #    self.worker.run_config_data.connect(self.on_run_config_data)
@@ -109,6 +163,14 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         cw.setStyleSheet("QWidget {background-color:white}")
         layout = QtGui.QGridLayout()
         cw.setLayout(layout)
+        self.rate_label = QtGui.QLabel("Display Rate\n0 Hz")
+        self.plot_delay_label = QtGui.QLabel("Plot Delay\n")
+        self.dropped_label = QtGui.QLabel("Dropped Frames\n0")
+        for i, label in enumerate((self.rate_label, self.plot_delay_label, self.dropped_label)):
+            layout.addWidget(label, 0, i)
+        dock_status = Dock("Status", size=(400, 60))
+        dock_status.addWidget(cw)
+        self.dock_area.addDock(dock_status, 'top')
 
         # Run config dock
         self.run_conf_list_widget = Qt.QListWidget()
@@ -161,6 +223,12 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
     def on_interpreted_data(self, interpreted_data):
         self.update_plots(**interpreted_data)
 
+    def on_meta_data(self, meta_data):
+        if meta_data['timestamp_stop'] is not None:  # the pickle format has no timestamps
+            self.plot_delay = time.time() - meta_data['timestamp_stop']
+        self.n_dropped = meta_data['n_dropped']
+        self.update_monitor()
+
     def reset_plots(self):
         self.update_plots(np.zeros((80, 336, 1), dtype=np.uint8))
     
@@ -173,23 +241,37 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         recent_fps = 1.0 / (now - self.updateTime)  # calculate FPS
         self.updateTime = now
         self.fps = self.fps * 0.7 + recent_fps * 0.3   
+        self.rate_label.setText("Display Rate\n%d Hz" % self.fps)
+        self.dropped_label.setText("Dropped Frames\n%d" % self.n_dropped)
             
             
 if __name__ == '__main__':
-    usage = "Usage: %prog ADDRESS"
-    description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5002)."
+    usage = "Usage: %prog [options] ADDRESS"
+    description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5004, the stream socket of the sender)."
     parser = OptionParser(usage, description=description)
+    parser.add_option("-r", "--display-rate", type="float", default=10., help="maximum number of displayed frames per second (default: %default)")
+    parser.add_option("--rcvhwm", type="int", default=10, help="maximum number of queued frames (default: %default)")
+    parser.add_option("-f", "--front-end", help="hit maps of one front end (index) or of all front ends side by side (combined)")
+    parser.add_option("--allow-pickle", action="store_true", default=False, help="decode pickled hit maps, only for trusted senders")
     options, args = parser.parse_args()
     if len(args) == 0:
-        socket_addr = 'tcp://127.0.0.1:5002'
+        socket_addr = 'tcp://127.0.0.1:5004'
     elif len(args) == 1:
         socket_addr = args[0]
     else:
         parser.error("incorrect number of arguments")
+    if options.front_end is None:
+        topic = None
+    elif options.front_end == "combined":
+        topic = hist_transport.COMBINED_TOPIC
+    elif options.front_end.isdigit():
+        topic = hist_transport.front_end_topic(int(options.front_end))
+    else:
+        parser.error("invalid front end %s" % options.front_end)
 
     app = Qt.QApplication(sys.argv)
 #     app.aboutToQuit.connect(myExitHandler)
-    win = OnlineMonitorApplication(socket_addr=socket_addr)  # enter remote IP to connect to the other side listening
+    win = OnlineMonitorApplication(socket_addr=socket_addr, display_rate=options.display_rate, rcvhwm=options.rcvhwm, topic=topic, allow_pickle=options.allow_pickle)  # enter remote IP to connect to the other side listening
     win.resize(500, 500)
     win.setWindowTitle('Online Monitor')
     win.show()
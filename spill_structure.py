@@ -0,0 +1,292 @@
+''' High resolution hitrate series and spill structure of the extraction.
+
+    The hitrate of analyse_beam has one value per integration window. The
+    RateSeries uses the number of data records and the timestamps of every
+    readout instead. The records of a readout are spread uniformly over its
+    time and summed into bins of dt seconds. The resolution is limited by the
+    readout interval (fifo_readout.WRITE_INTERVAL, 50 ms during a run):
+    structure faster than one readout is averaged out.
+
+    WelchSpectrum averages the periodograms of the last n_segments half
+    overlapping segments of the series. Only the newest segment is
+    transformed when it is complete. From the spectrum and the series
+    get_spill_structure() derives:
+
+        spill period: strongest frequency below min_ripple_frequency
+        duty factor: <rate>^2 / <rate^2> (1 for a constant rate)
+        ripple: strongest spectral peaks between min_ripple_frequency and
+                half the readout rate that stand out of their neighbourhood
+
+    The per readout counts are steps of the readout length in the series:
+    their spectrum has the harmonics of the readout rate (strong lines if
+    there are gaps between the readouts) and images of slower structure
+    around them. Above half the readout rate there is no ripple to resolve,
+    so these frequencies are not searched. The harmonics of the spill
+    structure are dense lines of similar power, a ripple peak has to be
+    ripple_contrast times stronger than the rest of the RIPPLE_NEIGHBOURS
+    bins on each side (outside of its Hann main lobe) and ripple_snr times
+    stronger than the median of the searched band.
+
+    SpillMonitor sends the series (SERIES_TOPIC) and the spill structure
+    with the spectrum (SPECTRUM_TOPIC) every interval seconds on the stream
+    socket while a client subscribed to the topic. Like all messages of that
+    socket they also reach the clients that subscribed to everything.
+'''
+import struct
+from collections import deque, namedtuple
+
+import numpy as np
+
+from beam_state import RingBuffer
+
+SERIES_TOPIC = b"E3RS"
+SPECTRUM_TOPIC = b"E3SP"
+# topic, frame number, time of the first bin, bin width, number of bins (float32 rates follow)
+SERIES_HEADER = struct.Struct("<4sIddI")
+# topic, frame number, timestamp, frequency step, spill period, duty factor, mean rate,
+# number of ripple peaks (frequency and fraction of the power, float64), number of spectrum bins (float32)
+SPECTRUM_HEADER = struct.Struct("<4sIdddddHI")
+
+# bins on each side of a ripple peak it is compared with, bins of the main lobe of a peak (Hann window)
+RIPPLE_NEIGHBOURS = 16
+MAIN_LOBE = 2
+
+SpillStructure = namedtuple("SpillStructure", ["period", "duty_factor", "mean_rate", "ripple"])
+
+
+def resample(timestamp_start, timestamp_stop, hits, edges):
+    ''' Hits of the readouts between the edges, the hits of a readout are spread uniformly over its time
+
+        The readouts must be sorted and must not overlap.
+    '''
+    cumulative = np.concatenate(([0.], np.cumsum(hits, dtype=np.float64)))  # hits before each readout
+    readout = np.searchsorted(timestamp_start, edges, side="right") - 1
+    after_first = readout >= 0
+    readout = np.maximum(readout, 0)
+    length = timestamp_stop[readout] - timestamp_start[readout]
+    fraction = np.ones(edges.shape[0])
+    in_readout = length > 0
+    fraction[in_readout] = np.clip((edges[in_readout] - timestamp_start[readout][in_readout]) / length[in_readout], 0., 1.)
+    return np.diff(np.where(after_first, cumulative[readout] + hits[readout] * fraction, 0.))
+
+
+class RateSeries(object):
+    ''' Hitrate on a grid of dt seconds, the last capacity bins are kept '''
+
+    def __init__(self, dt=0.005, capacity=1 << 15):
+        self.dt = dt
+        self.rates = RingBuffer(capacity)
+        self.reset()
+
+    def reset(self):
+        self.rates.clear()
+        self.timestamp = None  # start of the next bin
+        self.readout_interval = None  # median time between the starts of the readouts of the last add()
+        self._pending = (np.zeros(0), np.zeros(0), np.zeros(0))  # readouts that end after timestamp
+
+    def add(self, timestamp_start, timestamp_stop, hits):
+        ''' Add readouts, returns the rates of the completed bins '''
+        timestamp_start, timestamp_stop, hits = [np.concatenate((pending, np.asarray(values, dtype=np.float64)))
+                                                 for pending, values in zip(self._pending, (timestamp_start, timestamp_stop, hits))]
+        if not timestamp_start.shape[0]:
+            return np.zeros(0)
+        if timestamp_start.shape[0] > 1:
+            self.readout_interval = float(np.median(np.diff(timestamp_start)))
+        if self.timestamp is None:
+            self.timestamp = timestamp_start[0]
+        n_bins = int((timestamp_stop[-1] - self.timestamp) // self.dt)
+        if n_bins > self.rates.capacity:  # gap in the data, the older bins would be dropped anyway
+            self.timestamp += (n_bins - self.rates.capacity) * self.dt
+            n_bins = self.rates.capacity
+        if n_bins <= 0:
+            self._pending = timestamp_start, timestamp_stop, hits
+            return np.zeros(0)
+        edges = self.timestamp + self.dt * np.arange(n_bins + 1)
+        rates = resample(timestamp_start, timestamp_stop, hits, edges) / self.dt
+        self.timestamp = edges[-1]
+        pending = timestamp_stop > self.timestamp
+        self._pending = timestamp_start[pending], timestamp_stop[pending], hits[pending]
+        self.rates.extend(rates)
+        return rates
+
+
+class WelchSpectrum(object):
+    ''' Power spectral density of a series (bin width dt) averaged over the last n_segments segments
+
+        Segments of nperseg bins overlap by half, each is detrended (mean)
+        and weighted with a Hann window. With n_segments None all segments
+        are averaged.
+    '''
+
+    def __init__(self, dt, nperseg=4096, n_segments=4):
+        self.dt = dt
+        self.nperseg = nperseg
+        self.n_segments = n_segments
+        self.window = np.hanning(nperseg)
+        self.scale = dt / np.sum(self.window ** 2)
+        self.frequencies = np.fft.rfftfreq(nperseg, dt)
+        self.reset()
+
+    def reset(self):
+        self._buffer = np.zeros(0)
+        self._periodograms = deque()
+        self._sum = np.zeros(self.frequencies.shape[0])
+
+    def add(self, values):
+        ''' Add the next values of the series, returns the number of new segments '''
+        self._buffer = np.concatenate((self._buffer, values))
+        n_new = 0
+        while self._buffer.shape[0] >= self.nperseg:
+            segment = self._buffer[:self.nperseg]
+            periodogram = np.abs(np.fft.rfft((segment - segment.mean()) * self.window)) ** 2 * self.scale
+            periodogram[1:] *= 2  # one sided
+            self._periodograms.append(periodogram)
+            self._sum += periodogram
+            if self.n_segments and len(self._periodograms) > self.n_segments:
+                self._sum -= self._periodograms.popleft()
+            self._buffer = self._buffer[self.nperseg // 2:]
+            n_new += 1
+        return n_new
+
+    def n_averaged(self):
+        return len(self._periodograms)
+
+    def get(self):
+        ''' Averaged spectrum, None before the first segment '''
+        if not self._periodograms:
+            return None
+        return self._sum / len(self._periodograms)
+
+
+def get_peak_frequency(frequencies, power, index):
+    ''' Frequency of the peak at index, refined with a parabola through the neighbours '''
+    if 0 < index < power.shape[0] - 1:
+        left, center, right = power[index - 1:index + 2]
+        denominator = left - 2 * center + right
+        if denominator:
+            return frequencies[index] + 0.5 * (left - right) / denominator * (frequencies[1] - frequencies[0])
+    return frequencies[index]
+
+
+def get_spill_structure(rates, frequencies, power, min_ripple_frequency=1., n_ripple=3, readout_interval=None, ripple_contrast=2., ripple_snr=10.):
+    ''' SpillStructure of a rate series and its spectrum (None: no spectrum yet), see the module docstring '''
+    mean_rate = rates.mean() if rates.shape[0] else np.nan
+    mean_square = np.mean(rates ** 2) if rates.shape[0] else 0.
+    duty_factor = mean_rate ** 2 / mean_square if mean_square else np.nan
+    if power is None:
+        return SpillStructure(np.nan, duty_factor, mean_rate, [])
+    slow = np.flatnonzero((frequencies > 0) & (frequencies < min_ripple_frequency))
+    period = np.nan
+    if slow.shape[0] and power[slow].max() > 0:
+        index = slow[np.argmax(power[slow])]
+        period = 1. / get_peak_frequency(frequencies, power, index)
+    band = frequencies >= min_ripple_frequency
+    if readout_interval:
+        band &= frequencies < 0.5 / readout_interval
+    # local maxima in the band that stand out of their neighbourhood, strongest first
+    peaks = np.flatnonzero((power[1:-1] > power[:-2]) & (power[1:-1] >= power[2:])) + 1
+    peaks = peaks[band[peaks]]
+    if peaks.shape[0]:
+        padded = np.pad(power, RIPPLE_NEIGHBOURS, mode="edge")  # padded[index + RIPPLE_NEIGHBOURS] is power[index]
+        neighbours = np.array([max(padded[index:index + RIPPLE_NEIGHBOURS - MAIN_LOBE].max(),
+                                   padded[index + RIPPLE_NEIGHBOURS + MAIN_LOBE + 1:index + 2 * RIPPLE_NEIGHBOURS + 1].max()) for index in peaks])
+        peaks = peaks[(power[peaks] > ripple_contrast * neighbours) & (power[peaks] > ripple_snr * np.median(power[band]))]
+    peaks = peaks[np.argsort(power[peaks])[::-1][:n_ripple]]
+    total = power[1:].sum()
+    ripple = [(get_peak_frequency(frequencies, power, index), power[index] / total if total else 0.) for index in peaks]
+    return SpillStructure(period, duty_factor, mean_rate, ripple)
+
+
+class SpillMonitor(object):
+    ''' RateSeries and WelchSpectrum of the readouts, sent on socket to the subscribers of their topic
+
+        subscriptions is the HistPublisher of the socket. The spill structure
+        and the series since the last message are sent every interval seconds.
+    '''
+
+    def __init__(self, socket, subscriptions, dt=0.005, nperseg=4096, n_segments=4, interval=1., min_ripple_frequency=1.):
+        self.socket = socket
+        self.subscriptions = subscriptions
+        self.series = RateSeries(dt, capacity=max(1 << 15, nperseg * ((n_segments or 1) + 1) // 2))
+        self.spectrum = WelchSpectrum(dt, nperseg, n_segments)
+        self.interval = interval
+        self.min_ripple_frequency = min_ripple_frequency
+        self.frame_number = {SERIES_TOPIC: 0, SPECTRUM_TOPIC: 0}
+        self.reset()
+
+    def reset(self):
+        self.series.reset()
+        self.spectrum.reset()
+        self.last_send = None
+        self._unsent = []  # completed bins since the last series message
+        self._unsent_start = None
+
+    def add(self, timestamp_start, timestamp_stop, hits):
+        ''' Add the readouts (timestamps and data records of each readout) '''
+        series_start = self.series.timestamp
+        rates = self.series.add(timestamp_start, timestamp_stop, hits)
+        if not rates.shape[0]:
+            return
+        self.spectrum.add(rates)
+        if self._unsent_start is None:
+            self._unsent_start = series_start if series_start is not None else self.series.timestamp - rates.shape[0] * self.series.dt
+        self._unsent.append(rates)
+        if self.last_send is None:
+            self.last_send = self.series.timestamp
+        if self.series.timestamp - self.last_send >= self.interval:
+            self.send()
+
+    def subscribed(self, topic):
+        return any(subscription and topic.startswith(subscription) for subscription in self.subscriptions.topics)
+
+    def window_rates(self):
+        ''' Rates of the series covered by the spectrum '''
+        n_segments = self.spectrum.n_segments or self.spectrum.n_averaged()
+        return self.series.rates.view((max(n_segments, 1) + 1) * self.spectrum.nperseg // 2)
+
+    def get(self):
+        return get_spill_structure(self.window_rates(), self.spectrum.frequencies, self.spectrum.get(), self.min_ripple_frequency,
+                                   readout_interval=self.series.readout_interval)
+
+    def summary(self):
+        spill = self.get()
+        ripple = ", ".join("%.2f Hz (%.1f %%)" % (frequency, fraction * 100.) for frequency, fraction in spill.ripple)
+        return "spill period: %.2f s, duty factor: %.2f, mean rate: %.0f [Hz], ripple: %s" % (spill.period, spill.duty_factor, spill.mean_rate, ripple or "-")
+
+    def send(self):
+        self.subscriptions.update_subscriptions()
+        timestamp = self.series.timestamp
+        if self.subscribed(SERIES_TOPIC):
+            rates = np.concatenate(self._unsent).astype(np.float32)
+            self.socket.send(SERIES_HEADER.pack(SERIES_TOPIC, self.frame_number[SERIES_TOPIC], self._unsent_start, self.series.dt, rates.shape[0]) + rates.tobytes())
+            self.frame_number[SERIES_TOPIC] += 1
+        if self.subscribed(SPECTRUM_TOPIC):
+            spill = self.get()
+            power = self.spectrum.get()
+            power = np.zeros(0, dtype=np.float32) if power is None else power.astype(np.float32)
+            ripple = np.array(spill.ripple, dtype=np.float64).reshape(-1, 2)
+            header = SPECTRUM_HEADER.pack(SPECTRUM_TOPIC, self.frame_number[SPECTRUM_TOPIC], timestamp, self.spectrum.frequencies[1],
+                                          spill.period, spill.duty_factor, spill.mean_rate, ripple.shape[0], power.shape[0])
+            self.socket.send(header + ripple.tobytes() + power.tobytes())
+            self.frame_number[SPECTRUM_TOPIC] += 1
+        self._unsent = []
+        self._unsent_start = None
+        self.last_send = timestamp
+
+
+def decode(msg):
+    ''' Returns topic, frame number, timestamp and the data of a series or spectrum message
+
+        The data of a series message is (bin width, rates), of a spectrum
+        message (frequency step, SpillStructure, power spectral density).
+    '''
+    topic = msg[:4]
+    if topic == SERIES_TOPIC:
+        topic, frame_number, timestamp, dt, n_bins = SERIES_HEADER.unpack_from(msg)
+        return topic, frame_number, timestamp, (dt, np.frombuffer(msg, dtype=np.float32, count=n_bins, offset=SERIES_HEADER.size))
+    if topic == SPECTRUM_TOPIC:
+        topic, frame_number, timestamp, df, period, duty_factor, mean_rate, n_ripple, n_bins = SPECTRUM_HEADER.unpack_from(msg)
+        ripple = np.frombuffer(msg, dtype=np.float64, count=2 * n_ripple, offset=SPECTRUM_HEADER.size).reshape(-1, 2)
+        power = np.frombuffer(msg, dtype=np.float32, count=n_bins, offset=SPECTRUM_HEADER.size + ripple.nbytes)
+        return topic, frame_number, timestamp, (df, SpillStructure(period, duty_factor, mean_rate, [tuple(peak) for peak in ripple]), power)
+    raise ValueError("Unknown spill topic %r" % topic)
@@ -0,0 +1,60 @@
+''' Startup time report and socket stand-in of the analysis core.
+
+    E3_control creates the pyBAR scans, the RunManager, the power supply and
+    the zmq sockets only when they are used first. StartupReport collects
+    the time of each of these steps, so a slow start can be traced to its
+    cause.
+
+    Until the sockets are set up, the messages of the analysis core go to an
+    Outbox, which keeps the last messages in memory. This makes the core
+    usable by tools and benchmarks without sockets.
+'''
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import zmq
+
+
+class StartupReport(object):
+
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self.steps = OrderedDict()
+
+    def add(self, name, duration):
+        self.steps[name] = duration
+        logging.info("Startup: %s took %.3f s", name, duration)
+
+    @contextmanager
+    def step(self, name):
+        ''' Time the block as step name '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def summary(self):
+        lines = ["startup: %.3f s since start" % (time.time() - self.start)]
+        lines.extend("%s: %.3f s" % (name, duration) for name, duration in self.steps.items())
+        return "\n".join(lines)
+
+
+class Outbox(object):
+    ''' Keeps the last maxlen messages sent to it instead of a zmq socket '''
+
+    def __init__(self, maxlen=1000):
+        self.messages = deque(maxlen=maxlen)
+
+    def send(self, msg, *args, **kwargs):
+        self.messages.append(msg)
+
+    send_string = send
+
+    def send_multipart(self, msg_parts, *args, **kwargs):
+        self.messages.append(list(msg_parts))
+
+    def recv(self, *args, **kwargs):
+        raise zmq.Again()